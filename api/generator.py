@@ -0,0 +1,102 @@
+import torch
+import torch.nn as nn
+
+# Self-Attention Module
+class SelfAttention(nn.Module):
+    def __init__(self, in_channels):
+        super(SelfAttention, self).__init__()
+        self.query = nn.Conv2d(in_channels, in_channels // 8, 1)
+        self.key = nn.Conv2d(in_channels, in_channels // 8, 1)
+        self.value = nn.Conv2d(in_channels, in_channels, 1)
+        self.gamma = nn.Parameter(torch.zeros(1))
+
+    def forward(self, x):
+        batch, channels, height, width = x.size()
+        proj_query = self.query(x).view(batch, -1, height * width).permute(0, 2, 1)
+        proj_key = self.key(x).view(batch, -1, height * width)
+        energy = torch.bmm(proj_query, proj_key)
+        attention = torch.softmax(energy, dim=-1)
+        proj_value = self.value(x).view(batch, -1, height * width)
+        out = torch.bmm(proj_value, attention.permute(0, 2, 1))
+        out = out.view(batch, channels, height, width)
+        out = self.gamma * out + x
+        return out
+
+# Generator class (matches trained model)
+class Generator(nn.Module):
+    def __init__(self, in_channels, out_channels):
+        super(Generator, self).__init__()
+        self.enc1 = nn.Sequential(
+            nn.Conv2d(in_channels, 64, 4, stride=2, padding=1),
+            nn.LeakyReLU(0.2)
+        )  # 256x256 -> 128x128
+        self.enc2 = nn.Sequential(
+            nn.Conv2d(64, 128, 4, stride=2, padding=1),
+            nn.BatchNorm2d(128),
+            nn.LeakyReLU(0.2)
+        )  # 128x128 -> 64x64
+        self.enc3 = nn.Sequential(
+            nn.Conv2d(128, 256, 4, stride=2, padding=1),
+            nn.BatchNorm2d(256),
+            nn.LeakyReLU(0.2)
+        )  # 64x64 -> 32x32
+        self.enc4 = nn.Sequential(
+            nn.Conv2d(256, 512, 4, stride=2, padding=1),
+            nn.BatchNorm2d(512),
+            nn.LeakyReLU(0.2)
+        )  # 32x32 -> 16x16
+        self.enc5 = nn.Sequential(
+            nn.Conv2d(512, 512, 4, stride=2, padding=1),
+            nn.BatchNorm2d(512),
+            nn.LeakyReLU(0.2)
+        )  # 16x16 -> 8x8
+        self.attention = SelfAttention(512)
+        self.dec1 = nn.Sequential(
+            nn.ConvTranspose2d(512, 512, 4, stride=2, padding=1),
+            nn.BatchNorm2d(512),
+            nn.ReLU(),
+            nn.Dropout(0.3)
+        )  # 8x8 -> 16x16
+        self.dec2 = nn.Sequential(
+            nn.ConvTranspose2d(1024, 256, 4, stride=2, padding=1),
+            nn.BatchNorm2d(256),
+            nn.ReLU(),
+            nn.Dropout(0.3)
+        )  # 16x16 -> 32x32
+        self.dec3 = nn.Sequential(
+            nn.ConvTranspose2d(512, 128, 4, stride=2, padding=1),
+            nn.BatchNorm2d(128),
+            nn.ReLU(),
+            nn.Dropout(0.3)
+        )  # 32x32 -> 64x64
+        self.dec4 = nn.Sequential(
+            nn.ConvTranspose2d(256, 64, 4, stride=2, padding=1),
+            nn.BatchNorm2d(64),
+            nn.ReLU(),
+            nn.Dropout(0.3)
+        )  # 64x64 -> 128x128
+        self.dec5 = nn.Sequential(
+            nn.ConvTranspose2d(128, 64, 4, stride=2, padding=1),
+            nn.BatchNorm2d(64),
+            nn.ReLU(),
+            nn.Dropout(0.3)
+        )  # 128x128 -> 256x256
+        self.dec6 = nn.Sequential(
+            nn.Conv2d(64, out_channels, 3, stride=1, padding=1),
+            nn.Tanh()
+        )  # 256x256 -> 256x256
+
+    def forward(self, x):
+        e1 = self.enc1(x)
+        e2 = self.enc2(e1)
+        e3 = self.enc3(e2)
+        e4 = self.enc4(e3)
+        e5 = self.enc5(e4)
+        e5 = self.attention(e5)
+        d1 = self.dec1(e5)
+        d2 = self.dec2(torch.cat([d1, e4], dim=1))
+        d3 = self.dec3(torch.cat([d2, e3], dim=1))
+        d4 = self.dec4(torch.cat([d3, e2], dim=1))
+        d5 = self.dec5(torch.cat([d4, e1], dim=1))
+        d6 = self.dec6(d5)
+        return d6
@@ -0,0 +1,247 @@
+import argparse
+import copy
+import inspect
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Callable, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from generator import Generator
+
+try:
+    import onnxruntime as ort
+except ImportError:  # onnxruntime is only needed for the "onnxruntime" runtime
+    ort = None
+
+logger = logging.getLogger(__name__)
+
+RUNTIMES = ("eager", "torchscript", "onnxruntime")
+INPUT_SHAPE = (1, 1, 256, 256)
+
+
+def configure_threads(intra_op_threads: int = 0, inter_op_threads: int = 0):
+    """Set PyTorch intra-/inter-op thread pools; 0 keeps the PyTorch default."""
+    if intra_op_threads > 0:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads > 0:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError as e:
+            # Only allowed before the first inter-op parallel work in the process
+            logger.warning("Could not set inter-op threads: %s", str(e))
+
+
+def fuse_generator(model: Generator) -> Generator:
+    """Return an eval-mode copy of the generator with BatchNorm folded into the preceding conv.
+
+    Every ``Conv2d``/``ConvTranspose2d`` directly followed by ``BatchNorm2d`` in
+    the encoder and decoder blocks is replaced by a single conv with adjusted
+    weights and bias. Dropout layers, which are no-ops in eval mode, are dropped.
+    """
+    fused = copy.deepcopy(model).eval()
+    for name, block in fused.named_children():
+        if not isinstance(block, nn.Sequential):
+            continue
+        layers = list(block)
+        merged = []
+        i = 0
+        while i < len(layers):
+            layer = layers[i]
+            following = layers[i + 1] if i + 1 < len(layers) else None
+            if isinstance(layer, (nn.Conv2d, nn.ConvTranspose2d)) and isinstance(following, nn.BatchNorm2d):
+                merged.append(fuse_conv_bn_eval(layer, following, transpose=isinstance(layer, nn.ConvTranspose2d)))
+                i += 2
+                continue
+            if not isinstance(layer, nn.Dropout):
+                merged.append(layer)
+            i += 1
+        setattr(fused, name, nn.Sequential(*merged))
+    return fused
+
+
+def write_atomically(path: str, write: Callable[[str], None]):
+    """Call ``write`` with a temporary path next to ``path``, then rename it into place.
+
+    Services booting at once may export to the same cache directory; none of
+    them can load a half-written artifact.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def export_torchscript(model: nn.Module, path: str) -> torch.jit.ScriptModule:
+    """Trace, freeze and save the model as TorchScript."""
+    with torch.no_grad():
+        traced = torch.jit.trace(model, torch.randn(*INPUT_SHAPE))
+    frozen = torch.jit.freeze(traced)
+    write_atomically(path, frozen.save)
+    return frozen
+
+
+def export_onnx(model: nn.Module, path: str, int8: bool = False) -> str:
+    """Export the model to ONNX with a dynamic batch axis; optionally add a dynamic int8 copy.
+
+    Returns the path of the model to load (the quantized one when ``int8``).
+    """
+    # Newer PyTorch defaults to the dynamo exporter; the TorchScript-based one handles this model
+    options = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+
+    def export(tmp_path: str):
+        with torch.no_grad():
+            torch.onnx.export(model, torch.randn(*INPUT_SHAPE), tmp_path, opset_version=17,
+                              input_names=["sketch"], output_names=["photo"],
+                              dynamic_axes={"sketch": {0: "batch"}, "photo": {0: "batch"}}, **options)
+
+    write_atomically(path, export)
+    if not int8:
+        return path
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    quantized_path = path.replace(".onnx", ".int8.onnx")
+    # Conv weights become int8 (ConvInteger); activations are quantized per batch at run time
+    write_atomically(quantized_path, lambda tmp_path: quantize_dynamic(path, tmp_path, weight_type=QuantType.QInt8))
+    return quantized_path
+
+
+class GeneratorEngine:
+    """Callable wrapper that runs the generator on the selected runtime.
+
+    Takes and returns float32 ``(N, C, 256, 256)`` tensors, like the eager model.
+    """
+
+    def __init__(self, runtime: str, module=None, session=None):
+        self.runtime = runtime
+        self.module = module
+        self.session = session
+
+    def __call__(self, batch: torch.Tensor) -> torch.Tensor:
+        if self.session is not None:
+            output, = self.session.run(None, {"sketch": batch.detach().cpu().numpy().astype(np.float32)})
+            return torch.from_numpy(output)
+        with torch.no_grad():
+            return self.module(batch)
+
+
+def build_engine(model: Generator, runtime: str = "eager", fuse: bool = True, int8: bool = False,
+                 cache_dir: str = None, intra_op_threads: int = 0, inter_op_threads: int = 0) -> GeneratorEngine:
+    """Prepare the generator for CPU inference on ``runtime``.
+
+    Compiled artifacts (``generator.ts`` / ``generator.onnx``) are written to
+    ``cache_dir``. ``int8`` applies ONNX Runtime dynamic quantization; the
+    generator has no Linear layers, so PyTorch dynamic quantization would leave
+    it unchanged and the flag is ignored for the other runtimes.
+    """
+    if runtime not in RUNTIMES:
+        raise ValueError(f"Unknown runtime {runtime!r}; expected one of {RUNTIMES}")
+    configure_threads(intra_op_threads, inter_op_threads)
+    prepared = (fuse_generator(model) if fuse else copy.deepcopy(model).eval()).cpu()
+    if int8 and runtime != "onnxruntime":
+        logger.warning("int8 is only supported with the onnxruntime runtime; running %s in float32", runtime)
+
+    if runtime == "eager":
+        return GeneratorEngine(runtime, module=prepared)
+
+    cache_dir = cache_dir or os.path.join(os.path.dirname(__file__), "models", "compiled")
+    os.makedirs(cache_dir, exist_ok=True)
+    if runtime == "torchscript":
+        module = export_torchscript(prepared, os.path.join(cache_dir, "generator.ts"))
+        return GeneratorEngine(runtime, module=module)
+
+    if ort is None:
+        raise RuntimeError("onnxruntime is not installed")
+    onnx_path = export_onnx(prepared, os.path.join(cache_dir, "generator.onnx"), int8=int8)
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if intra_op_threads > 0:
+        options.intra_op_num_threads = intra_op_threads
+    if inter_op_threads > 0:
+        options.inter_op_num_threads = inter_op_threads
+    session = ort.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+    return GeneratorEngine(runtime, session=session)
+
+
+def parity_check(model: Generator, engine: GeneratorEngine, batch_size: int = 2, seed: int = 0) -> dict:
+    """Compare engine output with the eager model on random sketches.
+
+    Returns the maximum and mean absolute difference over all output values.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    sketches = torch.rand(batch_size, *INPUT_SHAPE[1:], generator=generator) * 2 - 1
+    with torch.no_grad():
+        expected = model.eval()(sketches.to(next(model.parameters()).device)).cpu()
+    actual = engine(sketches).cpu()
+    difference = (expected - actual).abs()
+    return {"max_abs_diff": float(difference.max()), "mean_abs_diff": float(difference.mean())}
+
+
+def build_checked_engine(model: Generator, runtime: str = "eager", fuse: bool = True, int8: bool = False,
+                         cache_dir: str = None, intra_op_threads: int = 0, inter_op_threads: int = 0,
+                         tolerance: float = 1e-3, int8_tolerance: float = 0.02) -> Tuple[GeneratorEngine, dict]:
+    """:func:`build_engine`, then :func:`parity_check` against the eager model; returns the engine and parity.
+
+    Raises ValueError when the maximum absolute difference exceeds
+    ``tolerance``, or for an int8 ONNX Runtime engine when the mean absolute
+    difference exceeds ``int8_tolerance``.
+    """
+    engine = build_engine(model, runtime, fuse=fuse, int8=int8, cache_dir=cache_dir,
+                          intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads)
+    parity = parity_check(model, engine)
+    if int8 and engine.runtime == "onnxruntime":
+        if parity["mean_abs_diff"] > int8_tolerance:
+            raise ValueError(f"int8 mean abs diff {parity['mean_abs_diff']:.4g} exceeds {int8_tolerance}")
+    elif parity["max_abs_diff"] > tolerance:
+        raise ValueError(f"max abs diff {parity['max_abs_diff']:.4g} exceeds {tolerance}")
+    return engine, parity
+
+
+def benchmark(engine: GeneratorEngine, batch_size: int = 1, iterations: int = 10) -> dict:
+    """Mean latency of the engine for one batch, after a warm-up call."""
+    sketches = torch.randn(batch_size, *INPUT_SHAPE[1:])
+    engine(sketches)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        engine(sketches)
+    batch_ms = (time.perf_counter() - start) * 1000 / iterations
+    return {"batch_size": batch_size, "batch_ms": batch_ms, "ms_per_sketch": batch_ms / batch_size}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the sketch-to-photo generator and compare runtimes.")
+    parser.add_argument("--weights", default=os.path.join(os.path.dirname(__file__), "models", "G_sketch_to_photo_best.pth"))
+    parser.add_argument("--runtime", choices=RUNTIMES, nargs="+", default=list(RUNTIMES))
+    parser.add_argument("--int8", action="store_true")
+    parser.add_argument("--no-fuse", action="store_true")
+    parser.add_argument("--intra-op-threads", type=int, default=0)
+    parser.add_argument("--inter-op-threads", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--iterations", type=int, default=10)
+    args = parser.parse_args()
+
+    model = Generator(in_channels=1, out_channels=3)
+    model.load_state_dict(torch.load(args.weights, map_location="cpu"))
+    model.eval()
+
+    for runtime in args.runtime:
+        engine = build_engine(model, runtime, fuse=not args.no_fuse, int8=args.int8,
+                              intra_op_threads=args.intra_op_threads, inter_op_threads=args.inter_op_threads)
+        report = {"runtime": runtime, "fused": not args.no_fuse, "int8": args.int8 and runtime == "onnxruntime"}
+        report.update(parity_check(model, engine))
+        report.update(benchmark(engine, args.batch_size, args.iterations))
+        print(json.dumps(report))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    main()
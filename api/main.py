@@ -1,23 +1,46 @@
 import torch
-import torch.nn as nn
 import cv2
 import numpy as np
-from PIL import Image
-from torchvision import transforms
-from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.background import BackgroundTask
 import io
 import base64
 from pathlib import Path
 import logging
 import os
+import sys
+import json
+import uuid
+import asyncio
+import itertools
+import threading
+import time
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+from generator import Generator
+from inference import GeneratorEngine, build_checked_engine
+
+# Upload ingest, admission control and instrumentation shared with api2 live in common/ at the repository root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.admission import AdmissionController, ClientGone, Overloaded
+from common.ingest import ImageTooLarge, batch_buffer, decode_image, read_upload, to_tensor
+from common.metrics import CONTENT_TYPE, MetricsMiddleware, observe_batch, render as render_metrics, stage
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Sketch to Photo Converter")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start serving immediately; the model loads and warms up in a background boot thread."""
+    threading.Thread(target=boot, name="boot", daemon=True).start()
+    yield
+    generation_executor.shutdown(wait=False)
+
+app = FastAPI(title="Sketch to Photo Converter", lifespan=lifespan)
 
 # Add CORS middleware for frontend integration
 app.add_middleware(
@@ -27,106 +50,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-
-# Self-Attention Module
-class SelfAttention(nn.Module):
-    def __init__(self, in_channels):
-        super(SelfAttention, self).__init__()
-        self.query = nn.Conv2d(in_channels, in_channels // 8, 1)
-        self.key = nn.Conv2d(in_channels, in_channels // 8, 1)
-        self.value = nn.Conv2d(in_channels, in_channels, 1)
-        self.gamma = nn.Parameter(torch.zeros(1))
-
-    def forward(self, x):
-        batch, channels, height, width = x.size()
-        proj_query = self.query(x).view(batch, -1, height * width).permute(0, 2, 1)
-        proj_key = self.key(x).view(batch, -1, height * width)
-        energy = torch.bmm(proj_query, proj_key)
-        attention = torch.softmax(energy, dim=-1)
-        proj_value = self.value(x).view(batch, -1, height * width)
-        out = torch.bmm(proj_value, attention.permute(0, 2, 1))
-        out = out.view(batch, channels, height, width)
-        out = self.gamma * out + x
-        return out
-
-# Generator class (matches trained model)
-class Generator(nn.Module):
-    def __init__(self, in_channels, out_channels):
-        super(Generator, self).__init__()
-        self.enc1 = nn.Sequential(
-            nn.Conv2d(in_channels, 64, 4, stride=2, padding=1),
-            nn.LeakyReLU(0.2)
-        )  # 256x256 -> 128x128
-        self.enc2 = nn.Sequential(
-            nn.Conv2d(64, 128, 4, stride=2, padding=1),
-            nn.BatchNorm2d(128),
-            nn.LeakyReLU(0.2)
-        )  # 128x128 -> 64x64
-        self.enc3 = nn.Sequential(
-            nn.Conv2d(128, 256, 4, stride=2, padding=1),
-            nn.BatchNorm2d(256),
-            nn.LeakyReLU(0.2)
-        )  # 64x64 -> 32x32
-        self.enc4 = nn.Sequential(
-            nn.Conv2d(256, 512, 4, stride=2, padding=1),
-            nn.BatchNorm2d(512),
-            nn.LeakyReLU(0.2)
-        )  # 32x32 -> 16x16
-        self.enc5 = nn.Sequential(
-            nn.Conv2d(512, 512, 4, stride=2, padding=1),
-            nn.BatchNorm2d(512),
-            nn.LeakyReLU(0.2)
-        )  # 16x16 -> 8x8
-        self.attention = SelfAttention(512)
-        self.dec1 = nn.Sequential(
-            nn.ConvTranspose2d(512, 512, 4, stride=2, padding=1),
-            nn.BatchNorm2d(512),
-            nn.ReLU(),
-            nn.Dropout(0.3)
-        )  # 8x8 -> 16x16
-        self.dec2 = nn.Sequential(
-            nn.ConvTranspose2d(1024, 256, 4, stride=2, padding=1),
-            nn.BatchNorm2d(256),
-            nn.ReLU(),
-            nn.Dropout(0.3)
-        )  # 16x16 -> 32x32
-        self.dec3 = nn.Sequential(
-            nn.ConvTranspose2d(512, 128, 4, stride=2, padding=1),
-            nn.BatchNorm2d(128),
-            nn.ReLU(),
-            nn.Dropout(0.3)
-        )  # 32x32 -> 64x64
-        self.dec4 = nn.Sequential(
-            nn.ConvTranspose2d(256, 64, 4, stride=2, padding=1),
-            nn.BatchNorm2d(64),
-            nn.ReLU(),
-            nn.Dropout(0.3)
-        )  # 64x64 -> 128x128
-        self.dec5 = nn.Sequential(
-            nn.ConvTranspose2d(128, 64, 4, stride=2, padding=1),
-            nn.BatchNorm2d(64),
-            nn.ReLU(),
-            nn.Dropout(0.3)
-        )  # 128x128 -> 256x256
-        self.dec6 = nn.Sequential(
-            nn.Conv2d(64, out_channels, 3, stride=1, padding=1),
-            nn.Tanh()
-        )  # 256x256 -> 256x256
-
-    def forward(self, x):
-        e1 = self.enc1(x)
-        e2 = self.enc2(e1)
-        e3 = self.enc3(e2)
-        e4 = self.enc4(e3)
-        e5 = self.enc5(e4)
-        e5 = self.attention(e5)
-        d1 = self.dec1(e5)
-        d2 = self.dec2(torch.cat([d1, e4], dim=1))
-        d3 = self.dec3(torch.cat([d2, e3], dim=1))
-        d4 = self.dec4(torch.cat([d3, e2], dim=1))
-        d5 = self.dec5(torch.cat([d4, e1], dim=1))
-        d6 = self.dec6(d5)
-        return d6
+app.add_middleware(MetricsMiddleware)
 
 # Initialize the model globally
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -135,6 +59,17 @@ model = None
 model_path = os.path.join(os.path.dirname(__file__), 'models', 'G_sketch_to_photo_best.pth')
 logger.info("Model path: %s", model_path)
 
+# CPU inference engine (see inference.py): runtime, BN folding, int8 and thread pools
+GENERATOR_RUNTIME = os.getenv("GENERATOR_RUNTIME", "eager")
+GENERATOR_FUSE = os.getenv("GENERATOR_FUSE", "1") == "1"
+GENERATOR_INT8 = os.getenv("GENERATOR_INT8", "0") == "1"
+GENERATOR_INTRA_OP_THREADS = int(os.getenv("GENERATOR_INTRA_OP_THREADS", "0"))
+GENERATOR_INTER_OP_THREADS = int(os.getenv("GENERATOR_INTER_OP_THREADS", "0"))
+# Max absolute output difference allowed against eager (mean difference for int8)
+GENERATOR_PARITY_TOLERANCE = float(os.getenv("GENERATOR_PARITY_TOLERANCE", "1e-3"))
+GENERATOR_INT8_PARITY_TOLERANCE = float(os.getenv("GENERATOR_INT8_PARITY_TOLERANCE", "0.02"))
+engine = None
+
 def load_model():
     global model
     try:
@@ -150,88 +85,199 @@ def load_model():
         model.load_state_dict(state_dict)
         model.eval()
 
-        # Print state dictionary keys and shapes
-        logger.info("Loaded state dictionary keys:")
-        for key in state_dict.keys():
-            logger.info("  %s: %s", key, list(state_dict[key].shape))
-
-        # Print weight statistics for key layers
-        logger.info("Weight statistics for key layers:")
-        sample_keys = ['enc1.0.weight', 'attention.query.weight', 'dec6.0.weight']
-        for key in sample_keys:
-            if key in state_dict:
-                weights = state_dict[key]
-                logger.info("  %s: shape=%s, mean=%s, std=%s",
-                            key, list(weights.shape), weights.mean().item(), weights.std().item())
-
-        # Test inference with dummy input
-        logger.info("Testing model with dummy input...")
-        dummy_input = torch.randn(1, 1, 256, 256).to(device)
-        with torch.no_grad():
-            output = model(dummy_input)
-        logger.info("Dummy inference output shape: %s", list(output.shape))
-        if output.shape != (1, 3, 256, 256):
-            raise ValueError(f"Unexpected output shape: {output.shape}, expected (1, 3, 256, 256)")
-
-        logger.info("Model weights loaded and verified successfully from %s", model_path)
+        # State dictionary shapes and weight statistics are only computed when debugging
+        if logger.isEnabledFor(logging.DEBUG):
+            for key in state_dict.keys():
+                logger.debug("  %s: %s", key, list(state_dict[key].shape))
+            for key in ['enc1.0.weight', 'attention.query.weight', 'dec6.0.weight']:
+                if key in state_dict:
+                    weights = state_dict[key]
+                    logger.debug("  %s: shape=%s, mean=%s, std=%s",
+                                 key, list(weights.shape), weights.mean().item(), weights.std().item())
+
+        logger.info("Model weights loaded successfully from %s", model_path)
     except Exception as e:
         logger.error("Error loading model weights: %s", str(e))
         raise RuntimeError(f"Failed to load model weights from {model_path}")
+    load_engine()
+
+def load_engine():
+    """Build the configured inference engine, falling back to the eager model if it fails parity."""
+    global engine
+    if device.type != 'cpu':
+        engine = GeneratorEngine("eager", module=model)
+        return
+    try:
+        candidate, parity = build_checked_engine(model, GENERATOR_RUNTIME, fuse=GENERATOR_FUSE, int8=GENERATOR_INT8,
+                                                 intra_op_threads=GENERATOR_INTRA_OP_THREADS,
+                                                 inter_op_threads=GENERATOR_INTER_OP_THREADS,
+                                                 tolerance=GENERATOR_PARITY_TOLERANCE,
+                                                 int8_tolerance=GENERATOR_INT8_PARITY_TOLERANCE)
+        quantized = GENERATOR_INT8 and candidate.runtime == "onnxruntime"
+        engine = candidate
+        logger.info("Using %s generator engine (fused=%s, int8=%s), parity %s",
+                    candidate.runtime, GENERATOR_FUSE, quantized, parity)
+    except Exception as e:
+        logger.error("Could not build %s engine, using eager model: %s", GENERATOR_RUNTIME, str(e))
+        engine = GeneratorEngine("eager", module=model)
+
+# Generator input: one normalized 256x256 grayscale channel
+SKETCH_SIZE = (256, 256)
+SKETCH_SHAPE = (1, 256, 256)
+
+# Batch generation settings
+GENERATION_BATCH_SIZE = int(os.getenv("GENERATION_BATCH_SIZE", "8"))
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "1"))
+generation_executor = ThreadPoolExecutor(max_workers=GENERATION_WORKERS, thread_name_prefix="generator")
+# Most sketches accepted by /image/upload/batch, and how many of its batches are queued or running at once
+BATCH_MAX_IMAGES = int(os.getenv("BATCH_MAX_IMAGES", "64"))
+BATCH_MAX_IN_FLIGHT = max(1, int(os.getenv("BATCH_MAX_IN_FLIGHT", str(GENERATION_WORKERS + 1))))
+
+# Admission control (see common/admission.py): requests generating at once, requests queued behind them,
+# and the deadline in seconds after which a queued request is rejected instead of served
+ADMISSION_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", str(GENERATION_WORKERS)))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "16"))
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "60"))
+admission = AdmissionController("generator", ADMISSION_MAX_CONCURRENCY, ADMISSION_MAX_QUEUE, REQUEST_TIMEOUT)
+
+# Warm-up rounds (one single-sketch and one full batch each) run before reporting ready
+WARMUP_BATCHES = int(os.getenv("WARMUP_BATCHES", "2"))
+# Lifecycle state reported by the health endpoints
+service_state = {"model_loaded": False, "warmed_up": False, "error": None}
+
+IMAGE_FORMATS = {"png": (".png", "image/png"), "jpeg": (".jpg", "image/jpeg")}
+
+def preprocess_sketch(contents: bytes, out: torch.Tensor = None) -> torch.Tensor:
+    """Decode an uploaded sketch to a normalized (1, 256, 256) grayscale tensor, written into ``out`` if given.
+
+    Raises ``IngestError`` (a ValueError) for undecodable uploads and ``ImageTooLarge`` past the pixel limit.
+    """
+    with stage("decode"):
+        return to_tensor(decode_image(contents, "L", size=SKETCH_SIZE), out)
+
+def generate_photos(sketch_batch: torch.Tensor) -> np.ndarray:
+    """Run the generator on an (N, 1, 256, 256) batch and return (N, 256, 256, 3) uint8 RGB images."""
+    observe_batch("generator", len(sketch_batch))
+    with stage("generate"):
+        generated = engine(sketch_batch.to(device))
+    with stage("postprocess"):
+        generated = (generated * 0.5 + 0.5).clamp(0, 1)
+        return (generated.permute(0, 2, 3, 1).cpu().numpy() * 255).astype(np.uint8)
+
+def encode_image(image_rgb: np.ndarray, image_format: str = "png") -> bytes:
+    """Encode an RGB uint8 image as PNG or JPEG bytes."""
+    extension, _ = IMAGE_FORMATS[image_format]
+    with stage("encode"):
+        ok, buffer = cv2.imencode(extension, cv2.cvtColor(image_rgb, cv2.COLOR_RGB2BGR))
+    if not ok:
+        raise ValueError(f"Could not encode image as {image_format}")
+    return buffer.tobytes()
+
+def to_data_url(image_bytes: bytes, image_format: str = "png") -> str:
+    _, media_type = IMAGE_FORMATS[image_format]
+    with stage("base64"):
+        return f"data:{media_type};base64,{base64.b64encode(image_bytes).decode('utf-8')}"
+
+def generate_batch(sketch_batch: torch.Tensor, image_format: str) -> List[bytes]:
+    """Generate and encode one (N, 1, 256, 256) batch of preprocessed sketches (runs on the generation executor)."""
+    photos = generate_photos(sketch_batch)
+    return [encode_image(photo, image_format) for photo in photos]
+
+def convert_sketch(contents: bytes, image_format: str) -> bytes:
+    """Decode, generate and encode one upload (runs on the generation executor)."""
+    sketch_batch = batch_buffer(1, SKETCH_SHAPE)
+    preprocess_sketch(contents, out=sketch_batch[0])
+    return generate_batch(sketch_batch, image_format)[0]
+
+def warm_up(batches: int = WARMUP_BATCHES):
+    """Run representative batches through the engine, checking the output shape on the way."""
+    start = time.perf_counter()
+    for _ in range(batches):
+        for batch_size in (1, GENERATION_BATCH_SIZE):
+            output = engine(torch.randn(batch_size, 1, 256, 256).to(device))
+            if tuple(output.shape) != (batch_size, 3, 256, 256):
+                raise ValueError(f"Unexpected output shape: {tuple(output.shape)}, expected ({batch_size}, 3, 256, 256)")
+    logger.info("Warm-up finished in %.2fs", time.perf_counter() - start)
+
+def boot():
+    """Load the model and engine, then warm up; runs in a background thread at startup."""
+    try:
+        if engine is None:
+            load_model()
+        service_state["model_loaded"] = True
+        warm_up()
+        service_state["warmed_up"] = True
+        logger.info("Service ready")
+    except Exception as e:
+        logger.error("Boot failed: %s", str(e))
+        service_state["error"] = str(e)
+
+def is_ready() -> bool:
+    return service_state["model_loaded"] and service_state["warmed_up"]
 
-# Load model at startup
-load_model()
+def require_ready():
+    """Reject generation requests before boot has finished."""
+    if not is_ready():
+        raise HTTPException(status_code=503, detail="Service is starting", headers={"Retry-After": "5"})
 
-# Define transformation for input sketch
-transform = transforms.Compose([
-    transforms.Resize((256, 256)),
-    transforms.ToTensor(),
-    transforms.Normalize((0.5,), (0.5,))
-])
+@app.get("/health/live")
+async def liveness():
+    """The process is up and the event loop is responsive."""
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+async def readiness():
+    """200 once the model is loaded and warmed up; 503 before that or if loading failed."""
+    body = dict(service_state, ready=is_ready(), runtime=engine.runtime if engine else None)
+    return JSONResponse(status_code=200 if body["ready"] else 503, content=body)
 
 @app.post("/image/upload")
-async def upload_image(digitalImage: UploadFile = File(...)):
+async def upload_image(request: Request, digitalImage: UploadFile = File(...), raw: bool = False, format: str = "png"):
+    """Convert one sketch to a photo; returned as a data URL in JSON, or as image bytes with ``raw``.
+
+    Rejected with 429 when the generation queue is full and with 503 when the
+    request's deadline passes while queued, both with ``Retry-After``.
+    """
     try:
         # Validate file existence and type
         if not digitalImage:
             raise HTTPException(status_code=422, detail="No file provided")
         if not digitalImage.content_type.startswith('image/'):
             raise HTTPException(status_code=422, detail=f"Invalid file type: {digitalImage.content_type}. Only image files are allowed")
+        if format not in IMAGE_FORMATS:
+            raise HTTPException(status_code=422, detail=f"Unsupported format: {format}. Use png or jpeg")
+        require_ready()
 
-        # Read the uploaded image
-        contents = await digitalImage.read()
-        if not contents:
-            raise HTTPException(status_code=422, detail="Empty file uploaded")
-
-        # Decode image
-        nparr = np.frombuffer(contents, np.uint8)
-        sketch = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
-        if sketch is None:
-            raise HTTPException(status_code=422, detail="Could not decode image. Ensure it's a valid grayscale image")
-
-        # Preprocess the sketch
-        sketch_pil = Image.fromarray(sketch)
-        sketch_tensor = transform(sketch_pil).unsqueeze(0).to(device)
-
-        # Generate the photo
-        with torch.no_grad():
-            generated_photo = model(sketch_tensor)
+        async with admission.slot(request):
+            # Read the uploaded image
+            try:
+                with stage("read"):
+                    contents = await read_upload(digitalImage)
+            except ImageTooLarge as e:
+                raise HTTPException(status_code=413, detail=str(e))
+            if not contents:
+                raise HTTPException(status_code=422, detail="Empty file uploaded")
 
-        # Denormalize the generated image
-        generated_photo = generated_photo * 0.5 + 0.5
-        generated_photo_np = generated_photo.cpu().squeeze().permute(1, 2, 0).numpy()
-        generated_photo_uint8 = (generated_photo_np * 255).astype(np.uint8)
+            # Decode, generate and encode the photo off the event loop
+            loop = asyncio.get_running_loop()
+            try:
+                image_bytes = await loop.run_in_executor(generation_executor, convert_sketch, contents, format)
+            except ImageTooLarge as e:
+                raise HTTPException(status_code=413, detail=str(e))
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=str(e))
 
-        # Encode the image to base64
-        _, buffer = cv2.imencode('.png', cv2.cvtColor(generated_photo_uint8, cv2.COLOR_RGB2BGR))
-        image_base64 = base64.b64encode(buffer).decode('utf-8')
-        image_data_url = f"data:image/png;base64,{image_base64}"
-
-        logger.info("Successfully processed image: %s", digitalImage.filename)
+        logger.debug("Successfully processed image: %s", digitalImage.filename)
+        if raw:
+            return Response(content=image_bytes, media_type=IMAGE_FORMATS[format][1])
         return JSONResponse(content={
             "result": {
-                "generatedImage": image_data_url
+                "generatedImage": to_data_url(image_bytes, format)
             }
         })
+    except (Overloaded, ClientGone) as e:
+        logger.warning("Request not admitted: %s", e.detail)
+        raise e
     except HTTPException as e:
         logger.error("HTTP error: %s", str(e))
         raise e
@@ -241,22 +287,156 @@ async def upload_image(digitalImage: UploadFile = File(...)):
     finally:
         await digitalImage.close()
 
+def process_sketch_batch(contents_list: List[bytes], image_format: str,
+                         deadline: float = None) -> List[Tuple[bytes, str]]:
+    """Decode, generate and encode a batch of uploads; returns ``(image_bytes, error)`` per upload.
+
+    A batch that reaches the executor after the request's (monotonic) ``deadline`` is skipped.
+    """
+    if deadline is not None and time.monotonic() > deadline:
+        return [(None, "Request deadline passed before generation started")] * len(contents_list)
+    outputs = [(None, "Empty or non-image file")] * len(contents_list)
+    # Sketches are decoded straight into this thread's reusable batch tensor
+    sketch_batch = batch_buffer(len(contents_list), SKETCH_SHAPE)
+    positions = []
+    for position, contents in enumerate(contents_list):
+        if not contents:
+            continue
+        try:
+            preprocess_sketch(contents, out=sketch_batch[len(positions)])
+            positions.append(position)
+        except ValueError as e:
+            outputs[position] = (None, str(e))
+    if positions:
+        for position, image_bytes in zip(positions, generate_batch(sketch_batch[:len(positions)], image_format)):
+            outputs[position] = (image_bytes, None)
+    return outputs
+
+async def generate_stream(uploads: List[Tuple[str, bytes]], image_format: str, batch_size: int,
+                          deadline: float = None):
+    """Yield ``(index, filename, image_bytes, error)`` as each batch of sketches finishes.
+
+    At most ``BATCH_MAX_IN_FLIGHT`` batches are submitted at a time; the next
+    one is submitted as soon as one finishes.
+    """
+    loop = asyncio.get_running_loop()
+    indexed = list(enumerate(uploads))
+
+    async def run_batch(batch):
+        try:
+            contents = [contents for _, (_, contents) in batch]
+            return batch, await loop.run_in_executor(generation_executor, process_sketch_batch, contents,
+                                                     image_format, deadline)
+        except Exception as e:
+            logger.error("Batch generation failed: %s", str(e))
+            return batch, [(None, f"Photo generation failed: {str(e)}")] * len(batch)
+
+    batches = iter([indexed[start:start + batch_size] for start in range(0, len(indexed), batch_size)])
+    pending = {asyncio.ensure_future(run_batch(batch)) for batch in itertools.islice(batches, BATCH_MAX_IN_FLIGHT)}
+    try:
+        while pending:
+            finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                # Keep the executor busy while the client reads this batch
+                following = next(batches, None)
+                if following is not None:
+                    pending.add(asyncio.ensure_future(run_batch(following)))
+                batch, outputs = task.result()
+                for (index, (filename, _)), (image_bytes, error) in zip(batch, outputs):
+                    yield index, filename, image_bytes, error
+    finally:
+        # When the client disconnects mid-stream, batches still waiting for the executor are dropped
+        for task in pending:
+            task.cancel()
+
+@app.post("/image/upload/batch")
+async def upload_images_batch(request: Request, digitalImages: List[UploadFile] = File(...), format: str = "png",
+                              raw: bool = False, batch_size: int = GENERATION_BATCH_SIZE):
+    """Convert many sketches, streaming each result back as soon as its batch finishes.
+
+    By default the response is NDJSON with one ``{"index", "filename",
+    "generatedImage"}`` object (or ``"error"``) per sketch. With ``raw`` the
+    response is ``multipart/mixed`` with the encoded image bytes in each part.
+    The request holds one admission slot until the stream ends.
+    """
+    if format not in IMAGE_FORMATS:
+        raise HTTPException(status_code=422, detail=f"Unsupported format: {format}. Use png or jpeg")
+    if batch_size < 1:
+        raise HTTPException(status_code=422, detail="batch_size must be at least 1")
+    if len(digitalImages) > BATCH_MAX_IMAGES:
+        raise HTTPException(status_code=413, detail=f"Upload at most {BATCH_MAX_IMAGES} sketches per batch")
+    require_ready()
+
+    ticket = await admission.acquire(request)
+    uploads = []
+    try:
+        for upload in digitalImages:
+            if upload.content_type and upload.content_type.startswith('image/'):
+                try:
+                    uploads.append((upload.filename, await read_upload(upload)))
+                except ImageTooLarge as e:
+                    raise HTTPException(status_code=413, detail=f"{upload.filename}: {e}")
+            else:
+                uploads.append((upload.filename, b""))
+            await upload.close()
+    except BaseException:
+        ticket.release()
+        raise
+    logger.debug("Received batch of %d sketches", len(uploads))
+    # The stream releases the slot when it ends; the background task covers a stream that never started
+    release = BackgroundTask(ticket.release)
+
+    if not raw:
+        async def ndjson():
+            try:
+                async for index, filename, image_bytes, error in generate_stream(uploads, format, batch_size,
+                                                                                  ticket.deadline):
+                    item = {"index": index, "filename": filename}
+                    if error is None:
+                        item["generatedImage"] = to_data_url(image_bytes, format)
+                    else:
+                        item["error"] = error
+                    yield json.dumps(item) + "\n"
+            finally:
+                ticket.release()
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson", background=release)
+
+    boundary = uuid.uuid4().hex
+    async def multipart():
+        try:
+            async for index, filename, image_bytes, error in generate_stream(uploads, format, batch_size,
+                                                                              ticket.deadline):
+                if error is None:
+                    media_type, body = IMAGE_FORMATS[format][1], image_bytes
+                else:
+                    media_type, body = "application/json", json.dumps({"error": error}).encode("utf-8")
+                filename = (filename or "").replace('"', '')
+                headers = (f"--{boundary}\r\nContent-Type: {media_type}\r\n"
+                           f"Content-Disposition: inline; name=\"{index}\"; filename=\"{filename}\"\r\n"
+                           f"Content-Length: {len(body)}\r\n\r\n")
+                yield headers.encode("utf-8") + body + b"\r\n"
+            yield f"--{boundary}--\r\n".encode("utf-8")
+        finally:
+            ticket.release()
+    return StreamingResponse(multipart(), media_type=f"multipart/mixed; boundary={boundary}", background=release)
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics: request latency, per-stage histograms, batch sizes and in-flight requests."""
+    return Response(content=render_metrics(), media_type=CONTENT_TYPE)
+
 # Test block for running as a normal script
 if __name__ == "__main__":
     import uvicorn
     test_image_path = "test_sketch.jpg"
     try:
-        sketch = cv2.imread(test_image_path, cv2.IMREAD_GRAYSCALE)
-        if sketch is None:
+        load_model()
+        if not os.path.exists(test_image_path):
             logger.error("Could not load test image: %s", test_image_path)
         else:
-            sketch_pil = Image.fromarray(sketch)
-            sketch_tensor = transform(sketch_pil).unsqueeze(0).to(device)
-            with torch.no_grad():
-                generated_photo = model(sketch_tensor)
-            generated_photo = generated_photo * 0.5 + 0.5
-            generated_photo_np = generated_photo.cpu().squeeze().permute(1, 2, 0).numpy()
-            generated_photo_uint8 = (generated_photo_np * 255).astype(np.uint8)
+            with open(test_image_path, 'rb') as f:
+                sketch_tensor = preprocess_sketch(f.read()).unsqueeze(0)
+            generated_photo_uint8 = generate_photos(sketch_tensor)[0]
             output_path = "test_output.png"
             cv2.imwrite(output_path, cv2.cvtColor(generated_photo_uint8, cv2.COLOR_RGB2BGR))
             logger.info("Test image processed and saved as %s", output_path)
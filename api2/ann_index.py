@@ -0,0 +1,446 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from embedding_store import load_legacy_pickle, open_store
+from gallery import GalleryIndex
+import config
+
+try:
+    import faiss
+except ImportError:  # faiss-cpu is optional; the exact NumPy index is always available
+    faiss = None
+
+logger = logging.getLogger(__name__)
+
+INDEX_TYPES = ("exact", "flat", "ivf", "hnsw", "fp16", "sq8", "pq")
+# Index types that store lossy codes instead of float32 vectors, and can be re-ranked exactly
+COMPRESSED_TYPES = ("fp16", "sq8", "pq")
+# Index types whose search takes an ID selector (IndexPQ does not)
+SELECTOR_TYPES = ("flat", "ivf", "hnsw", "fp16", "sq8")
+
+
+def gallery_fingerprint(gallery: GalleryIndex) -> str:
+    """Hash of the gallery IDs and vectors, used to detect a stale persisted index."""
+    digest = hashlib.sha1()
+    digest.update("\n".join(gallery.ids).encode("utf-8"))
+    digest.update(np.ascontiguousarray(gallery.matrix).tobytes())
+    return digest.hexdigest()
+
+
+class FaissIndex:
+    """FAISS inner-product index over a snapshot of a GalleryIndex.
+
+    Vectors in the gallery are L2-normalized, so inner product equals cosine
+    similarity and scores are comparable with ``GalleryIndex.search``.
+
+    Compressed indexes (``fp16``, ``sq8``, ``pq``) keep only lossy codes in
+    memory. With :meth:`set_rerank` they fetch ``factor * k`` candidates and
+    re-score them against a full-precision matrix, normally the memory-mapped
+    embedding store, so only the candidate rows are read from it.
+
+    FAISS labels are positions in ``ids``. A freshly built index labels the
+    gallery rows; :meth:`updated` appends new entries and masks removed ones
+    (``None`` in ``ids``), so labels and gallery rows can then differ and are
+    mapped through ``row_labels`` / ``label_rows``.
+    """
+
+    # updated() gives up (the caller rebuilds) once this fraction of the labels are masked out
+    MAX_REMOVED_FRACTION = 0.25
+
+    def __init__(self, index, ids: List[Optional[str]], index_type: str, params: dict):
+        self.index = index
+        self.ids = list(ids)
+        self.index_type = index_type
+        self.params = params
+        self.rerank_matrix: Optional[np.ndarray] = None
+        self.rerank_factor = 0
+        self.set_search_params(**params)
+        self._map_rows(None)
+
+    def __len__(self) -> int:
+        return len(self._labels)
+
+    def _map_rows(self, gallery_ids: Optional[List[str]]):
+        """Map the rows of a gallery with ``gallery_ids`` to labels; None means the labels are the rows."""
+        self._labels = {image_id: label for label, image_id in enumerate(self.ids) if image_id is not None}
+        self.row_labels: Optional[np.ndarray] = None
+        self.label_rows: Optional[np.ndarray] = None
+        # Live labels and their packed bitmap, when some are masked out
+        self._live: Optional[np.ndarray] = None
+        self._live_bits: Optional[np.ndarray] = None
+        if gallery_ids is not None and gallery_ids != self.ids:
+            self.row_labels = np.fromiter((self._labels[image_id] for image_id in gallery_ids), dtype=np.int64,
+                                          count=len(gallery_ids))
+            self.label_rows = np.full(len(self.ids), -1, dtype=np.int64)
+            self.label_rows[self.row_labels] = np.arange(len(gallery_ids))
+        if len(self._labels) < len(self.ids):
+            self._live = np.fromiter((image_id is not None for image_id in self.ids), dtype=bool,
+                                     count=len(self.ids))
+            self._live_bits = np.packbits(self._live, bitorder="little")
+
+    @property
+    def supports_filter(self) -> bool:
+        """Whether :meth:`search_many` accepts ``rows``."""
+        return self.index_type in SELECTOR_TYPES
+
+    @classmethod
+    def build(cls, gallery: GalleryIndex, index_type: str = "flat", nlist: int = config.IVF_NLIST,
+              nprobe: int = config.IVF_NPROBE, hnsw_m: int = config.HNSW_M,
+              ef_construction: int = config.HNSW_EF_CONSTRUCTION,
+              ef_search: int = config.HNSW_EF_SEARCH, pq_m: int = config.PQ_M,
+              pq_nbits: int = config.PQ_NBITS) -> "FaissIndex":
+        """Build a FAISS index of the requested type from the gallery matrix."""
+        if faiss is None:
+            raise RuntimeError("faiss is not installed; install faiss-cpu or use the exact index")
+        vectors = np.ascontiguousarray(gallery.matrix, dtype=np.float32)
+        dim = gallery.dim
+        params = {}
+        if index_type == "flat":
+            index = faiss.IndexFlatIP(dim)
+        elif index_type == "ivf":
+            # k-means wants about 39 training points per list, and ~4 * sqrt(n) lists is plenty;
+            # more lists on a small gallery leave nprobe too few of the vectors to find the exact top-k
+            requested = nlist
+            nlist = max(1, min(nlist, int(4 * np.sqrt(len(vectors))), len(vectors) // 39))
+            if nlist != requested:
+                logger.info(f"Using nlist={nlist} instead of {requested} for {len(vectors)} vectors")
+            quantizer = faiss.IndexFlatIP(dim)
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+            if len(vectors):
+                index.train(vectors)
+            params = {"nlist": nlist, "nprobe": nprobe}
+        elif index_type == "hnsw":
+            index = faiss.IndexHNSWFlat(dim, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = ef_construction
+            params = {"m": hnsw_m, "ef_construction": ef_construction, "ef_search": ef_search}
+        elif index_type in ("fp16", "sq8"):
+            quantizer_type = faiss.ScalarQuantizer.QT_fp16 if index_type == "fp16" else faiss.ScalarQuantizer.QT_8bit
+            index = faiss.IndexScalarQuantizer(dim, quantizer_type, faiss.METRIC_INNER_PRODUCT)
+            if len(vectors):
+                index.train(vectors)
+        elif index_type == "pq":
+            if dim % pq_m:
+                raise ValueError(f"PQ needs the dimension ({dim}) to be a multiple of pq_m ({pq_m})")
+            # Each sub-quantizer needs at least one training point per centroid
+            pq_nbits = max(1, min(pq_nbits, int(np.log2(max(len(vectors), 2)))))
+            index = faiss.IndexPQ(dim, pq_m, pq_nbits, faiss.METRIC_INNER_PRODUCT)
+            if len(vectors):
+                index.train(vectors)
+            params = {"pq_m": pq_m, "pq_nbits": pq_nbits}
+        else:
+            raise ValueError(f"Unknown FAISS index type: {index_type}")
+        if len(vectors):
+            index.add(vectors)
+        return cls(index, gallery.ids, index_type, params)
+
+    def updated(self, gallery: GalleryIndex, changed_ids: List[str]) -> Optional["FaissIndex"]:
+        """A copy of this index for ``gallery`` after ``changed_ids`` were added, replaced or removed.
+
+        Old vectors of the changed IDs are masked out and their current ones
+        appended under new labels, with the trained quantizers (IVF, SQ, PQ)
+        reused as they are; searches on this index are unaffected. Returns
+        None when a rebuild is due instead: too many masked labels, or an
+        empty gallery.
+        """
+        ids = list(self.ids)
+        labels = dict(self._labels)
+        for image_id in set(changed_ids):
+            label = labels.pop(image_id, None)
+            if label is not None:
+                ids[label] = None
+        rows = gallery.rows_of(set(changed_ids))
+        if not len(gallery) or len(ids) - len(labels) > self.MAX_REMOVED_FRACTION * (len(ids) + len(rows)):
+            return None
+        index = faiss.clone_index(self.index)
+        if len(rows):
+            index.add(np.ascontiguousarray(gallery.matrix[rows], dtype=np.float32))
+            ids.extend(gallery.ids[row] for row in rows)
+        result = FaissIndex(index, ids, self.index_type, dict(self.params))
+        result._map_rows(gallery.ids)
+        if self.rerank_matrix is not None:
+            result.set_rerank(gallery.matrix, self.rerank_factor)
+        return result
+
+    def set_search_params(self, nprobe: Optional[int] = None, ef_search: Optional[int] = None, **_):
+        """Update query-time parameters (``nprobe`` for IVF, ``ef_search`` for HNSW)."""
+        if nprobe is not None and self.index_type == "ivf":
+            self.index.nprobe = nprobe
+            self.params["nprobe"] = nprobe
+        if ef_search is not None and self.index_type == "hnsw":
+            self.index.hnsw.efSearch = ef_search
+            self.params["ef_search"] = ef_search
+
+    def set_rerank(self, matrix: Optional[np.ndarray], factor: int = config.RERANK_FACTOR):
+        """Re-score ``factor * k`` candidates against ``matrix`` (the gallery rows); None or 0 disables."""
+        enabled = matrix is not None and factor > 0
+        self.rerank_matrix = matrix if enabled else None
+        self.rerank_factor = factor if enabled else 0
+        self.params["rerank_factor"] = self.rerank_factor
+
+    def memory_bytes(self) -> int:
+        """Size of the index as FAISS holds it in memory (codes, codebooks and any graph or lists)."""
+        return int(faiss.serialize_index(self.index).nbytes)
+
+    def _rerank(self, query: np.ndarray, labels: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        labels = labels[labels >= 0]
+        rows = labels if self.label_rows is None else self.label_rows[labels]
+        # Sorted rows read the memory map front to back
+        order = np.argsort(rows)
+        labels, rows = labels[order], rows[order]
+        exact = self.rerank_matrix[rows].astype(np.float32, copy=False) @ query
+        top = np.argsort(-exact, kind="stable")[:k]
+        return exact[top], labels[top]
+
+    def _filter_params(self, rows: np.ndarray):
+        """FAISS search parameters that only admit gallery ``rows``, keeping the index's own nprobe / efSearch."""
+        bitmap = np.zeros(len(self.ids), dtype=bool)
+        bitmap[rows if self.row_labels is None else self.row_labels[rows]] = True
+        return self._selector_params(np.packbits(bitmap, bitorder="little"))
+
+    def _selector_params(self, bits: np.ndarray):
+        """FAISS search parameters that only admit the labels set in the packed bitmap ``bits``."""
+        selector = faiss.IDSelectorBitmap(len(self.ids), faiss.swig_ptr(bits))
+        if self.index_type == "ivf":
+            params = faiss.SearchParametersIVF(sel=selector, nprobe=self.index.nprobe)
+        elif self.index_type == "hnsw":
+            params = faiss.SearchParametersHNSW(sel=selector, efSearch=self.index.hnsw.efSearch)
+        else:
+            params = faiss.SearchParameters(sel=selector)
+        # The selector only points at the bitmap, so keep it alive as long as the parameters
+        params.bits = bits
+        return params
+
+    def search_batch(self, queries: np.ndarray, k: int,
+                     rows: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Search normalized ``(n, dim)`` queries; returns ``(scores, labels)`` with -1 for missing labels.
+
+        With gallery ``rows``, only those rows can match; FAISS skips the others
+        while it searches, as it does masked-out labels.
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        if rows is not None:
+            if not self.supports_filter:
+                raise ValueError(f"A {self.index_type} index cannot filter by rows")
+            return self.index.search(queries, min(k, len(rows)), params=self._filter_params(rows))
+        if self._live is None:
+            return self.index.search(queries, min(k, len(self)))
+        if self.supports_filter:
+            return self.index.search(queries, min(k, len(self)), params=self._selector_params(self._live_bits))
+        # No selector: fetch past the masked labels, then move them behind the live ones and blank them
+        scores, labels = self.index.search(queries, min(k + len(self.ids) - len(self), len(self.ids)))
+        live = (labels >= 0) & self._live[np.maximum(labels, 0)]
+        order = np.argsort(~live, axis=1, kind="stable")[:, :min(k, len(self))]
+        labels = np.where(np.take_along_axis(live, order, 1), np.take_along_axis(labels, order, 1), -1)
+        return np.take_along_axis(scores, order, 1), labels
+
+    def search(self, embedding: np.ndarray, k: int = 5) -> List[Tuple[str, float]]:
+        """Return the ``k`` most similar IDs by cosine similarity, best first."""
+        return self.search_many(np.asarray(embedding, dtype=np.float32).reshape(1, -1), k)[0]
+
+    def search_many(self, embeddings: np.ndarray, k: int = 5, threshold: Optional[float] = None,
+                    rows: Optional[np.ndarray] = None) -> List[List[Tuple[str, float]]]:
+        """Top ``k`` per query row in one FAISS call; matches below ``threshold`` are dropped.
+
+        ``rows`` restricts the matches to those gallery rows, as in ``GalleryIndex.search_many``.
+        """
+        queries = np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+        norms = np.linalg.norm(queries, axis=1)
+        valid = np.isfinite(norms) & (norms > 0)
+        results = [[] for _ in range(len(queries))]
+        if not len(self) or k <= 0 or not valid.any() or (rows is not None and not len(rows)):
+            return results
+        queries = queries[valid] / norms[valid, None]
+        fetch = k * self.rerank_factor if self.rerank_matrix is not None else k
+        scores, found = self.search_batch(queries, fetch, rows)
+        if self.rerank_matrix is not None:
+            reranked = [self._rerank(query, labels, k) for query, labels in zip(queries, found)]
+            scores, found = [pair[0] for pair in reranked], [pair[1] for pair in reranked]
+        for position, row_scores, labels in zip(np.flatnonzero(valid), scores, found):
+            results[position] = [(self.ids[label], float(score)) for label, score in zip(labels, row_scores)
+                                 if label >= 0 and (threshold is None or score >= threshold)]
+        return results
+
+    def save(self, path: str, fingerprint: str):
+        """Write the index and its ID/parameter sidecar next to it, each atomically.
+
+        The sidecar records a hash of the index file, so a reader that sees one
+        process's index with another's sidecar treats the pair as out of date.
+        """
+        data = faiss.serialize_index(self.index)
+        meta = {"index_type": self.index_type, "params": self.params, "fingerprint": fingerprint,
+                "index_sha1": hashlib.sha1(data).hexdigest(), "ids": self.ids}
+        _replace(path, data.tofile)
+        _replace(f"{path}.json", lambda f: f.write(json.dumps(meta).encode("utf-8")))
+
+    @classmethod
+    def load(cls, path: str, index_type: str, fingerprint: str) -> Optional["FaissIndex"]:
+        """Load a persisted index, or return None if it is missing or out of date."""
+        if faiss is None or not (os.path.exists(path) and os.path.exists(f"{path}.json")):
+            return None
+        with open(f"{path}.json") as f:
+            meta = json.load(f)
+        if meta.get("index_type") != index_type or meta.get("fingerprint") != fingerprint:
+            return None
+        data = np.fromfile(path, dtype=np.uint8)
+        if hashlib.sha1(data).hexdigest() != meta.get("index_sha1"):
+            return None
+        return cls(faiss.deserialize_index(data), meta["ids"], index_type, meta.get("params", {}))
+
+
+def _replace(path: str, write):
+    """Write a file through ``write(f)`` under a per-process temporary name and rename it over ``path``."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load_or_build_index(gallery: GalleryIndex, index_type: str = config.INDEX_TYPE,
+                        path: str = config.INDEX_PATH):
+    """Return the configured search index for the gallery.
+
+    ``exact`` returns the gallery itself. FAISS indexes are reused from ``path``
+    when they match the gallery contents, otherwise rebuilt and persisted there.
+    Compressed indexes re-rank against the gallery matrix (the memory-mapped
+    store) when ``RERANK_FACTOR`` is set.
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {index_type!r}; expected one of {INDEX_TYPES}")
+    if index_type == "exact" or not len(gallery):
+        return gallery
+    if faiss is None:
+        logger.warning(f"faiss is not installed, falling back to exact search instead of {index_type}")
+        return gallery
+
+    fingerprint = gallery_fingerprint(gallery)
+    index = FaissIndex.load(path, index_type, fingerprint)
+    if index is not None:
+        # An index saved after updated() labels entries differently from the gallery rows
+        index._map_rows(gallery.ids)
+        index.set_search_params(nprobe=config.IVF_NPROBE, ef_search=config.HNSW_EF_SEARCH)
+        if index_type in COMPRESSED_TYPES:
+            index.set_rerank(gallery.matrix, config.RERANK_FACTOR)
+        logger.info(f"Loaded {index_type} index with {len(index)} vectors from {path}")
+        return index
+
+    start = time.perf_counter()
+    index = FaissIndex.build(gallery, index_type)
+    logger.info(f"Built {index_type} index with {len(index)} vectors in {time.perf_counter() - start:.2f}s")
+    save_index(index, gallery, path, fingerprint)
+    if index_type in COMPRESSED_TYPES:
+        index.set_rerank(gallery.matrix, config.RERANK_FACTOR)
+    return index
+
+
+def save_index(index: FaissIndex, gallery: GalleryIndex, path: str = config.INDEX_PATH,
+               fingerprint: Optional[str] = None):
+    """Persist ``index`` as the index of ``gallery``, so the next load_or_build_index() reuses it."""
+    try:
+        index.save(path, fingerprint or gallery_fingerprint(gallery))
+    except Exception as e:
+        logger.error(f"Error saving index to {path}: {e}")
+
+
+def recall_at_k(index, gallery: GalleryIndex, queries: np.ndarray, k: int = 10) -> dict:
+    """Compare an index against exact search over the same gallery.
+
+    Returns mean recall@k (fraction of the exact top-k that the index also
+    returns) together with the mean per-query latency of both searches.
+    """
+    queries = np.asarray(queries, dtype=np.float32)
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    k = min(k, len(gallery))
+
+    start = time.perf_counter()
+    exact = [set(image_id for image_id, _ in gallery.search(q, k)) for q in queries]
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    start = time.perf_counter()
+    approx = [set(image_id for image_id, _ in index.search(q, k)) for q in queries]
+    approx_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    recall = float(np.mean([len(e & a) / k for e, a in zip(exact, approx)]))
+    return {"k": k, "queries": len(queries), "gallery_size": len(gallery), "recall": recall,
+            "exact_ms_per_query": exact_ms, "index_ms_per_query": approx_ms}
+
+
+def memory_report(index: FaissIndex, gallery: GalleryIndex) -> dict:
+    """Index size against the float32 vectors it replaces."""
+    index_bytes = index.memory_bytes()
+    float32_bytes = len(gallery) * gallery.dim * 4
+    return {"index_mb": index_bytes / 2 ** 20, "float32_mb": float32_bytes / 2 ** 20,
+            "bytes_per_vector": index_bytes / max(len(gallery), 1),
+            "compression": float32_bytes / index_bytes if index_bytes else 0.0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a FAISS index for the gallery and report recall@k and "
+                                                 "memory against exact search.")
+    parser.add_argument("--embeddings", default=config.EMBEDDINGS_PATH,
+                        help="Embedding store, or a legacy embeddings pickle")
+    parser.add_argument("--type", dest="index_type", choices=INDEX_TYPES[1:], default="ivf")
+    parser.add_argument("--nlist", type=int, default=config.IVF_NLIST)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[config.IVF_NPROBE])
+    parser.add_argument("--hnsw-m", type=int, default=config.HNSW_M)
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[config.HNSW_EF_SEARCH])
+    parser.add_argument("--pq-m", type=int, default=config.PQ_M)
+    parser.add_argument("--pq-nbits", type=int, default=config.PQ_NBITS)
+    parser.add_argument("--rerank", type=int, nargs="+", default=[0, config.RERANK_FACTOR],
+                        help="Re-ranking factors to try for compressed indexes (0 = no re-ranking)")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--noise", type=float, default=0.05,
+                        help="Gaussian noise added to sampled gallery vectors to form queries")
+    parser.add_argument("--synthetic", type=int, default=0,
+                        help="Use this many random unit vectors instead of the embeddings file")
+    parser.add_argument("--save", action="store_true", help="Persist the built index to API2_INDEX_PATH")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    if args.synthetic:
+        vectors = rng.standard_normal((args.synthetic, 512), dtype=np.float32)
+        gallery = GalleryIndex(dim=512, capacity=args.synthetic)
+        gallery.add_many((f"S{i:07d}", v) for i, v in enumerate(vectors))
+    elif args.embeddings.endswith((".pkl", ".pickle")):
+        gallery = GalleryIndex.from_dict(load_legacy_pickle(args.embeddings))
+    else:
+        ids, matrix, _ = open_store(args.embeddings)
+        gallery = GalleryIndex.from_matrix(ids, matrix)
+
+    sample = gallery.matrix[rng.integers(0, len(gallery), args.queries)]
+    queries = sample + rng.standard_normal(sample.shape, dtype=np.float32) * args.noise
+
+    start = time.perf_counter()
+    index = FaissIndex.build(gallery, args.index_type, nlist=args.nlist, hnsw_m=args.hnsw_m, pq_m=args.pq_m,
+                             pq_nbits=args.pq_nbits)
+    build_s = time.perf_counter() - start
+    memory = memory_report(index, gallery)
+
+    sweep = args.nprobe if args.index_type == "ivf" else args.ef_search
+    reranks = args.rerank if args.index_type in COMPRESSED_TYPES else [0]
+    for value in sweep:
+        for factor in reranks:
+            index.set_search_params(nprobe=value, ef_search=value)
+            index.set_rerank(gallery.matrix, factor)
+            report = recall_at_k(index, gallery, queries, args.k)
+            report.update({"index_type": args.index_type, "params": dict(index.params), "build_s": build_s}, **memory)
+            print(json.dumps(report))
+
+    if args.save:
+        index.save(config.INDEX_PATH, gallery_fingerprint(gallery))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -1,22 +1,67 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, Form, Request, UploadFile, HTTPException
+from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from facenet_pytorch import MTCNN, InceptionResnetV1
 from PIL import Image
 import numpy as np
-import pickle
 import os
-from typing import List, Tuple
+from typing import List, NamedTuple, Optional, Tuple
 from pathlib import Path
 import io
+import asyncio
+import base64
 import logging
 import torch
 import random
+import re
+import sys
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from starlette.concurrency import run_in_threadpool
+from gallery import GalleryIndex
+from ann_index import FaissIndex, load_or_build_index, save_index
+from attributes import AttributeIndex, Filter, FilterError, load_records
+from config import (EMBEDDINGS_PATH, DATASET_PATH, LEGACY_EMBEDDINGS_PATH, EMBEDDINGS_DTYPE, STORE_RELOAD_INTERVAL,
+                    STORE_LOCK_TIMEOUT, MANIFEST_PATH, MODEL_VERSION, RESNET_PRETRAINED, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS, WARMUP_BATCHES,
+                    QUERY_CACHE_SIZE, QUERY_CACHE_TTL, BATCH_SEARCH_MAX_IMAGES, SEARCH_MAX_K, SHARD_COUNT,
+                    SHARD_ADDRESSES, SHARD_STORE_TEMPLATE, SHARD_AUTHKEY, SKETCH_GENERATOR_WEIGHTS,
+                    SKETCH_GENERATOR_RUNTIME, SKETCH_GENERATOR_CACHE_DIR, CROP_STORE_PATH, DETECTOR_VERSION,
+                    ATTRIBUTES_PATH, QUERY_MAX_SIDE, ENROLL_MAX_SIDE, SEARCH_MAX_CONCURRENCY, SEARCH_MAX_QUEUE, INFERENCE_WORKERS,
+                    INFERENCE_MAX_QUEUE, REQUEST_TIMEOUT)
+from crop_store import CropStore, crop_to_uint8
+from embedding_store import StoreBusy, convert_pickle, open_store, store_lock, write_store
+from enrollment import (IMAGE_EXTENSIONS, detect_face_batch, detect_faces, detect_faces_with_boxes, embed_faces,
+                        enroll_images, list_gallery_images)
+from batcher import MicroBatcher
+from manifest import EnrollmentManifest
+from query_cache import QueryCache, content_key
+import sketch_pipeline
+from shards import (ShardError, ShardedGallery, parse_address, shard_of, shard_store_path, start_local_shards,
+                    write_shard_stores)
+
+# Upload ingest, admission control and instrumentation shared with the sketch-to-photo API live in common/
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.admission import AdmissionController
+from common.ingest import ImageTooLarge, batch_buffer, decode_image, read_upload
+from common.metrics import CONTENT_TYPE, Gauge, MetricsMiddleware, observe_batch, render as render_metrics, stage
 
 # Setup logging
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Criminal Faces Similarity API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start serving immediately; models and the gallery load in a background boot thread."""
+    embedding_batcher.start()
+    threading.Thread(target=boot, name="boot", daemon=True).start()
+    yield
+    store_watch_stop.set()
+    await embedding_batcher.stop()
+    inference_executor.shutdown(wait=False)
+    stop_shards()
+
+app = FastAPI(title="Criminal Faces Similarity API", lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -26,73 +71,395 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
 
-# Initialize face detection and embedding models
+# Face detection and embedding models, created by load_models() during boot
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-mtcnn = MTCNN(image_size=160, margin=0, min_face_size=10, device=device)
-resnet = InceptionResnetV1(pretrained='vggface2').eval().to(device)
+mtcnn = None
+resnet = None
+# Sketch-to-photo generator for /sketch/match/, loaded during boot when its weights exist
+sketch_engine = None
+
+# Lifecycle state reported by the health endpoints
+service_state = {"models_loaded": False, "gallery_loaded": False, "warmed_up": False, "sketch_pipeline": False,
+                 "error": None}
+
+class Snapshot(NamedTuple):
+    """What queries search: a gallery, the search and attribute indexes built over its rows, and a version.
+
+    A published snapshot is never edited. Writers build the next gallery (see
+    ``GalleryIndex.copy``) and its indexes and swap the whole snapshot in with
+    publish(), so a query that reads ``snapshot`` once sees rows that agree.
+    """
+    gallery: GalleryIndex
+    # The gallery itself, a FAISS index built from it, or the shard coordinator
+    search_index: object
+    attribute_index: AttributeIndex
+    # Bumped on every publish, so cached results from an older gallery are ignored
+    version: int
+
+# Normalized embedding matrix and the indexes over it, replaced as a whole by publish()
+snapshot = Snapshot(GalleryIndex(), None, AttributeIndex([], {}), 0)
+snapshot = snapshot._replace(search_index=snapshot.gallery)
+snapshot_lock = threading.Lock()
+# Coordinator for the shard processes when sharded search is enabled, and any local shard processes
+shard_gallery = None
+shard_processes = []
+# Details records by image ID, indexed over each snapshot's rows for filtered search
+attribute_records = {}
+attributes_mtime_ns = None
+# Modification time of the store this worker has mapped; watch_store() reloads it when it changes
+store_mtime_ns = None
+store_watch_stop = threading.Event()
+
+# Which dataset files are embedded, so re-indexing only touches changed files
+manifest = EnrollmentManifest(MODEL_VERSION)
+# Aligned face crops of the dataset, so re-embedding with a new model skips detection
+crop_store = CropStore(CROP_STORE_PATH, DETECTOR_VERSION)
+# Image IDs double as dataset file stems
+IMAGE_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+
+# Held for a whole re-index, and tracks its progress; enrollment is refused (409) meanwhile
+preprocess_lock = threading.Lock()
+# Serializes this worker's gallery writes and store reloads, so a reload never publishes over a newer write.
+# Other worker processes are kept out by store_lock() on the store file (see writing_store()).
+write_lock = threading.Lock()
+preprocess_status = {"running": False, "done": 0, "total": 0, "images_per_sec": 0.0, "started_at": None}
 
-# Path to embeddings file
-EMBEDDINGS_PATH = "embeddings.pkl"
-DATASET_PATH = "criminal_faces/"
+# Embeddings and top-k results of recent uploads, so resubmitted images skip detection and search
+query_cache = QueryCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
 
-# Store embeddings and IDs
-embeddings_dict = {}
+# Bounded model work: /find_similar/ feeds the micro-batcher, everything else runs on the inference pool
+search_admission = AdmissionController("find_similar", SEARCH_MAX_CONCURRENCY, SEARCH_MAX_QUEUE, REQUEST_TIMEOUT)
+inference_admission = AdmissionController("inference", INFERENCE_WORKERS, INFERENCE_MAX_QUEUE, REQUEST_TIMEOUT)
+inference_executor = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix="inference")
 
 def load_embeddings():
-    """Load precomputed embeddings from file."""
-    global embeddings_dict
+    """Memory-map the embedding store and load the enrollment manifest and crop store.
+
+    A legacy ``embeddings.pkl`` is converted to the store format the first time.
+    """
+    global manifest, crop_store, store_mtime_ns
+    manifest = EnrollmentManifest.load(MANIFEST_PATH, MODEL_VERSION)
+    gallery = GalleryIndex()
+    crop_store = CropStore.open(CROP_STORE_PATH, DETECTOR_VERSION)
+    if not os.path.exists(EMBEDDINGS_PATH) and os.path.exists(LEGACY_EMBEDDINGS_PATH):
+        try:
+            count = convert_pickle(LEGACY_EMBEDDINGS_PATH, EMBEDDINGS_PATH, dtype=EMBEDDINGS_DTYPE)
+            logger.info(f"Converted {count} embeddings from {LEGACY_EMBEDDINGS_PATH} to {EMBEDDINGS_PATH}")
+        except Exception as e:
+            logger.error(f"Error converting {LEGACY_EMBEDDINGS_PATH}: {e}")
     if os.path.exists(EMBEDDINGS_PATH):
         try:
-            with open(EMBEDDINGS_PATH, 'rb') as f:
-                embeddings_dict = pickle.load(f)
-            logger.info(f"Loaded {len(embeddings_dict)} embeddings from {EMBEDDINGS_PATH}")
+            store_mtime_ns = os.stat(EMBEDDINGS_PATH).st_mtime_ns
+            ids, matrix, meta = open_store(EMBEDDINGS_PATH)
+            gallery = GalleryIndex.from_matrix(ids, matrix)
+            if meta.get("model_version") not in (None, MODEL_VERSION):
+                logger.warning(f"{EMBEDDINGS_PATH} was built with {meta['model_version']}, expected {MODEL_VERSION}")
+            logger.info(f"Loaded {len(gallery)} embeddings from {EMBEDDINGS_PATH}")
         except Exception as e:
             logger.error(f"Error loading embeddings: {e}")
-            embeddings_dict = {}
+            gallery = GalleryIndex()
     else:
         logger.warning(f"No embeddings file found at {EMBEDDINGS_PATH}")
+    load_attributes()
+    publish(gallery)
+
+def load_attributes():
+    """Load the details records used by search filters, if the attributes file exists."""
+    global attribute_records, attributes_mtime_ns
+    if not os.path.exists(ATTRIBUTES_PATH):
+        return
+    try:
+        attributes_mtime_ns = os.stat(ATTRIBUTES_PATH).st_mtime_ns
+        attribute_records = load_records(ATTRIBUTES_PATH)
+        logger.info(f"Loaded {len(attribute_records)} attribute records from {ATTRIBUTES_PATH}")
+    except Exception as e:
+        logger.error(f"Error loading attributes from {ATTRIBUTES_PATH}: {e}")
+
+def watch_store():
+    """Every ``STORE_RELOAD_INTERVAL`` seconds, reload what other worker processes rewrote, until shutdown.
 
-def save_embeddings():
-    """Save embeddings to file."""
+    Runs in its own thread: requests keep searching the published snapshot
+    while the next one is loaded, and publish() swaps it in.
+    """
+    while not store_watch_stop.wait(STORE_RELOAD_INTERVAL):
+        try:
+            reload_changed()
+        except Exception as e:
+            logger.error(f"Error reloading embeddings: {e}")
+
+def store_changed() -> bool:
+    """Whether another worker rewrote the store since this one loaded it."""
+    return os.path.exists(EMBEDDINGS_PATH) and os.stat(EMBEDDINGS_PATH).st_mtime_ns != store_mtime_ns
+
+def reload_changed():
+    """Reload the attributes or the store if they changed on disk since they were loaded."""
+    # A write in progress publishes its own result; check again on the next tick
+    if not write_lock.acquire(blocking=False):
+        return
+    try:
+        if os.path.exists(ATTRIBUTES_PATH) and os.stat(ATTRIBUTES_PATH).st_mtime_ns != attributes_mtime_ns:
+            load_attributes()
+            republish_attributes()
+        if store_changed():
+            # Shared with other readers, but never in the middle of another worker's write
+            with store_lock(EMBEDDINGS_PATH, shared=True, timeout=0):
+                logger.info(f"{EMBEDDINGS_PATH} changed on disk, reloading")
+                load_embeddings()
+    except StoreBusy:
+        pass
+    finally:
+        write_lock.release()
+
+@contextmanager
+def writing_store():
+    """Hold the write lock of this worker and the store lock of all workers for one gallery write.
+
+    The store, manifest and crop store are reloaded first if another worker
+    rewrote them, so the write applies on top of that worker's changes instead
+    of overwriting them. Raises StoreBusy if another worker's write does not
+    finish within ``STORE_LOCK_TIMEOUT`` seconds.
+    """
+    with write_lock, store_lock(EMBEDDINGS_PATH, timeout=STORE_LOCK_TIMEOUT):
+        # Crop slots are allocated from this worker's copy of the crop index, so it must be current too
+        if store_changed() or crop_store.changed_on_disk():
+            logger.info(f"{EMBEDDINGS_PATH} was rewritten by another worker, reloading before writing")
+            load_embeddings()
+        yield
+
+def build_search_index(gallery: GalleryIndex):
+    """The configured search index for ``gallery``: a FAISS index, the shards, or the gallery itself."""
     try:
-        with open(EMBEDDINGS_PATH, 'wb') as f:
-            pickle.dump(embeddings_dict, f)
-        logger.info(f"Saved {len(embeddings_dict)} embeddings to {EMBEDDINGS_PATH}")
+        if SHARD_COUNT:
+            # Shards search their own stores exactly; until they are up, search the local gallery
+            return shard_gallery if shard_gallery is not None else gallery
+        return load_or_build_index(gallery)
+    except Exception as e:
+        logger.error(f"Error building search index, using exact search: {e}")
+        return gallery
+
+def update_search_index(search_index, gallery: GalleryIndex, changed_ids: List[str]):
+    """The search index for ``gallery`` after ``changed_ids`` changed, derived from the current ``search_index``.
+
+    A FAISS index is updated incrementally instead of rebuilt and retrained,
+    and saved, so other workers load it when they reload the store.
+    """
+    if isinstance(search_index, FaissIndex):
+        try:
+            with stage("index_update"):
+                updated = search_index.updated(gallery, changed_ids)
+            if updated is not None:
+                save_index(updated, gallery)
+                return updated
+        except Exception as e:
+            logger.error(f"Error updating search index, rebuilding it: {e}")
+    return build_search_index(gallery)
+
+def publish(gallery: GalleryIndex, search_index=None, changed_ids: Optional[List[str]] = None):
+    """Swap in ``gallery`` with its search index and attribute index as one snapshot.
+
+    Without ``search_index``, the current one is updated for ``changed_ids``,
+    or a new one is built when they are None.
+    """
+    global snapshot
+    if search_index is None and changed_ids is not None:
+        search_index = update_search_index(snapshot.search_index, gallery, changed_ids)
+    elif search_index is None:
+        search_index = build_search_index(gallery)
+    with stage("attribute_index"):
+        attribute_index = AttributeIndex(gallery.ids, attribute_records)
+    with snapshot_lock:
+        snapshot = Snapshot(gallery, search_index, attribute_index, snapshot.version + 1)
+
+def republish_attributes():
+    """Re-index changed attribute records over the current snapshot's rows."""
+    current = snapshot
+    publish(current.gallery, current.search_index)
+
+def save_embeddings(gallery: GalleryIndex, changed_ids: Optional[List[str]] = None) -> GalleryIndex:
+    """Atomically write the embedding store, the enrollment manifest and the crop index.
+
+    With sharded search, the shard stores holding ``changed_ids`` (all shards
+    when None) are rewritten too and only those shards reload. Returns the
+    gallery re-opened from the written store, or ``gallery`` if writing failed.
+    """
+    global store_mtime_ns
+    try:
+        write_store(EMBEDDINGS_PATH, gallery.ids, gallery.matrix, dtype=EMBEDDINGS_DTYPE,
+                    model_version=MODEL_VERSION)
+        manifest.save(MANIFEST_PATH)
+        crop_store.save()
+        if SHARD_COUNT:
+            shards = None if changed_ids is None else {shard_of(image_id, SHARD_COUNT) for image_id in changed_ids}
+            save_shards(gallery, shards)
+        # Re-map the new file so this worker shares the page cache again instead of a private copy
+        store_mtime_ns = os.stat(EMBEDDINGS_PATH).st_mtime_ns
+        ids, matrix, _ = open_store(EMBEDDINGS_PATH)
+        gallery = GalleryIndex.from_matrix(ids, matrix)
+        logger.info(f"Saved {len(gallery)} embeddings to {EMBEDDINGS_PATH}")
     except Exception as e:
         logger.error(f"Error saving embeddings: {e}")
+    return gallery
+
+def save_shards(gallery: GalleryIndex, shards: Optional[set] = None):
+    """Update the given shard stores (all when None) and have those shards serve them.
+
+    Local shards share this host's files, so they are rewritten here and the
+    shards told to reload. Shards at ``SHARD_ADDRESSES`` keep their own store
+    files, so they are sent their rows instead.
+    """
+    if shards is not None and not shards:
+        return
+    if SHARD_ADDRESSES:
+        if shard_gallery is None:
+            return
+        written = shard_gallery.push(gallery.ids, gallery.matrix, shards, model_version=MODEL_VERSION)
+    else:
+        written = write_shard_stores(gallery.ids, gallery.matrix, SHARD_COUNT, SHARD_STORE_TEMPLATE, shards=shards,
+                                     dtype=EMBEDDINGS_DTYPE, model_version=MODEL_VERSION)
+        if shard_gallery is not None:
+            shard_gallery.reload(written)
+    logger.info(f"Updated shard stores {written}")
 
-def preprocess_images():
-    """Preprocess all images in the dataset and store embeddings."""
-    global embeddings_dict
+def start_shards():
+    """Write missing or outdated shard stores, start local shard processes if needed and connect to them.
+
+    Shards at ``SHARD_ADDRESSES`` are sent the current gallery once connected,
+    since their store files may predate it.
+    """
+    global shard_gallery, shard_processes
+    if SHARD_ADDRESSES:
+        if not SHARD_AUTHKEY:
+            raise ShardError("API2_SHARD_ADDRESSES needs API2_SHARD_AUTHKEY, the key the shards were started with")
+        authkey = SHARD_AUTHKEY.encode()
+        addresses = [parse_address(address) for address in SHARD_ADDRESSES]
+    else:
+        paths = [shard_store_path(shard, SHARD_COUNT, SHARD_STORE_TEMPLATE) for shard in range(SHARD_COUNT)]
+        store_mtime = os.stat(EMBEDDINGS_PATH).st_mtime_ns if os.path.exists(EMBEDDINGS_PATH) else 0
+        if any(not os.path.exists(path) or os.stat(path).st_mtime_ns < store_mtime for path in paths):
+            with store_lock(EMBEDDINGS_PATH, timeout=STORE_LOCK_TIMEOUT):
+                save_shards(snapshot.gallery)
+        # Only this process and its children need the key of local shards
+        authkey = SHARD_AUTHKEY.encode() or os.urandom(32)
+        addresses, shard_processes = start_local_shards(SHARD_COUNT, authkey, template=SHARD_STORE_TEMPLATE)
+    shard_gallery = ShardedGallery(addresses, authkey)
+    if SHARD_ADDRESSES:
+        save_shards(snapshot.gallery)
+    sizes = [info["size"] for info in shard_gallery.info()]
+    logger.info(f"Connected to {SHARD_COUNT} gallery shards with sizes {sizes}")
+    publish(snapshot.gallery)
+
+def stop_shards():
+    if shard_gallery is not None:
+        shard_gallery.close()
+    for process in shard_processes:
+        process.terminate()
+
+def preprocess_images(full: bool = False):
+    """Embed new or changed dataset images and drop embeddings of deleted ones.
+
+    With ``full=True`` the manifest is ignored and every image is re-embedded;
+    images whose file did not change reuse their stored face crop, so after a
+    model change only the embedding pass runs.
+    """
     if not os.path.exists(DATASET_PATH):
         logger.error(f"Dataset path {DATASET_PATH} does not exist")
         return
+    if not preprocess_lock.acquire(blocking=False):
+        raise RuntimeError("Preprocessing is already running")
 
-    embeddings_dict.clear()
-    for filename in os.listdir(DATASET_PATH):
-        if filename.lower().endswith(('.jpg', '.jpeg', '.png')):
-            image_id = Path(filename).stem
-            image_path = os.path.join(DATASET_PATH, filename)
-            try:
-                embedding = get_image_embedding(image_path)
-                if embedding is not None:
-                    embeddings_dict[image_id] = embedding
-                    logger.info(f"Processed {image_id}")
+    try:
+        with writing_store():
+            image_paths = list_gallery_images(DATASET_PATH)
+            current = snapshot.gallery
+            # Build into a fresh gallery or a copy, so searches keep using the published one until the swap
+            if full:
+                manifest.clear()
+                target = GalleryIndex(dim=current.dim, capacity=len(image_paths))
+            else:
+                target = current.copy()
+            to_embed, to_remove = manifest.diff(image_paths, target.ids)
+            logger.info(f"Re-indexing: {len(to_embed)} to embed, {len(to_remove)} to remove, "
+                        f"{len(image_paths) - len(to_embed)} unchanged")
+            preprocess_status.update(running=True, done=0, total=len(to_embed), started_at=time.time())
+
+            def report_progress(done: int, total: int):
+                elapsed = time.time() - preprocess_status["started_at"]
+                preprocess_status.update(done=done, images_per_sec=done / elapsed if elapsed else 0.0)
+
+            for image_id in to_remove:
+                target.remove(image_id)
+                logger.info(f"Removed {image_id}")
+            pruned = crop_store.prune(image_paths)
+            for image_id, embedding in enroll_images(to_embed, mtcnn, resnet, device, progress=report_progress,
+                                                     crop_store=crop_store):
+                embedded = embedding is not None and target.add(image_id, embedding)
+                if embedded:
+                    logger.debug(f"Processed {image_id}")
                 else:
+                    target.remove(image_id)
                     logger.warning(f"No face detected in {image_id}")
-            except Exception as e:
-                logger.error(f"Error processing {image_id}: {e}")
+                manifest.record(image_id, to_embed[image_id], embedded)
+
+            if full or to_embed or to_remove or pruned:
+                changed_ids = None if full else list(to_embed) + list(to_remove)
+                publish(save_embeddings(target, changed_ids), changed_ids=changed_ids)
+    finally:
+        preprocess_status["running"] = False
+        preprocess_lock.release()
+
+def _dataset_files(image_id: str) -> List[str]:
+    """Paths of dataset files whose stem is ``image_id``."""
+    return [os.path.join(DATASET_PATH, image_id + ext) for ext in IMAGE_EXTENSIONS
+            if os.path.exists(os.path.join(DATASET_PATH, image_id + ext))]
 
-    save_embeddings()
+def enroll_identity(image_id: str, image_bytes: bytes, extension: str) -> bool:
+    """Store one identity's image in the dataset and add its embedding. Returns False if no face was found."""
+    # Decoded like dataset images, so the stored crop matches DETECTOR_VERSION
+    img = decode_uploads([image_bytes], ENROLL_MAX_SIDE)[0]
+    detections = detect_faces_with_boxes(mtcnn, [img])[0] if img is not None else None
+    if not detections:
+        return False
+    face, box, probability = detections[0]
+    embedding = embed_faces(resnet, [face], device)[0]
+    with writing_store():
+        for old_path in _dataset_files(image_id):
+            os.remove(old_path)
+        image_path = os.path.join(DATASET_PATH, image_id + extension)
+        with open(image_path, 'wb') as f:
+            f.write(image_bytes)
+        target = snapshot.gallery.copy()
+        target.add(image_id, embedding)
+        manifest.record(image_id, image_path, True)
+        crop_store.put(image_id, crop_to_uint8(face, mtcnn.post_process), box, probability, image_path)
+        publish(save_embeddings(target, [image_id]), changed_ids=[image_id])
+    logger.info(f"Enrolled {image_id}")
+    return True
+
+def remove_identity(image_id: str) -> bool:
+    """Remove one identity's embedding and dataset image. Returns False if it was not enrolled."""
+    with writing_store():
+        files = _dataset_files(image_id)
+        target = snapshot.gallery.copy()
+        removed = target.remove(image_id)
+        if not removed and not files:
+            return False
+        for path in files:
+            os.remove(path)
+        manifest.discard(image_id)
+        crop_store.discard(image_id)
+        publish(save_embeddings(target, [image_id]), changed_ids=[image_id])
+    logger.info(f"Removed {image_id}")
+    return True
 
 def get_image_embedding(image_path: str = None, image_bytes: bytes = None) -> np.ndarray:
     """Generate embedding for an image from path or bytes."""
     try:
         if image_path:
-            img = Image.open(image_path).convert('RGB')
-        else:
-            img = Image.open(io.BytesIO(image_bytes)).convert('RGB')
+            with open(image_path, 'rb') as f:
+                image_bytes = f.read()
+        img = decode_image(image_bytes, 'RGB', max_side=QUERY_MAX_SIDE)
 
         # Detect face and align
         faces, _ = mtcnn(img, return_prob=True)
@@ -107,62 +474,525 @@ def get_image_embedding(image_path: str = None, image_bytes: bytes = None) -> np
         logger.error(f"Error generating embedding: {e}")
         return None
 
-def compute_similarity(embedding: np.ndarray) -> List[Tuple[str, float]]:
-    """Compute cosine similarity between input embedding and stored embeddings."""
-    similarities = []
-    for image_id, stored_embedding in embeddings_dict.items():
-        cosine_sim = np.dot(embedding, stored_embedding) / (np.linalg.norm(embedding) * np.linalg.norm(stored_embedding))
-        similarities.append((image_id, float(cosine_sim)))
-    
-    # Sort by similarity (descending) and take top 5
-    similarities.sort(key=lambda x: x[1], reverse=True)
-    return similarities[:5]
-
-def get_fallback_images() -> List[Tuple[str, float]]:
-    """Return 5 random image IDs from embeddings_dict as a fallback."""
-    if not embeddings_dict:
+def embed_image_batch(images: List[bytes]) -> List[Optional[np.ndarray]]:
+    """Embed a batch of uploaded images with one MTCNN pass per image size and one resnet pass."""
+    observe_batch("find_similar", len(images))
+    decoded = decode_uploads(images)
+    valid = [i for i, img in enumerate(decoded) if img is not None]
+    faces = [None] * len(images)
+    with stage("detect"):
+        for i, face in zip(valid, detect_faces(mtcnn, [decoded[i] for i in valid])):
+            faces[i] = face
+
+    detected = [i for i, face in enumerate(faces) if face is not None]
+    embeddings = [None] * len(images)
+    if detected:
+        with stage("embed"):
+            for i, embedding in zip(detected, embed_faces(resnet, [faces[i] for i in detected], device)):
+                embeddings[i] = embedding
+    return embeddings
+
+# Groups concurrent /find_similar/ uploads into one detection and embedding batch
+embedding_batcher = MicroBatcher(embed_image_batch, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS, "find_similar")
+
+# Scrape-time gauges; reading them costs nothing on the request path
+Gauge("facetrace_gallery_size", "Embeddings in the searchable gallery.").set_function(lambda: len(snapshot.gallery))
+Gauge("facetrace_batch_queue_depth", "Uploads waiting for the /find_similar/ batcher.").set_function(
+    lambda: embedding_batcher.queue_depth)
+
+def compute_similarity(embedding: np.ndarray, k: int = 5, query_filter: Optional[Filter] = None,
+                       snap: Optional[Snapshot] = None) -> List[Tuple[str, float]]:
+    """Return the top-k stored embeddings by cosine similarity to the input embedding."""
+    snap = snap or snapshot
+    with stage("search"):
+        if query_filter is None:
+            return snap.search_index.search(embedding, k)
+        return search_filtered(np.asarray(embedding, dtype=np.float32).reshape(1, -1), k, None, query_filter,
+                               snap)[0]
+
+def search_filtered(embeddings: np.ndarray, k: int, threshold: Optional[float], query_filter: Filter,
+                    snap: Optional[Snapshot] = None) -> List[List[Tuple[str, float]]]:
+    """Top-k per query among the gallery entries whose attributes match ``query_filter``.
+
+    The filter is resolved to gallery rows through the attribute index and
+    applied inside the top-k selection. A selective filter is searched exactly
+    over just its rows; a broad one goes to the FAISS index with the rows as an
+    ID selector, falling back to exact search if the index finds fewer than k.
+    """
+    # One snapshot throughout: its attribute rows are rows of exactly this gallery and index
+    snap = snap or snapshot
+    with stage("filter"):
+        rows = snap.attribute_index.select(query_filter)
+    if not len(rows):
+        return [[] for _ in range(len(embeddings))]
+    if isinstance(snap.search_index, ShardedGallery):
+        # Each shard gets the allowed IDs it holds and searches only those
+        return snap.search_index.search_many(embeddings, k, threshold, ids=snap.attribute_index.ids_of(rows))
+    results = None
+    if isinstance(snap.search_index, FaissIndex) and snap.search_index.supports_filter and \
+            len(rows) > GalleryIndex.PREFILTER_SELECTIVITY * len(snap.gallery):
+        results = snap.search_index.search_many(embeddings, k, threshold, rows=rows)
+        if threshold is None and any(len(matches) < min(k, len(rows)) for matches in results):
+            results = None
+    if results is None:
+        results = snap.gallery.search_many(embeddings, k, threshold, rows=rows)
+    return results
+
+def decode_uploads(images: List[bytes], max_side: int = QUERY_MAX_SIDE) -> List[Optional[Image.Image]]:
+    """Decode uploads to RGB at most ``max_side`` pixels across, with None for any that cannot be decoded."""
+    decoded = []
+    with stage("decode"):
+        for image_bytes in images:
+            try:
+                decoded.append(decode_image(image_bytes, 'RGB', max_side=max_side))
+            except Exception as e:
+                logger.error(f"Error decoding uploaded image: {e}")
+                decoded.append(None)
+    return decoded
+
+def search_image_batch(images: List[bytes], keep_all: bool = False, k: int = 5,
+                       threshold: Optional[float] = None, fuse: Optional[str] = None,
+                       query_filter: Optional[Filter] = None) -> dict:
+    """Detect faces in every upload, embed all crops together and score them against the gallery at once.
+
+    Without ``fuse`` each face gets its own top-k from the search index. With
+    ``fuse`` ("max" or "mean") all faces are treated as views of one suspect and
+    a single ranking is returned; fusion needs every gallery score, so it always
+    uses the exact gallery.
+    """
+    snap = snapshot
+    decoded = decode_uploads(images)
+    valid = [i for i, img in enumerate(decoded) if img is not None]
+    detections = [[] for _ in images]
+    errors = {i: "Could not decode image" for i, img in enumerate(decoded) if img is None}
+    with stage("detect"):
+        for i, faces in zip(valid, detect_faces_with_boxes(mtcnn, [decoded[i] for i in valid], keep_all)):
+            if faces is None:
+                errors[i] = "Face detection failed"
+            else:
+                detections[i] = faces
+
+    crops = [face for faces in detections for face, _, _ in faces]
+    observe_batch("batch_search", len(crops))
+    embeddings = np.empty((0, snap.gallery.dim), dtype=np.float32)
+    if crops:
+        with stage("embed"):
+            embeddings = np.concatenate([embed_faces(resnet, crops[start:start + BATCH_MAX_SIZE], device)
+                                         for start in range(0, len(crops), BATCH_MAX_SIZE)])
+
+    with stage("search"):
+        if fuse and query_filter is not None:
+            with stage("filter"):
+                rows = snap.attribute_index.select(query_filter)
+            if not len(rows):
+                fused = []
+            elif isinstance(snap.search_index, ShardedGallery):
+                fused = snap.search_index.search_fused(embeddings, k, threshold, fuse,
+                                                       ids=snap.attribute_index.ids_of(rows))
+            else:
+                fused = snap.gallery.search_fused(embeddings, k, threshold, fuse, rows=rows)
+            matches = iter([None] * len(crops))
+        elif fuse:
+            # Shards fuse exactly as well; a FAISS index cannot, so fall back to the exact gallery
+            fusion_index = snap.search_index if hasattr(snap.search_index, "search_fused") else snap.gallery
+            fused = fusion_index.search_fused(embeddings, k, threshold, fuse)
+            matches = iter([None] * len(crops))
+        elif query_filter is not None:
+            matches = iter(search_filtered(embeddings, k, threshold, query_filter, snap))
+        else:
+            matches = iter(snap.search_index.search_many(embeddings, k, threshold))
+
+    queries = []
+    for i, faces in enumerate(detections):
+        query = {"index": i, "faces": []}
+        if i in errors:
+            query["error"] = errors[i]
+        for _, box, probability in faces:
+            face = {"box": [round(v, 1) for v in box], "probability": round(probability, 4)}
+            face_matches = next(matches)
+            if face_matches is not None:
+                face["matches"] = [[image_id, f"{score:.4f}"] for image_id, score in face_matches]
+            query["faces"].append(face)
+        queries.append(query)
+    response = {"k": k, "threshold": threshold, "keep_all": keep_all, "fuse": fuse,
+                "faces": len(crops), "queries": queries}
+    if fuse:
+        response["matches"] = [[image_id, f"{score:.4f}"] for image_id, score in fused]
+    return response
+
+def match_sketch(contents: bytes, k: int = 5, return_image: bool = False, image_format: str = "png",
+                 query_filter: Optional[Filter] = None) -> dict:
+    """Generate a photo from a sketch and search the gallery with it, all in memory.
+
+    The generator output goes straight to MTCNN as a uint8 tensor and the
+    aligned crop to InceptionResnetV1; the photo is only encoded when
+    ``return_image`` is set.
+    """
+    sketch_batch = batch_buffer(1, (1, sketch_pipeline.SKETCH_SIZE, sketch_pipeline.SKETCH_SIZE))
+    with stage("decode"):
+        sketch_pipeline.preprocess_sketch(contents, out=sketch_batch[0])
+    observe_batch("generator", 1)
+    with stage("generate"):
+        photos = sketch_pipeline.generate_photos(sketch_engine, sketch_batch.to(device))
+    with stage("detect"):
+        faces = detect_face_batch(mtcnn, photos)[0]
+
+    response = {"face": None, "fallback": not faces}
+    if faces:
+        crop, box, probability = faces[0]
+        with stage("embed"):
+            embedding = embed_faces(resnet, [crop], device)[0]
+        results = compute_similarity(embedding, k, query_filter)
+        response["face"] = {"box": [round(v, 1) for v in box], "probability": round(probability, 4)}
+    else:
+        logger.warning("No face detected in generated photo, returning fallback images")
+        results = get_fallback_images(query_filter)
+    response["matches"] = [[image_id, f"{score:.4f}"] for image_id, score in results]
+    if return_image:
+        with stage("encode"):
+            image_bytes = sketch_pipeline.encode_photo(photos[0], image_format)
+        with stage("base64"):
+            media_type = sketch_pipeline.IMAGE_FORMATS[image_format][1]
+            response["generatedImage"] = f"data:{media_type};base64,{base64.b64encode(image_bytes).decode('utf-8')}"
+    return response
+
+def get_fallback_images(query_filter: Optional[Filter] = None,
+                        snap: Optional[Snapshot] = None) -> List[Tuple[str, float]]:
+    """Return 5 random image IDs from the gallery (matching ``query_filter``, if given) as a fallback."""
+    snap = snap or snapshot
+    if not len(snap.gallery):
         logger.warning("No embeddings available for fallback")
         return []
-    image_ids = list(embeddings_dict.keys())
+    if query_filter is None:
+        image_ids = list(snap.gallery.ids)
+    else:
+        index = snap.attribute_index
+        image_ids = index.ids_of(index.select(query_filter))
     random.shuffle(image_ids)
     # Return top 5 IDs with a default similarity of 0.0
     return [(image_id, 0.0) for image_id in image_ids[:5]]
 
-@app.on_event("startup")
-async def startup_event():
-    """Load embeddings or preprocess images on startup."""
-    load_embeddings()
-    if not embeddings_dict:
+def load_models():
+    """Create MTCNN and InceptionResnetV1; facenet_pytorch is imported here to keep module import cheap."""
+    global mtcnn, resnet
+    from facenet_pytorch import MTCNN, InceptionResnetV1
+    mtcnn = MTCNN(image_size=160, margin=0, min_face_size=10, device=device)
+    resnet = InceptionResnetV1(pretrained=RESNET_PRETRAINED or None).eval().to(device)
+    # Embeddings cached from previously loaded weights must not be reused
+    query_cache.clear()
+
+def load_sketch_generator():
+    """Load the generator for /sketch/match/ if its weights are available; the rest of the API works without it."""
+    global sketch_engine
+    if not os.path.exists(SKETCH_GENERATOR_WEIGHTS):
+        logger.warning(f"Sketch generator weights not found at {SKETCH_GENERATOR_WEIGHTS}, /sketch/match/ is disabled")
+        return
+    sketch_engine = sketch_pipeline.load_generator(SKETCH_GENERATOR_WEIGHTS, SKETCH_GENERATOR_RUNTIME, device,
+                                                   SKETCH_GENERATOR_CACHE_DIR)
+    service_state["sketch_pipeline"] = True
+    logger.info(f"Loaded sketch generator ({sketch_engine.runtime}) from {SKETCH_GENERATOR_WEIGHTS}")
+
+def warm_up(batches: int = WARMUP_BATCHES):
+    """Run a few single and full-size batches so the first real request sees steady-state latency."""
+    if batches <= 0:
+        return
+    samples = []
+    if os.path.exists(DATASET_PATH):
+        for image_path in list(list_gallery_images(DATASET_PATH).values())[:BATCH_MAX_SIZE]:
+            with open(image_path, 'rb') as f:
+                samples.append(f.read())
+    if not samples:
+        buffer = io.BytesIO()
+        Image.new('RGB', (160, 160), (128, 128, 128)).save(buffer, format='JPEG')
+        samples = [buffer.getvalue()]
+    start = time.perf_counter()
+    for _ in range(batches):
+        for batch in (samples[:1], samples):
+            embed_image_batch(batch)
+        # Detection may find no face in a synthetic sample, so exercise the embedding net directly
+        embed_faces(resnet, [torch.zeros(3, 160, 160)] * len(samples), device)
+        snap = snapshot
+        snap.search_index.search(np.ones(snap.gallery.dim, dtype=np.float32), 5)
+        if sketch_engine is not None:
+            sketch_pipeline.generate_photos(sketch_engine, torch.zeros(1, 1, 256, 256, device=device))
+    logger.info(f"Warm-up finished in {time.perf_counter() - start:.2f}s")
+
+def boot():
+    """Load models and the gallery, warm up, then enroll the dataset if no embeddings exist.
+
+    Runs in a background thread so the server answers health checks while it works;
+    readiness is reported through ``service_state``.
+    """
+    try:
+        load_models()
+        load_sketch_generator()
+        service_state["models_loaded"] = True
+        load_embeddings()
+        if SHARD_COUNT:
+            start_shards()
+        service_state["gallery_loaded"] = True
+        warm_up()
+        service_state["warmed_up"] = True
+        threading.Thread(target=watch_store, name="store-watcher", daemon=True).start()
+        logger.info("Service ready")
+    except Exception as e:
+        logger.error(f"Boot failed: {e}")
+        service_state["error"] = str(e)
+        return
+    if not len(snapshot.gallery):
         logger.info("No embeddings found, preprocessing images...")
-        preprocess_images()
+        try:
+            preprocess_images()
+        except Exception as e:
+            logger.error(f"Error during preprocessing: {e}")
+
+def parse_filters(filters: Optional[str]) -> Optional[Filter]:
+    try:
+        return Filter.parse(filters)
+    except FilterError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def read_image(file: UploadFile) -> bytes:
+    """Read an upload, rejecting it with 413 once it passes the ingest byte limit."""
+    try:
+        with stage("read"):
+            return await read_upload(file)
+    except ImageTooLarge as e:
+        raise HTTPException(status_code=413, detail=f"{file.filename}: {e}")
+
+def is_ready() -> bool:
+    return service_state["models_loaded"] and service_state["gallery_loaded"] and service_state["warmed_up"]
+
+def store_busy() -> HTTPException:
+    """The 409 for a write that timed out waiting for another worker process's write to the store."""
+    return HTTPException(status_code=409, detail="Another worker is writing the gallery, try again later",
+                         headers={"Retry-After": str(max(1, round(STORE_LOCK_TIMEOUT)))})
+
+def require_ready():
+    """Reject requests that need the models before boot has finished."""
+    if not is_ready():
+        raise HTTPException(status_code=503, detail="Service is starting", headers={"Retry-After": "5"})
+
+async def run_inference(request: Request, function, *args):
+    """Run model work on the inference pool once admission control grants a slot (429/503 otherwise)."""
+    async with inference_admission.slot(request):
+        return await asyncio.get_running_loop().run_in_executor(inference_executor, function, *args)
+
+@app.exception_handler(ShardError)
+async def shard_unavailable(request: Request, exc: ShardError):
+    """A shard that cannot be reached or fails makes search unavailable for a while, like an overload."""
+    logger.error(f"Sharded search failed: {exc}")
+    return JSONResponse(status_code=503, content={"detail": f"Search is temporarily unavailable: {exc}"},
+                        headers={"Retry-After": "5"})
+
+@app.get("/health/live")
+async def liveness():
+    """The process is up and the event loop is responsive."""
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+async def readiness():
+    """200 once models are loaded, the gallery is loaded and warm-up has run; 503 before that."""
+    body = dict(service_state, ready=is_ready(), gallery_size=len(snapshot.gallery),
+                enrollment_running=preprocess_status["running"])
+    return JSONResponse(status_code=200 if body["ready"] else 503, content=body)
 
 @app.post("/find_similar/", response_model=List[List[str]])
-async def find_similar(file: UploadFile = File(...)):
-    """Upload an image and find the 5 most similar images."""
-    logger.info(f"Received file: {file.filename}, content_type: {file.content_type}, size: {file.size}")
+async def find_similar(request: Request, file: UploadFile = File(...), filters: Optional[str] = Form(None)):
+    """Upload an image and find the 5 most similar images.
+
+    ``filters`` is an optional JSON object of attribute conditions, e.g.
+    ``{"county": "COOK", "class": ["X", "1"]}``; only matching entries are ranked.
+    """
     if not file.content_type.startswith('image/'):
         raise HTTPException(status_code=400, detail="File must be an image")
+    query_filter = parse_filters(filters)
+    require_ready()
 
-    image_bytes = await file.read()
-    logger.debug(f"Image bytes length: {len(image_bytes)}")
-    embedding = get_image_embedding(image_bytes=image_bytes)
-    
-    if embedding is None:
-        logger.warning("No face detected in uploaded image, returning fallback images")
-        results = get_fallback_images()
-    else:
-        results = compute_similarity(embedding)
+    image_bytes = await read_image(file)
+    snap = snapshot
+    with stage("cache_lookup"):
+        key = content_key(image_bytes, MODEL_VERSION)
+        version = snap.version
+        # Filtered results depend on the filter, so only the embedding is cached for them
+        results = query_cache.get_results(key, 5, version) if query_filter is None else None
+    if results is None:
+        cached, embedding = query_cache.get_embedding(key)
+        if not cached:
+            # Cache hits skip admission; misses take a slot, and are dropped from the batcher queue
+            # if their deadline passes first
+            async with search_admission.slot(request) as ticket:
+                # Queueing plus the shared batch; the batch itself is split into decode/detect/embed
+                with stage("batch_wait"):
+                    try:
+                        embedding = await asyncio.wait_for(embedding_batcher.submit(image_bytes), ticket.remaining())
+                    except asyncio.TimeoutError:
+                        raise search_admission.deadline_passed("Request deadline passed before embedding")
+            query_cache.put_embedding(key, embedding)
+
+        if embedding is None:
+            logger.warning("No face detected in uploaded image, returning fallback images")
+            results = get_fallback_images(query_filter, snap)
+        elif isinstance(snap.search_index, ShardedGallery):
+            # A scatter-gather over the shards blocks on the network, so keep it off the event loop
+            results = await run_in_threadpool(compute_similarity, embedding, 5, query_filter, snap)
+        else:
+            results = compute_similarity(embedding, 5, query_filter, snap)
+        if embedding is not None and query_filter is None:
+            query_cache.put_results(key, 5, version, results)
 
     formatted_results = [[id, f"{sim:.4f}"] for id, sim in results]
-    logger.info(f"Returning {len(formatted_results)} similar images")
+    logger.debug(f"Returning {len(formatted_results)} similar images for {file.filename}")
     return formatted_results
 
+@app.post("/find_similar/batch/")
+async def find_similar_batch(request: Request, files: List[UploadFile] = File(...), k: int = 5, threshold: Optional[float] = None,
+                             keep_all: bool = False, fuse: Optional[str] = None,
+                             filters: Optional[str] = Form(None)):
+    """Search several images in one request, optionally every face per image and fused into one ranking.
+
+    ``k`` and ``threshold`` bound the matches per face; ``keep_all`` searches
+    every detected face instead of the most prominent one; ``fuse`` ("max" or
+    "mean") ranks identities over all faces, e.g. several sketch variants of one
+    suspect; ``filters`` restricts matches by attributes as in /find_similar/.
+    Query ``index`` follows the upload order.
+    """
+    if not 0 < len(files) <= BATCH_SEARCH_MAX_IMAGES:
+        raise HTTPException(status_code=400, detail=f"Upload between 1 and {BATCH_SEARCH_MAX_IMAGES} images")
+    if not 0 < k <= SEARCH_MAX_K:
+        raise HTTPException(status_code=400, detail=f"k must be between 1 and {SEARCH_MAX_K}")
+    if fuse is not None and fuse not in GalleryIndex.FUSE_MODES:
+        raise HTTPException(status_code=400, detail=f"fuse must be one of {', '.join(GalleryIndex.FUSE_MODES)}")
+    if any(not (file.content_type or "").startswith('image/') for file in files):
+        raise HTTPException(status_code=400, detail="All files must be images")
+    query_filter = parse_filters(filters)
+    require_ready()
+
+    images = [await read_image(file) for file in files]
+    response = await run_inference(request, search_image_batch, images, keep_all, k, threshold, fuse, query_filter)
+    for query, file in zip(response["queries"], files):
+        query["filename"] = file.filename
+    return response
+
+@app.post("/sketch/match/")
+async def sketch_match(request: Request, file: UploadFile = File(...), k: int = 5, return_image: bool = False, format: str = "png",
+                       filters: Optional[str] = Form(None)):
+    """Turn a sketch into a photo and find the most similar gallery faces in one call.
+
+    Replaces calling /image/upload on the sketch API and posting the returned
+    photo to /find_similar/. The generated photo is included as a data URL
+    only with ``return_image``.
+    """
+    if not (file.content_type or "").startswith('image/'):
+        raise HTTPException(status_code=400, detail="File must be an image")
+    if not 0 < k <= SEARCH_MAX_K:
+        raise HTTPException(status_code=400, detail=f"k must be between 1 and {SEARCH_MAX_K}")
+    if format not in sketch_pipeline.IMAGE_FORMATS:
+        raise HTTPException(status_code=400, detail="format must be png or jpeg")
+    query_filter = parse_filters(filters)
+    require_ready()
+    if sketch_engine is None:
+        raise HTTPException(status_code=503, detail="Sketch generator is not available")
+
+    contents = await read_image(file)
+    try:
+        return await run_inference(request, match_sketch, contents, k, return_image, format, query_filter)
+    except ImageTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        # common.ingest raises IngestError (a ValueError) for undecodable uploads
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.get("/preprocess/")
-async def preprocess_endpoint():
-    """Trigger preprocessing of all images."""
+async def preprocess_endpoint(full: bool = False):
+    """Re-index the dataset; only new or changed images are embedded unless ``full`` is set."""
+    require_ready()
+    if preprocess_lock.locked():
+        raise HTTPException(status_code=409, detail="Preprocessing is already running")
     try:
-        preprocess_images()
-        return {"message": f"Preprocessed {len(embeddings_dict)} images"}
+        await run_in_threadpool(preprocess_images, full)
+        return {"message": f"Preprocessed {len(snapshot.gallery)} images"}
+    except StoreBusy:
+        raise store_busy()
     except Exception as e:
         logger.error(f"Error during preprocessing: {e}")
-        raise HTTPException(status_code=500, detail="Preprocessing failed")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="Preprocessing failed")
+
+@app.get("/preprocess/status")
+async def preprocess_status_endpoint():
+    """Report progress of the current or most recent preprocessing run."""
+    return {key: value for key, value in preprocess_status.items() if key != "started_at"}
+
+@app.post("/enroll/")
+async def enroll_endpoint(request: Request, image_id: str = Form(...), file: UploadFile = File(...)):
+    """Add or replace a single identity without re-indexing the gallery."""
+    if not IMAGE_ID_PATTERN.match(image_id):
+        raise HTTPException(status_code=400, detail="image_id may only contain letters, digits, '-' and '_'")
+    if not file.content_type.startswith('image/'):
+        raise HTTPException(status_code=400, detail="File must be an image")
+    extension = Path(file.filename or "").suffix.lower()
+    if extension not in IMAGE_EXTENSIONS:
+        extension = '.jpg'
+    require_ready()
+    if preprocess_lock.locked():
+        raise HTTPException(status_code=409, detail="Preprocessing is running, try again later")
+
+    image_bytes = await read_image(file)
+    try:
+        enrolled = await run_inference(request, enroll_identity, image_id, image_bytes, extension)
+    except StoreBusy:
+        raise store_busy()
+    if not enrolled:
+        raise HTTPException(status_code=422, detail="No face detected in image")
+    return {"message": f"Enrolled {image_id}", "total": len(snapshot.gallery)}
+
+@app.delete("/enroll/{image_id}")
+async def remove_endpoint(image_id: str):
+    """Remove a single identity from the gallery and the dataset."""
+    if not IMAGE_ID_PATTERN.match(image_id):
+        raise HTTPException(status_code=400, detail="Invalid image_id")
+    require_ready()
+    if preprocess_lock.locked():
+        raise HTTPException(status_code=409, detail="Preprocessing is running, try again later")
+    try:
+        removed = await run_in_threadpool(remove_identity, image_id)
+    except StoreBusy:
+        raise store_busy()
+    if not removed:
+        raise HTTPException(status_code=404, detail=f"{image_id} is not enrolled")
+    return {"message": f"Removed {image_id}", "total": len(snapshot.gallery)}
+
+@app.get("/attributes/")
+async def attribute_fields():
+    """Fields that searches can be filtered on, with their distinct values and coverage of the gallery."""
+    return dict(snapshot.attribute_index.describe(), path=ATTRIBUTES_PATH, records=len(attribute_records))
+
+@app.get("/stats/batching")
+async def batching_stats():
+    """Queue depth and batch-size histogram of the /find_similar/ batcher."""
+    return embedding_batcher.stats()
+
+@app.get("/stats/admission")
+async def admission_stats():
+    """Slots in use, queue lengths and limits of the admission-controlled pools."""
+    return {"pools": [search_admission.stats(), inference_admission.stats()]}
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics: request latency, per-stage histograms, batch sizes, gallery size and in-flight requests."""
+    return Response(content=render_metrics(), media_type=CONTENT_TYPE)
+
+@app.get("/stats/shards")
+async def shard_stats():
+    """Size and reload count of every gallery shard, when sharded search is enabled."""
+    if shard_gallery is None:
+        return {"shards": []}
+    try:
+        return {"shards": await run_in_threadpool(shard_gallery.info)}
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+@app.get("/stats/cache")
+async def cache_stats():
+    """Hit/miss counters and size of the query cache."""
+    return dict(query_cache.stats(), gallery_version=snapshot.version)
@@ -0,0 +1,248 @@
+"""Attributes of gallery entries, with posting-list and bitmap indexes for filtered search.
+
+The attributes are the ``details`` records of the Node backend (county,
+offense, class, custody date, ...), exported from MongoDB with::
+
+    mongoexport --db <db> --collection details --out details.jsonl
+
+Records are matched to gallery entries by their ``id`` field. For every
+value of a categorical field the index keeps the gallery rows that have it.
+Rare values are kept as a sorted row array (posting list) and common ones as
+a boolean bitmap over all rows. Numeric and date fields keep the rows sorted
+by value, so a range is two binary searches.
+
+A filter is a JSON object with one condition per field, all of which must hold::
+
+    {"county": "COOK", "class": ["X", "1"], "custody_date": {"gte": "01/01/2014", "lt": "01/01/2016"}}
+
+A list matches any of its values. Categorical values are compared
+case-insensitively. Range fields take ``gt``/``gte``/``lt``/``lte`` or a
+single value.
+"""
+import json
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+
+CATEGORICAL_FIELDS = ("class", "offense", "county", "sentence", "sentence_discharged", "mittimus", "mark")
+RANGE_FIELDS = ("count", "custody_date")
+RANGE_OPERATORS = ("gt", "gte", "lt", "lte")
+DATE_FORMAT = "%m/%d/%Y"
+
+# A value matching more than this fraction of rows is stored as a bitmap instead of a posting list
+BITMAP_MIN_FRACTION = 1 / 8
+
+# Sorted gallery rows, or a boolean mask over all rows
+Rows = np.ndarray
+
+_NO_ROWS = np.zeros(0, dtype=np.int64)
+
+
+class FilterError(ValueError):
+    """A filter names an unknown field or operator, or has a value of the wrong type."""
+
+
+def load_records(path: str) -> Dict[str, dict]:
+    """Read details records keyed by ``id`` from a JSON array or JSON lines (mongoexport) file."""
+    with open(path) as f:
+        text = f.read()
+    if text.lstrip().startswith("["):
+        records = json.loads(text)
+    else:
+        records = [json.loads(line) for line in text.splitlines() if line.strip()]
+    return {str(record["id"]): record for record in records if record.get("id") is not None}
+
+
+def _category(value) -> str:
+    return str(value).strip().casefold()
+
+
+def _number(field: str, value) -> float:
+    if field == "custody_date":
+        return float(datetime.strptime(str(value).strip(), DATE_FORMAT).toordinal())
+    return float(value)
+
+
+class Filter:
+    """A parsed filter: per field, the allowed categories or a ``(low, high, include_low, include_high)`` range."""
+
+    def __init__(self, conditions: dict):
+        if not isinstance(conditions, dict):
+            raise FilterError("Filters must be a JSON object of field conditions")
+        self.categories: Dict[str, set] = {}
+        self.ranges: Dict[str, tuple] = {}
+        for field, condition in conditions.items():
+            if field in CATEGORICAL_FIELDS:
+                values = condition if isinstance(condition, list) else [condition]
+                if any(isinstance(value, (dict, list)) or value is None for value in values):
+                    raise FilterError(f"{field} takes a value or a list of values")
+                self.categories[field] = {_category(value) for value in values}
+            elif field in RANGE_FIELDS:
+                self.ranges[field] = self._parse_range(field, condition)
+            else:
+                raise FilterError(f"Unknown filter field {field!r}; expected one of "
+                                  f"{', '.join(CATEGORICAL_FIELDS + RANGE_FIELDS)}")
+
+    @staticmethod
+    def _parse_range(field: str, condition) -> tuple:
+        if not isinstance(condition, dict):
+            condition = {"gte": condition, "lte": condition}
+        low, high, include_low, include_high = -np.inf, np.inf, True, True
+        for operator, bound in condition.items():
+            if operator not in RANGE_OPERATORS:
+                raise FilterError(f"Unknown operator {operator!r} for {field}; expected one of {RANGE_OPERATORS}")
+            try:
+                value = _number(field, bound)
+            except (TypeError, ValueError):
+                expected = f"a date like {datetime(2014, 3, 18).strftime(DATE_FORMAT)}" \
+                    if field == "custody_date" else "a number"
+                raise FilterError(f"{field} {operator} must be {expected}, got {bound!r}")
+            # Several bounds on one side keep the tightest, and exclusive wins over inclusive
+            if operator.startswith("g") and (value > low or (value == low and operator == "gt")):
+                low, include_low = value, operator == "gte"
+            elif operator.startswith("l") and (value < high or (value == high and operator == "lt")):
+                high, include_high = value, operator == "lte"
+        return low, high, include_low, include_high
+
+    @classmethod
+    def parse(cls, text: Optional[str]) -> Optional["Filter"]:
+        """Parse a JSON filter; None or an empty object means no filter."""
+        if not text:
+            return None
+        try:
+            conditions = json.loads(text)
+        except ValueError as e:
+            raise FilterError(f"Filters are not valid JSON: {e}")
+        return cls(conditions) if conditions else None
+
+    def matches(self, record: Optional[dict]) -> bool:
+        """Check one record directly, without an index."""
+        if record is None:
+            return False
+        for field, allowed in self.categories.items():
+            if record.get(field) in (None, "") or _category(record[field]) not in allowed:
+                return False
+        for field, (low, high, include_low, include_high) in self.ranges.items():
+            try:
+                value = _number(field, record[field])
+            except (KeyError, TypeError, ValueError):
+                return False
+            if value < low or (value == low and not include_low) or value > high or (value == high and not include_high):
+                return False
+        return True
+
+
+class AttributeIndex:
+    """Attribute indexes over the rows of one gallery, in that gallery's row order.
+
+    Rebuild it whenever the gallery's rows change. :meth:`select` resolves a
+    filter to the matching rows, and :meth:`allows` checks single results.
+    """
+
+    def __init__(self, ids: List[str], records: Dict[str, dict]):
+        self.ids = list(ids)
+        self.records = records
+        self.size = n = len(self.ids)
+        postings = {field: defaultdict(list) for field in CATEGORICAL_FIELDS}
+        columns = {field: np.full(n, np.nan) for field in RANGE_FIELDS}
+        for row, image_id in enumerate(self.ids):
+            record = records.get(image_id)
+            if record is None:
+                continue
+            for field in CATEGORICAL_FIELDS:
+                if record.get(field) not in (None, ""):
+                    postings[field][_category(record[field])].append(row)
+            for field in RANGE_FIELDS:
+                try:
+                    columns[field][row] = _number(field, record[field])
+                except (KeyError, TypeError, ValueError):
+                    pass
+
+        self.values: Dict[str, Dict[str, Rows]] = {
+            field: {value: self._rows_or_bitmap(np.asarray(rows, dtype=np.int64)) for value, rows in values.items()}
+            for field, values in postings.items()
+        }
+        self.counts = {field: {value: len(rows) for value, rows in values.items()}
+                       for field, values in postings.items()}
+        self.sorted_rows: Dict[str, np.ndarray] = {}
+        self.sorted_values: Dict[str, np.ndarray] = {}
+        for field, column in columns.items():
+            present = np.flatnonzero(~np.isnan(column))
+            order = present[np.argsort(column[present], kind="stable")]
+            self.sorted_rows[field] = order
+            self.sorted_values[field] = column[order]
+
+    def _rows_or_bitmap(self, rows: np.ndarray) -> Rows:
+        """Sorted ``rows`` as they are, or as a bitmap when they cover a large part of the gallery."""
+        if len(rows) <= BITMAP_MIN_FRACTION * self.size:
+            return rows
+        bitmap = np.zeros(self.size, dtype=bool)
+        bitmap[rows] = True
+        return bitmap
+
+    @staticmethod
+    def _count(rows: Rows) -> int:
+        return int(rows.sum()) if rows.dtype == bool else len(rows)
+
+    @staticmethod
+    def _intersect(a: Rows, b: Rows) -> Rows:
+        if a.dtype == bool and b.dtype == bool:
+            return a & b
+        if a.dtype == bool:
+            a, b = b, a
+        if b.dtype == bool:
+            return a[b[a]]
+        return np.intersect1d(a, b, assume_unique=True)
+
+    def _union(self, parts: List[Rows]) -> Rows:
+        if len(parts) == 1:
+            return parts[0]
+        if sum(self._count(part) for part in parts) <= BITMAP_MIN_FRACTION * self.size:
+            return np.unique(np.concatenate(parts))
+        bitmap = np.zeros(self.size, dtype=bool)
+        for part in parts:
+            if part.dtype == bool:
+                bitmap |= part
+            else:
+                bitmap[part] = True
+        return bitmap
+
+    def _range_rows(self, field: str, low: float, high: float, include_low: bool, include_high: bool) -> Rows:
+        values = self.sorted_values[field]
+        start = np.searchsorted(values, low, side="left" if include_low else "right")
+        stop = np.searchsorted(values, high, side="right" if include_high else "left")
+        if start >= stop:
+            return _NO_ROWS
+        return self._rows_or_bitmap(np.sort(self.sorted_rows[field][start:stop]))
+
+    def select(self, query_filter: Filter) -> np.ndarray:
+        """Sorted rows that satisfy every condition of the filter."""
+        conditions = [self._union([self.values[field].get(value, _NO_ROWS) for value in allowed])
+                      for field, allowed in query_filter.categories.items()]
+        conditions += [self._range_rows(field, *bounds) for field, bounds in query_filter.ranges.items()]
+        if not conditions:
+            return np.arange(self.size)
+        # Start from the most selective condition so every intersection is as small as possible
+        conditions.sort(key=self._count)
+        rows = conditions[0]
+        for condition in conditions[1:]:
+            if not self._count(rows):
+                break
+            rows = self._intersect(rows, condition)
+        return np.flatnonzero(rows) if rows.dtype == bool else rows
+
+    def ids_of(self, rows: np.ndarray) -> List[str]:
+        """Image IDs of gallery rows, e.g. of a :meth:`select` result."""
+        return [self.ids[row] for row in rows]
+
+    def allows(self, image_id: str, query_filter: Filter) -> bool:
+        return query_filter.matches(self.records.get(image_id))
+
+    def describe(self) -> dict:
+        """Filterable fields with their number of distinct values and of rows that have the field."""
+        fields = {field: {"values": len(counts), "rows": sum(counts.values())} for field, counts in self.counts.items()}
+        fields.update({field: {"rows": len(rows)} for field, rows in self.sorted_rows.items()})
+        return {"gallery_rows": self.size, "rows_with_attributes": sum(1 for i in self.ids if i in self.records),
+                "fields": fields}
@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """Collects concurrent requests into batches for a single model worker thread.
+
+    ``submit`` queues an item and waits for its result. A background task takes
+    the first queued item, keeps collecting until ``max_batch_size`` items are
+    gathered or ``max_wait_ms`` has passed, then runs ``process_batch`` on the
+    whole list in a worker thread and resolves each caller's future with the
+    matching result. Batches run one at a time, so requests arriving while a
+    batch is running form the next batch. If a batch raises, its items are run
+    again one at a time, so one bad item does not fail the others.
+    """
+
+    # Upper bounds of the batch-size histogram buckets
+    HISTOGRAM_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+    def __init__(self, process_batch: Callable[[List[Any]], List[Any]], max_batch_size: int = 16,
+                 max_wait_ms: float = 5.0, name: str = "batcher"):
+        self.process_batch = process_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self.name = name
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        self._histogram = [0] * (len(self.HISTOGRAM_BUCKETS) + 1)
+        self._batches = 0
+        self._items = 0
+        self._busy_seconds = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self):
+        """Start the collector task on the running event loop."""
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Cancel the collector and fail anything still queued."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while self._queue is not None and not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError(f"{self.name} stopped"))
+
+    async def submit(self, item: Any) -> Any:
+        """Queue ``item`` for the next batch and wait for its result."""
+        if self._task is None:
+            raise RuntimeError(f"{self.name} is not running")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _collect(self) -> list:
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                # Still take whatever is already waiting, without blocking
+                while len(batch) < self.max_batch_size and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            # Callers that gave up while queued do not need to be computed
+            batch = [(item, future) for item, future in batch if not future.cancelled()]
+            if not batch:
+                continue
+            start = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(self._executor, self.process_batch, [item for item, _ in batch])
+            except Exception as e:
+                logger.error(f"{self.name} batch of {len(batch)} failed: {e}")
+                if len(batch) > 1:
+                    # Run the items one at a time, so only the ones that fail themselves get an error
+                    for item, future in batch:
+                        if future.done():
+                            continue
+                        try:
+                            result = (await loop.run_in_executor(self._executor, self.process_batch, [item]))[0]
+                        except Exception as item_error:
+                            if not future.done():
+                                future.set_exception(item_error)
+                        else:
+                            if not future.done():
+                                future.set_result(result)
+                elif not batch[0][1].done():
+                    batch[0][1].set_exception(e)
+                continue
+            finally:
+                self._record(len(batch), time.perf_counter() - start)
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def _record(self, size: int, seconds: float):
+        self._histogram[bisect_left(self.HISTOGRAM_BUCKETS, size)] += 1
+        self._batches += 1
+        self._items += size
+        self._busy_seconds += seconds
+
+    def stats(self) -> dict:
+        """Queue depth, batch counts and the batch-size histogram (bucket upper bound -> count)."""
+        buckets = [str(b) for b in self.HISTOGRAM_BUCKETS] + ["+Inf"]
+        return {
+            "queue_depth": self.queue_depth,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "batches": self._batches,
+            "items": self._items,
+            "mean_batch_size": self._items / self._batches if self._batches else 0.0,
+            "busy_seconds": self._busy_seconds,
+            "batch_size_histogram": dict(zip(buckets, self._histogram)),
+        }
@@ -0,0 +1,114 @@
+import os
+
+# Paths to the gallery images and the persisted embeddings
+EMBEDDINGS_PATH = os.getenv("API2_EMBEDDINGS_PATH", "embeddings.emb")
+DATASET_PATH = os.getenv("API2_DATASET_PATH", "criminal_faces/")
+# Pickle written by older versions, converted to EMBEDDINGS_PATH on first load
+LEGACY_EMBEDDINGS_PATH = os.getenv("API2_LEGACY_EMBEDDINGS_PATH", "embeddings.pkl")
+# On-disk precision of the embedding store: "float32" or "float16"
+EMBEDDINGS_DTYPE = os.getenv("API2_EMBEDDINGS_DTYPE", "float32")
+# Seconds between checks for a store rewritten by another worker process
+STORE_RELOAD_INTERVAL = float(os.getenv("API2_STORE_RELOAD_INTERVAL", "5"))
+# Seconds a gallery write waits for another worker process's write (see embedding_store.store_lock)
+# before it is refused with 409
+STORE_LOCK_TIMEOUT = float(os.getenv("API2_STORE_LOCK_TIMEOUT", "10"))
+
+# Search index: "exact" (NumPy brute force), FAISS "flat", "ivf" or "hnsw", or a compressed
+# FAISS index "fp16", "sq8" or "pq" (see below)
+INDEX_TYPE = os.getenv("API2_INDEX_TYPE", "exact")
+INDEX_PATH = os.getenv(
+    "API2_INDEX_PATH",
+    os.path.join(os.path.dirname(EMBEDDINGS_PATH), "faiss_index.bin"),
+)
+# Upper bound: IVF builds use at most 4 * sqrt(n) and n / 39 lists for n vectors
+IVF_NLIST = int(os.getenv("API2_IVF_NLIST", "1024"))
+IVF_NPROBE = int(os.getenv("API2_IVF_NPROBE", "16"))
+HNSW_M = int(os.getenv("API2_HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("API2_HNSW_EF_CONSTRUCTION", "200"))
+HNSW_EF_SEARCH = int(os.getenv("API2_HNSW_EF_SEARCH", "64"))
+# Compressed indexes: "fp16" and "sq8" (scalar quantization) or "pq" (PQ_M sub-vectors of PQ_NBITS bits).
+# Their top RERANK_FACTOR * k candidates are re-scored exactly against the memory-mapped
+# full-precision store; 0 returns the compressed-domain ranking as is.
+PQ_M = int(os.getenv("API2_PQ_M", "64"))
+PQ_NBITS = int(os.getenv("API2_PQ_NBITS", "8"))
+RERANK_FACTOR = int(os.getenv("API2_RERANK_FACTOR", "4"))
+
+# Gallery enrollment pipeline
+ENROLL_BATCH_SIZE = int(os.getenv("API2_ENROLL_BATCH_SIZE", "32"))
+ENROLL_WORKERS = int(os.getenv("API2_ENROLL_WORKERS", "4"))
+ENROLL_MAX_SIDE = int(os.getenv("API2_ENROLL_MAX_SIDE", "640"))
+
+# Uploaded queries are decoded (JPEGs at reduced scale) to at most this many pixels on the longest side
+QUERY_MAX_SIDE = int(os.getenv("API2_QUERY_MAX_SIDE", "1024"))
+
+# Manifest of embedded gallery files, used for incremental re-indexing.
+# Bump MODEL_VERSION whenever the detector or embedding model changes.
+MANIFEST_PATH = os.getenv(
+    "API2_MANIFEST_PATH",
+    os.path.join(os.path.dirname(EMBEDDINGS_PATH), "embeddings_manifest.json"),
+)
+MODEL_VERSION = os.getenv("API2_MODEL_VERSION", "mtcnn160-inception_resnet_v1-vggface2")
+# Aligned face crops kept by enrollment so a new embedding model can skip detection (see crop_store.py).
+# Bump DETECTOR_VERSION whenever MTCNN settings or ENROLL_MAX_SIDE change, which discards the stored crops.
+CROP_STORE_PATH = os.getenv(
+    "API2_CROP_STORE_PATH",
+    os.path.join(os.path.dirname(EMBEDDINGS_PATH), "face_crops.u8"),
+)
+DETECTOR_VERSION = os.getenv("API2_DETECTOR_VERSION", f"mtcnn160-margin0-side{ENROLL_MAX_SIDE}")
+# Pretrained InceptionResnetV1 weights; empty for random weights (benchmarks on offline machines)
+RESNET_PRETRAINED = os.getenv("API2_RESNET_PRETRAINED", "vggface2")
+
+# Details records (mongoexport of the Node backend's details collection) used to filter searches
+ATTRIBUTES_PATH = os.getenv(
+    "API2_ATTRIBUTES_PATH",
+    os.path.join(os.path.dirname(EMBEDDINGS_PATH), "details.jsonl"),
+)
+
+# Micro-batching of /find_similar/ requests
+BATCH_MAX_SIZE = int(os.getenv("API2_BATCH_MAX_SIZE", "16"))
+BATCH_MAX_WAIT_MS = float(os.getenv("API2_BATCH_MAX_WAIT_MS", "5"))
+
+# Admission control (see common/admission.py). /find_similar/ requests share the micro-batcher and are
+# limited separately from batch search, sketch matching and enrollment, which run on a pool of
+# API2_INFERENCE_WORKERS threads. Requests beyond the queue get 429; queued requests whose deadline
+# (API2_REQUEST_TIMEOUT seconds) passes get 503.
+SEARCH_MAX_CONCURRENCY = int(os.getenv("API2_SEARCH_MAX_CONCURRENCY", str(2 * BATCH_MAX_SIZE)))
+SEARCH_MAX_QUEUE = int(os.getenv("API2_SEARCH_MAX_QUEUE", "64"))
+INFERENCE_WORKERS = int(os.getenv("API2_INFERENCE_WORKERS", "2"))
+INFERENCE_MAX_QUEUE = int(os.getenv("API2_INFERENCE_MAX_QUEUE", "16"))
+REQUEST_TIMEOUT = float(os.getenv("API2_REQUEST_TIMEOUT", "30"))
+
+# Number of warm-up rounds (one single and one full batch each) run before reporting ready
+WARMUP_BATCHES = int(os.getenv("API2_WARMUP_BATCHES", "2"))
+
+# Cache of query embeddings and results keyed by upload content; 0 entries disables it
+QUERY_CACHE_SIZE = int(os.getenv("API2_QUERY_CACHE_SIZE", "1024"))
+QUERY_CACHE_TTL = float(os.getenv("API2_QUERY_CACHE_TTL", "600"))
+
+# Batch search (/find_similar/batch/): uploads per request and the largest k allowed
+BATCH_SEARCH_MAX_IMAGES = int(os.getenv("API2_BATCH_SEARCH_MAX_IMAGES", "32"))
+SEARCH_MAX_K = int(os.getenv("API2_SEARCH_MAX_K", "100"))
+
+# Sharded search: API2_SHARDS > 0 partitions the gallery by ID hash into that many shard stores,
+# each served by its own process (see shards.py). API2_SHARD_ADDRESSES lists already running
+# shard servers as host:port, in shard order, instead of spawning local ones.
+SHARD_ADDRESSES = [address for address in os.getenv("API2_SHARD_ADDRESSES", "").split(",") if address]
+SHARD_COUNT = len(SHARD_ADDRESSES) or int(os.getenv("API2_SHARDS", "0"))
+SHARD_STORE_TEMPLATE = os.getenv(
+    "API2_SHARD_STORE_TEMPLATE",
+    os.path.join(os.path.dirname(EMBEDDINGS_PATH), "embeddings.shard{shard}of{count}.emb"),
+)
+SHARD_BASE_PORT = int(os.getenv("API2_SHARD_BASE_PORT", "7100"))
+# Shared key that authenticates coordinator and shards. Required to serve shards from the command
+# line or connect to API2_SHARD_ADDRESSES; locally spawned shards get a random key when it is unset.
+SHARD_AUTHKEY = os.getenv("API2_SHARD_AUTHKEY", "")
+
+# In-process sketch -> photo -> match pipeline (/sketch/match/), using the generator of the api app.
+# The endpoint is disabled when the weights file does not exist.
+SKETCH_GENERATOR_WEIGHTS = os.getenv(
+    "API2_SKETCH_GENERATOR_WEIGHTS",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "api", "models", "G_sketch_to_photo_best.pth"),
+)
+SKETCH_GENERATOR_RUNTIME = os.getenv("API2_SKETCH_GENERATOR_RUNTIME", "eager")
+# Compiled generator artifacts of this service, apart from the api app's own api/models/compiled
+SKETCH_GENERATOR_CACHE_DIR = os.getenv("API2_SKETCH_GENERATOR_CACHE_DIR", "compiled_generator")
@@ -0,0 +1,256 @@
+"""Aligned face crops saved during enrollment, so the gallery can be re-embedded without detection.
+
+Enrollment keeps the MTCNN crop of every gallery image as ``3 x S x S``
+uint8 pixels in one fixed-slot file (``S`` is 160), memory-mapped and
+indexed by image ID. A JSON index next to it records each ID's slot, the
+detection box and probability, and the size and mtime of the source file.
+Images without a face are recorded with no slot, so they are not detected
+again either.
+
+Any embedding model can be run over the stored crops in batches (see
+:func:`embed_crops`). Changing the embedding model then costs only the
+embedding pass. Crops depend on the detector settings, so a store built
+with another ``detector_version`` is discarded when opened.
+
+Slots freed by :meth:`CropStore.discard` are not reused until the index
+has been saved. Because of this, a crash between writing crops and saving
+the index never leaves the saved index pointing at another face's pixels.
+
+Free slots are tracked in memory, so only one process may write at a time,
+and only to a store that is current: api2 writes under the embedding store
+lock (``embedding_store.store_lock``) and re-opens the crop store first when
+:meth:`CropStore.changed_on_disk` reports another process saved it.
+
+Re-embed the stored crops with another model from the command line::
+
+    python crop_store.py embed --pretrained casia-webface --out embeddings.casia.emb
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+def crop_to_uint8(face: torch.Tensor, post_processed: bool = True) -> torch.Tensor:
+    """Convert an MTCNN crop back to uint8 pixels, undoing ``fixed_image_standardization``."""
+    pixels = face * 128.0 + 127.5 if post_processed else face
+    return pixels.round().clamp(0, 255).to(torch.uint8)
+
+
+def uint8_to_input(crops: torch.Tensor) -> torch.Tensor:
+    """Standardize uint8 crops the way MTCNN does for InceptionResnetV1 (``(x - 127.5) / 128``)."""
+    return (crops.float() - 127.5) / 128.0
+
+
+class CropStore:
+    """Fixed-size uint8 face crops in a memory-mapped file, indexed by image ID."""
+
+    def __init__(self, path: str, detector_version: str, image_size: int = 160):
+        self.path = path
+        self.index_path = f"{path}.json"
+        self.detector_version = detector_version
+        self.image_size = image_size
+        self.entries: Dict[str, dict] = {}
+        self._crops: Optional[np.memmap] = None
+        self._free: List[int] = []
+        # Slots discarded since the last save; reusable only once the index no longer references them
+        self._released: List[int] = []
+        # Modification time of the index when it was loaded or saved by this process
+        self._index_mtime_ns: Optional[int] = None
+
+    @property
+    def slot_shape(self) -> Tuple[int, int, int]:
+        return 3, self.image_size, self.image_size
+
+    @property
+    def capacity(self) -> int:
+        return 0 if self._crops is None else self._crops.shape[0]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, image_id: str) -> bool:
+        return image_id in self.entries
+
+    @property
+    def ids(self) -> List[str]:
+        """IDs that have a stored crop (images without a face are left out)."""
+        return [image_id for image_id, entry in self.entries.items() if entry["slot"] is not None]
+
+    def changed_on_disk(self) -> bool:
+        """Whether another process saved the index since this one opened or saved it."""
+        if not os.path.exists(self.index_path):
+            return False
+        return os.stat(self.index_path).st_mtime_ns != self._index_mtime_ns
+
+    @classmethod
+    def open(cls, path: str, detector_version: str, image_size: int = 160) -> "CropStore":
+        """Open the store at ``path``. Start empty if it is missing, unreadable or from another detector."""
+        store = cls(path, detector_version, image_size)
+        if not os.path.exists(store.index_path) or not os.path.exists(path):
+            return store
+        store._index_mtime_ns = os.stat(store.index_path).st_mtime_ns
+        try:
+            with open(store.index_path) as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.error(f"Error loading crop index {store.index_path}, starting empty: {e}")
+            return store
+        if data.get("detector_version") != detector_version or data.get("image_size") != image_size:
+            logger.warning(f"{path} holds crops from {data.get('detector_version')}, expected {detector_version}; "
+                           f"faces will be detected again")
+            return store
+        store._map(data["capacity"])
+        store.entries = data["entries"]
+        used = {entry["slot"] for entry in store.entries.values() if entry["slot"] is not None}
+        store._free = sorted(set(range(store.capacity)).difference(used), reverse=True)
+        return store
+
+    def _map(self, capacity: int):
+        slot_bytes = int(np.prod(self.slot_shape))
+        with open(self.path, "ab") as f:
+            if f.tell() < capacity * slot_bytes:
+                f.truncate(capacity * slot_bytes)
+        self._crops = np.memmap(self.path, dtype=np.uint8, mode="r+", shape=(capacity,) + self.slot_shape) \
+            if capacity else None
+
+    def _allocate(self) -> int:
+        if not self._free:
+            old = self.capacity
+            if self._crops is not None:
+                self._crops.flush()
+            self._map(max(2 * old, 64))
+            self._free = list(range(self.capacity - 1, old - 1, -1))
+        return self._free.pop()
+
+    def is_current(self, image_id: str, path: str) -> bool:
+        """Whether the stored detection for ``image_id`` was made from the current contents of ``path``."""
+        entry = self.entries.get(image_id)
+        if entry is None or entry["path"] != path:
+            return False
+        stat = os.stat(path)
+        return entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns
+
+    def put(self, image_id: str, crop: Optional[torch.Tensor], box: Optional[List[float]] = None,
+            probability: Optional[float] = None, path: Optional[str] = None):
+        """Store the uint8 crop (or ``None`` when no face was found) detected in the file at ``path``."""
+        self.discard(image_id)
+        slot = None
+        if crop is not None:
+            slot = self._allocate()
+            self._crops[slot] = crop.cpu().numpy() if isinstance(crop, torch.Tensor) else crop
+        stat = os.stat(path) if path else None
+        self.entries[image_id] = {
+            "slot": slot,
+            "box": box,
+            "probability": probability,
+            "path": path,
+            "size": stat.st_size if stat else None,
+            "mtime_ns": stat.st_mtime_ns if stat else None,
+        }
+
+    def discard(self, image_id: str):
+        entry = self.entries.pop(image_id, None)
+        if entry is not None and entry["slot"] is not None:
+            self._released.append(entry["slot"])
+
+    def prune(self, keep_ids: Iterable[str]) -> int:
+        """Discard every entry not in ``keep_ids``; returns how many were dropped."""
+        stale = set(self.entries).difference(keep_ids)
+        for image_id in stale:
+            self.discard(image_id)
+        return len(stale)
+
+    def crops(self, image_ids: List[str]) -> torch.Tensor:
+        """Stored crops of ``image_ids`` as one ``(N, 3, S, S)`` uint8 tensor."""
+        slots = [self.entries[image_id]["slot"] for image_id in image_ids]
+        if not slots:
+            return torch.zeros((0,) + self.slot_shape, dtype=torch.uint8)
+        return torch.from_numpy(np.ascontiguousarray(self._crops[slots]))
+
+    def save(self):
+        """Flush the crops to disk, then write the index atomically."""
+        if self._crops is not None:
+            self._crops.flush()
+        # Per process, so workers saving at the same time never write into one temporary file
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"detector_version": self.detector_version, "image_size": self.image_size,
+                           "capacity": self.capacity, "saved_at": time.time(), "entries": self.entries}, f)
+            os.replace(tmp_path, self.index_path)
+            self._index_mtime_ns = os.stat(self.index_path).st_mtime_ns
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self._free.extend(self._released)
+        self._released = []
+
+
+def embed_crops(store: CropStore, embed_batch: Callable[[torch.Tensor], np.ndarray],
+                image_ids: Optional[List[str]] = None,
+                batch_size: int = config.ENROLL_BATCH_SIZE) -> Iterator[Tuple[str, np.ndarray]]:
+    """Run an embedding model over stored crops in batches.
+
+    ``embed_batch`` takes a ``(N, 3, S, S)`` uint8 tensor and returns one
+    embedding row per crop. That leaves standardization or resizing (for
+    example, to 112x112 for ArcFace) to the model. Yields
+    ``(image_id, embedding)`` for every ID with a crop.
+    """
+    ids = store.ids if image_ids is None else [i for i in image_ids if store.entries.get(i, {}).get("slot") is not None]
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        yield from zip(batch, embed_batch(store.crops(batch)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build an embedding store from the saved face crops.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    embed = commands.add_parser("embed", help="Embed every stored crop with an InceptionResnetV1 model")
+    embed.add_argument("--store", default=config.CROP_STORE_PATH)
+    embed.add_argument("--pretrained", default=config.RESNET_PRETRAINED or None,
+                       help="facenet-pytorch weights: vggface2 or casia-webface (empty for random weights)")
+    embed.add_argument("--out", required=True, help="Embedding store to write")
+    embed.add_argument("--model-version", default=None)
+    embed.add_argument("--batch-size", type=int, default=config.ENROLL_BATCH_SIZE)
+
+    commands.add_parser("info", help="Print crop counts").add_argument("--store", default=config.CROP_STORE_PATH)
+    args = parser.parse_args()
+
+    store = CropStore.open(args.store, config.DETECTOR_VERSION)
+    if args.command == "info":
+        print(f"{len(store.ids)} crops, {len(store) - len(store.ids)} images without a face, "
+              f"{store.capacity} slots in {args.store}")
+        return
+
+    from facenet_pytorch import InceptionResnetV1
+    from embedding_store import write_store
+    from gallery import GalleryIndex
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    resnet = InceptionResnetV1(pretrained=args.pretrained or None).eval().to(device)
+
+    def embed_batch(crops: torch.Tensor) -> np.ndarray:
+        with torch.no_grad():
+            return resnet(uint8_to_input(crops).to(device)).cpu().numpy()
+
+    start = time.perf_counter()
+    gallery = GalleryIndex(capacity=len(store.ids))
+    gallery.add_many(embed_crops(store, embed_batch, batch_size=args.batch_size))
+    write_store(args.out, gallery.ids, gallery.matrix, dtype=config.EMBEDDINGS_DTYPE,
+                model_version=args.model_version or f"{config.DETECTOR_VERSION}-inception_resnet_v1-{args.pretrained}")
+    print(f"Embedded {len(gallery)} crops into {args.out} in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import argparse
+import fcntl
+import json
+import os
+import pickle
+import struct
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# File layout (little endian):
+#   header   struct HEADER_FORMAT, padded to DATA_ALIGNMENT bytes
+#   matrix   count x dim rows of float32 or float16, starting at matrix_offset
+#   metadata UTF-8 JSON {"ids": [...], "model_version": ..., "created_at": ...}
+MAGIC = b"FEMB"
+FORMAT_VERSION = 1
+HEADER_FORMAT = "<4sHHQIIQQQ"
+DATA_ALIGNMENT = 4096
+DTYPES = {0: np.float32, 1: np.float16}
+DTYPE_CODES = {np.dtype(dtype): code for code, dtype in DTYPES.items()}
+# How often store_lock() retries while another process holds the lock
+LOCK_POLL_SECONDS = 0.05
+
+
+class EmbeddingStoreError(Exception):
+    """Raised when an embedding store file is missing, truncated or of an unknown format."""
+
+
+class StoreBusy(EmbeddingStoreError):
+    """Raised when another process holds the store lock for longer than the caller would wait."""
+
+
+@contextmanager
+def store_lock(path: str, shared: bool = False, timeout: Optional[float] = None):
+    """Hold an ``fcntl.flock`` on ``{path}.lock``, the lock every process takes around the store at ``path``.
+
+    A writer holds it exclusively from re-reading the store to renaming the
+    new one into place, so two processes never both rewrite it from the same
+    old contents. A reader holds it shared, so it never sees files of two
+    different writes. Waits up to ``timeout`` seconds (forever when None,
+    one try when 0), then raises :class:`StoreBusy`.
+    """
+    mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    with open(f"{path}.lock", "a") as lock_file:
+        if timeout is None:
+            fcntl.flock(lock_file, mode)
+        else:
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    fcntl.flock(lock_file, mode | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        raise StoreBusy(f"{path} is locked by another process")
+                    time.sleep(LOCK_POLL_SECONDS)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def write_store(path: str, ids: List[str], matrix: np.ndarray, dtype=np.float32,
+                model_version: Optional[str] = None):
+    """Write ``ids`` and their ``(count, dim)`` embedding matrix to ``path`` atomically.
+
+    The file is written under a temporary name in the same directory, flushed
+    to disk, and renamed over ``path``, so readers only ever see a complete
+    file. Processes that already mapped the previous file keep their mapping.
+    """
+    dtype = np.dtype(dtype)
+    if dtype not in DTYPE_CODES:
+        raise ValueError(f"Unsupported dtype {dtype}; expected float32 or float16")
+    matrix = np.asarray(matrix)
+    if matrix.ndim != 2:
+        raise ValueError(f"Expected a 2-D matrix, got shape {matrix.shape}")
+    count, dim = matrix.shape
+    if count != len(ids):
+        raise ValueError(f"Matrix has {count} rows but {len(ids)} ids were given")
+
+    meta = json.dumps({"ids": list(ids), "model_version": model_version,
+                       "created_at": time.time()}).encode("utf-8")
+    matrix_offset = DATA_ALIGNMENT
+    meta_offset = matrix_offset + count * dim * dtype.itemsize
+    header = struct.pack(HEADER_FORMAT, MAGIC, FORMAT_VERSION, DTYPE_CODES[dtype],
+                         count, dim, 0, matrix_offset, meta_offset, len(meta))
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(header.ljust(DATA_ALIGNMENT, b"\0"))
+            # Write in blocks so float16 conversion never copies the whole matrix
+            for start in range(0, count, 65536):
+                f.write(np.ascontiguousarray(matrix[start:start + 65536], dtype=dtype).tobytes())
+            f.write(meta)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def open_store(path: str) -> Tuple[List[str], np.ndarray, dict]:
+    """Memory-map an embedding store.
+
+    Returns ``(ids, matrix, metadata)``. ``matrix`` is a read-only
+    ``np.memmap``, so every process that opens the same file shares one
+    page-cache copy and nothing is read until rows are touched. The header,
+    IDs and rows all come from one open file, so a store renamed over
+    ``path`` meanwhile cannot mix the old IDs with the new rows.
+    """
+    header_size = struct.calcsize(HEADER_FORMAT)
+    with open(path, "rb") as f:
+        raw = f.read(header_size)
+        if len(raw) < header_size:
+            raise EmbeddingStoreError(f"{path} is truncated")
+        magic, version, dtype_code, count, dim, _, matrix_offset, meta_offset, meta_length = \
+            struct.unpack(HEADER_FORMAT, raw)
+        if magic != MAGIC:
+            raise EmbeddingStoreError(f"{path} is not an embedding store")
+        if version != FORMAT_VERSION or dtype_code not in DTYPES:
+            raise EmbeddingStoreError(f"{path} has unsupported format version {version} / dtype {dtype_code}")
+        dtype = np.dtype(DTYPES[dtype_code])
+        if meta_offset != matrix_offset + count * dim * dtype.itemsize or \
+                os.fstat(f.fileno()).st_size < meta_offset + meta_length:
+            raise EmbeddingStoreError(f"{path} is truncated")
+        f.seek(meta_offset)
+        meta_bytes = f.read(meta_length)
+        if len(meta_bytes) != meta_length:
+            raise EmbeddingStoreError(f"{path} is truncated")
+        meta = json.loads(meta_bytes.decode("utf-8"))
+        ids = meta.pop("ids")
+        if len(ids) != count:
+            raise EmbeddingStoreError(f"{path} has {count} rows but {len(ids)} ids")
+        if count and dim:
+            # Map the file already open; the mapping stays valid after it is closed
+            matrix = np.memmap(f, dtype=dtype, mode="r", offset=matrix_offset, shape=(count, dim))
+        else:
+            matrix = np.zeros((0, dim), dtype=dtype)
+    return ids, matrix, meta
+
+
+def load_legacy_pickle(path: str) -> Dict[str, np.ndarray]:
+    """Read either pickle layout used in this project as an ``{id: embedding}`` dict.
+
+    Handles the api2 ``{image_id: ndarray}`` dict and the notebook's
+    ``{'ids': [...], 'embeddings': [...]}`` file read by ``bnd/recognize_face.py``.
+    """
+    with open(path, "rb") as f:
+        data = pickle.load(f)
+    if isinstance(data, dict) and set(data) == {"ids", "embeddings"}:
+        return dict(zip(data["ids"], data["embeddings"]))
+    return data
+
+
+def convert_pickle(src: str, dst: str, dtype=np.float32, normalize: bool = True,
+                   model_version: Optional[str] = None) -> int:
+    """Convert a legacy embeddings pickle to an embedding store. Returns the row count."""
+    embeddings = load_legacy_pickle(src)
+    ids = list(embeddings)
+    matrix = np.stack([np.asarray(embeddings[i], dtype=np.float32).reshape(-1) for i in ids]) \
+        if ids else np.zeros((0, 0), dtype=np.float32)
+    if normalize and len(matrix):
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix = matrix / np.where(norms == 0, 1, norms)
+    write_store(dst, ids, matrix, dtype=dtype, model_version=model_version)
+    return len(ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert an embeddings pickle into a memory-mapped embedding store.")
+    parser.add_argument("src", help="embeddings.pkl (api2) or embeddings.pickle (notebook)")
+    parser.add_argument("dst", help="output store, e.g. embeddings.emb")
+    parser.add_argument("--dtype", choices=("float32", "float16"), default="float32")
+    parser.add_argument("--no-normalize", action="store_true", help="Keep vectors as stored instead of L2-normalizing")
+    parser.add_argument("--model-version", default=None)
+    args = parser.parse_args()
+
+    count = convert_pickle(args.src, args.dst, dtype=args.dtype, normalize=not args.no_normalize,
+                           model_version=args.model_version)
+    print(f"Wrote {count} embeddings to {args.dst}")
+
+
+if __name__ == "__main__":
+    main()
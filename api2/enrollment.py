@@ -0,0 +1,217 @@
+import logging
+import os
+import sys
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+
+import config
+from crop_store import CropStore, crop_to_uint8, uint8_to_input
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import ingest  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+ProgressCallback = Callable[[int, int], None]
+
+
+def list_gallery_images(dataset_path: str) -> Dict[str, str]:
+    """Map image ID (file stem) to path for every image in the dataset directory."""
+    return {
+        Path(filename).stem: os.path.join(dataset_path, filename)
+        for filename in sorted(os.listdir(dataset_path))
+        if filename.lower().endswith(IMAGE_EXTENSIONS)
+    }
+
+
+def decode_image(image_path: str, max_side: int = config.ENROLL_MAX_SIDE) -> Optional[Image.Image]:
+    """Decode an image to RGB, downscaling so its longest side is at most ``max_side``.
+
+    Large JPEGs are decoded at reduced scale (see common/ingest.py).
+    """
+    try:
+        with open(image_path, 'rb') as f:
+            return ingest.decode_image(f.read(), 'RGB', max_side=max_side)
+    except Exception as e:
+        logger.error(f"Error decoding {image_path}: {e}")
+        return None
+
+
+def detect_faces(mtcnn, images: List[Image.Image]) -> List[Optional[torch.Tensor]]:
+    """Run MTCNN over a list of images, batching images that share a size.
+
+    MTCNN can only stack equally sized images into one batch, so images are
+    grouped by size and each group is detected in a single call. Returns the
+    aligned crop of the face MTCNN selects, or None, per image (also when
+    detection failed for it).
+    """
+    return [faces[0][0] if faces else None for faces in detect_faces_with_boxes(mtcnn, images)]
+
+
+def detect_faces_with_boxes(mtcnn, images: List[Image.Image],
+                            keep_all: bool = False) -> List[Optional[List[Tuple[torch.Tensor, List[float], float]]]]:
+    """Detect faces with their boxes and probabilities, batching images that share a size.
+
+    Returns ``(crop, [x1, y1, x2, y2], probability)`` per face for each image.
+    With ``keep_all`` every detected face is returned, otherwise only the one
+    MTCNN would pick itself, so the crop matches ``detect_faces``.
+
+    MTCNN raises on images too small for its smallest scale (a few pixels, or
+    3x3000). When a size group fails, its images are detected one at a time,
+    and only an image that fails on its own gets None instead of a list.
+    """
+    detections: List[Optional[List[Tuple[torch.Tensor, List[float], float]]]] = [[] for _ in images]
+    groups = defaultdict(list)
+    for position, img in enumerate(images):
+        groups[img.size].append(position)
+    for size, positions in groups.items():
+        try:
+            results = detect_face_batch(mtcnn, [images[p] for p in positions], keep_all)
+        except Exception as e:
+            logger.warning(f"Face detection failed for {len(positions)} images of size {size}: {e}")
+            # Retry one at a time, so only the images that cannot be detected lose their result
+            results = [_detect_one(mtcnn, images[p], keep_all) for p in positions] if len(positions) > 1 else [None]
+        for position, faces in zip(positions, results):
+            detections[position] = faces
+    return detections
+
+
+def _detect_one(mtcnn, img: Image.Image, keep_all: bool) -> Optional[List[Tuple[torch.Tensor, List[float], float]]]:
+    try:
+        return detect_face_batch(mtcnn, [img], keep_all)[0]
+    except Exception as e:
+        logger.warning(f"Face detection failed for an image of size {img.size}: {e}")
+        return None
+
+
+def detect_face_batch(mtcnn, batch, keep_all: bool = False) -> List[List[Tuple[torch.Tensor, List[float], float]]]:
+    """``detect_faces_with_boxes`` for one batch of equally sized images.
+
+    ``batch`` is a list of PIL images or an ``(N, H, W, 3)`` uint8 tensor, such
+    as generator output that was never encoded to an image file.
+    """
+    from facenet_pytorch.models.mtcnn import fixed_image_standardization
+    from facenet_pytorch.models.utils.detect_face import extract_face
+
+    boxes, probs = mtcnn.detect(batch)
+    detections = []
+    for img, image_boxes, image_probs in zip(batch, boxes, probs):
+        faces = []
+        if image_boxes is not None:
+            if not keep_all:
+                # MTCNN.select_boxes fails on batches mixing images with and without faces, so select here
+                if mtcnn.selection_method == 'probability':
+                    best = int(np.argmax(image_probs))
+                else:
+                    best = int(np.argmax((image_boxes[:, 2] - image_boxes[:, 0]) * (image_boxes[:, 3] - image_boxes[:, 1])))
+                image_boxes, image_probs = image_boxes[[best]], image_probs[[best]]
+            for box, prob in zip(image_boxes, image_probs):
+                face = extract_face(img, box, mtcnn.image_size, mtcnn.margin)
+                if mtcnn.post_process:
+                    face = fixed_image_standardization(face)
+                faces.append((face, [float(v) for v in box], float(prob)))
+        detections.append(faces)
+    return detections
+
+
+def embed_faces(resnet, faces: List[torch.Tensor], device) -> np.ndarray:
+    """Embed a batch of aligned face crops in one forward pass."""
+    with torch.no_grad():
+        return resnet(torch.stack(faces).to(device)).cpu().numpy()
+
+
+def enroll_images(image_paths: Dict[str, str], mtcnn, resnet, device,
+                  batch_size: int = config.ENROLL_BATCH_SIZE,
+                  workers: int = config.ENROLL_WORKERS,
+                  max_side: int = config.ENROLL_MAX_SIDE,
+                  progress: Optional[ProgressCallback] = None,
+                  crop_store: Optional[CropStore] = None) -> Iterator[Tuple[str, Optional[np.ndarray]]]:
+    """Embed gallery images with a three-stage pipeline.
+
+    A thread pool decodes and resizes images ahead of the consumer, MTCNN
+    detects faces over each chunk of ``batch_size`` decoded images, and
+    InceptionResnetV1 embeds the detected crops in batches. Yields
+    ``(image_id, embedding)`` per image, with ``None`` when no face was found.
+    Images whose detection failed (see ``detect_faces_with_boxes``) are not
+    yielded, so the caller leaves them as they were and retries them next run.
+
+    With a ``crop_store``, images whose file is unchanged since their crop was
+    stored are neither decoded nor detected, and new detections are added to
+    the store (the caller saves it).
+    """
+    items = list(image_paths.items())
+    total = len(items)
+    done = 0
+    start = time.perf_counter()
+    stored = {image_id for image_id, path in items if crop_store is not None and crop_store.is_current(image_id, path)}
+    if stored:
+        logger.info(f"Reusing stored face crops for {len(stored)}/{total} images")
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        # Keep up to two chunks of decodes in flight so decoding overlaps detection
+        # and embedding without holding the whole gallery in memory
+        pending = deque()
+        submitted = 0
+
+        def prefetch(limit: int):
+            nonlocal submitted
+            while submitted < min(limit, total):
+                image_id, path = items[submitted]
+                pending.append(None if image_id in stored else pool.submit(decode_image, path, max_side))
+                submitted += 1
+
+        for chunk_start in range(0, total, batch_size):
+            chunk = items[chunk_start:chunk_start + batch_size]
+            prefetch(chunk_start + 2 * batch_size)
+            decodes = [pending.popleft() for _ in chunk]
+            images = [decode.result() if decode is not None else None for decode in decodes]
+
+            faces: List[Optional[torch.Tensor]] = [None] * len(chunk)
+            reused = [i for i, (image_id, _) in enumerate(chunk)
+                      if image_id in stored and crop_store.entries[image_id]["slot"] is not None]
+            if reused:
+                crops = uint8_to_input(crop_store.crops([chunk[i][0] for i in reused]))
+                for i, face in zip(reused, crops):
+                    faces[i] = face
+
+            valid = [i for i, img in enumerate(images) if img is not None]
+            failed = set()
+            for i, detections in zip(valid, detect_faces_with_boxes(mtcnn, [images[i] for i in valid])):
+                image_id, path = chunk[i]
+                if detections is None:
+                    failed.add(i)
+                elif detections:
+                    faces[i], box, probability = detections[0]
+                    if crop_store is not None:
+                        crop_store.put(image_id, crop_to_uint8(faces[i], mtcnn.post_process), box, probability, path)
+                elif crop_store is not None:
+                    crop_store.put(image_id, None, path=path)
+
+            detected = [i for i, face in enumerate(faces) if face is not None]
+            embeddings = {}
+            if detected:
+                vectors = embed_faces(resnet, [faces[i] for i in detected], device)
+                embeddings = dict(zip(detected, vectors))
+
+            for i, (image_id, _) in enumerate(chunk):
+                if i not in failed:
+                    yield image_id, embeddings.get(i)
+
+            done += len(chunk)
+            if progress is not None:
+                progress(done, total)
+            elapsed = time.perf_counter() - start
+            logger.info(f"Enrolled {done}/{total} images ({done / elapsed:.1f} images/sec)")
+
+    elapsed = time.perf_counter() - start
+    if total:
+        logger.info(f"Enrollment finished: {total} images in {elapsed:.1f}s ({total / elapsed:.1f} images/sec)")
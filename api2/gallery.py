@@ -0,0 +1,260 @@
+import threading
+import numpy as np
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+class GalleryIndex:
+    """In-memory gallery of L2-normalized embeddings stored as one contiguous matrix.
+
+    Rows are kept packed in ``_matrix[:len(self)]`` with a parallel list of IDs, so
+    a query is a single matrix-vector product followed by a partial selection.
+    Removing an entry moves the last row into the freed slot to keep rows packed.
+    Mutations and searches take an internal lock, so the gallery can be updated
+    in place while it is being queried.
+
+    A gallery opened from an embedding store searches the read-only memory map
+    directly and only copies it into private memory on the first mutation.
+    """
+
+    # Rows scored per block when the matrix is not float32, to bound the upcast copy
+    SEARCH_BLOCK_ROWS = 65536
+    # How ``search_fused`` combines the scores of several queries for one gallery entry
+    FUSE_MODES = ("max", "mean")
+    # Filtered searches score only the allowed rows when they are at most this fraction of the gallery
+    # (pre-filtering); above it, gathering them costs more than scoring every row and masking the rest
+    PREFILTER_SELECTIVITY = 0.25
+
+    def __init__(self, dim: int = 512, capacity: int = 1024):
+        self.dim = dim
+        self._matrix = np.zeros((max(capacity, 1), dim), dtype=np.float32)
+        self._ids: List[str] = []
+        self._rows: Dict[str, int] = {}
+        self._lock = threading.RLock()
+        self._writable = True
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, image_id: str) -> bool:
+        return image_id in self._rows
+
+    @property
+    def ids(self) -> List[str]:
+        """IDs in row order."""
+        return self._ids
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """View of the packed, normalized embedding rows."""
+        return self._matrix[:len(self._ids)]
+
+    @staticmethod
+    def _normalize(embedding: np.ndarray) -> Optional[np.ndarray]:
+        vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(vector)
+        if not np.isfinite(norm) or norm == 0:
+            return None
+        return vector / norm
+
+    def _grow(self, needed: int):
+        capacity = max(self._matrix.shape[0], 1)
+        if needed <= capacity and self._writable:
+            return
+        while capacity < needed:
+            capacity *= 2
+        grown = np.zeros((capacity, self.dim), dtype=np.float32)
+        grown[:len(self._ids)] = self.matrix
+        self._matrix = grown
+        self._writable = True
+
+    def add(self, image_id: str, embedding: np.ndarray) -> bool:
+        """Insert or replace the embedding for ``image_id``. Returns False for a zero vector."""
+        with self._lock:
+            vector = self._normalize(embedding)
+            if vector is None or vector.shape[0] != self.dim:
+                return False
+            row = self._rows.get(image_id)
+            self._grow(len(self._ids) + (row is None))
+            if row is None:
+                row = len(self._ids)
+                self._ids.append(image_id)
+                self._rows[image_id] = row
+            self._matrix[row] = vector
+            return True
+
+    def add_many(self, items: Iterable[Tuple[str, np.ndarray]]) -> int:
+        """Insert several ``(image_id, embedding)`` pairs. Returns the number stored."""
+        return sum(1 for image_id, embedding in items if self.add(image_id, embedding))
+
+    def remove(self, image_id: str) -> bool:
+        """Remove ``image_id`` from the gallery. Returns False if it was not present."""
+        with self._lock:
+            if image_id not in self._rows:
+                return False
+            self._grow(len(self._ids))
+            row = self._rows.pop(image_id)
+            last = len(self._ids) - 1
+            if row != last:
+                moved_id = self._ids[last]
+                self._matrix[row] = self._matrix[last]
+                self._ids[row] = moved_id
+                self._rows[moved_id] = row
+            self._ids.pop()
+            return True
+
+    def clear(self):
+        """Remove every entry, keeping the allocated capacity."""
+        with self._lock:
+            self._ids = []
+            self._rows = {}
+
+    def get(self, image_id: str) -> Optional[np.ndarray]:
+        """Return a copy of the stored (normalized) embedding for ``image_id``."""
+        with self._lock:
+            row = self._rows.get(image_id)
+            return None if row is None else self._matrix[row].copy()
+
+    def rows_of(self, image_ids: Iterable[str]) -> np.ndarray:
+        """Sorted rows of the given IDs, skipping any that are not in the gallery (for ``rows`` arguments)."""
+        with self._lock:
+            return np.array(sorted(self._rows[image_id] for image_id in image_ids if image_id in self._rows),
+                            dtype=np.int64)
+
+    def _scores(self, query: np.ndarray) -> np.ndarray:
+        matrix = self.matrix
+        if matrix.dtype == np.float32:
+            return matrix @ query
+        scores = np.empty(len(matrix), dtype=np.float32)
+        for start in range(0, len(matrix), self.SEARCH_BLOCK_ROWS):
+            block = matrix[start:start + self.SEARCH_BLOCK_ROWS].astype(np.float32)
+            scores[start:start + len(block)] = block @ query
+        return scores
+
+    def _score_matrix(self, queries: np.ndarray) -> np.ndarray:
+        """``(m, n)`` scores of normalized ``(m, dim)`` queries against every row, one matrix product."""
+        matrix = self.matrix
+        if matrix.dtype == np.float32:
+            return queries @ matrix.T
+        scores = np.empty((len(queries), len(matrix)), dtype=np.float32)
+        for start in range(0, len(matrix), self.SEARCH_BLOCK_ROWS):
+            block = matrix[start:start + self.SEARCH_BLOCK_ROWS].astype(np.float32)
+            scores[:, start:start + len(block)] = queries @ block.T
+        return scores
+
+    def _candidate_scores(self, queries: np.ndarray, rows: Optional[np.ndarray]) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """Scores of the queries against the allowed ``rows`` (every row when None).
+
+        Returns ``(scores, columns)``, where ``columns`` maps score columns to
+        gallery rows, or is None when the columns are the gallery rows.
+        """
+        if rows is None:
+            return self._score_matrix(queries), None
+        if len(rows) <= self.PREFILTER_SELECTIVITY * len(self._ids):
+            return queries @ self.matrix[rows].astype(np.float32, copy=False).T, rows
+        # Post-filter inside the top-k: score every row and rule out the others before selecting
+        scores = self._score_matrix(queries)
+        excluded = np.ones(len(self._ids), dtype=bool)
+        excluded[rows] = False
+        scores[:, excluded] = -np.inf
+        return scores, None
+
+    def _top(self, scores: np.ndarray, k: int, threshold: Optional[float] = None,
+             columns: Optional[np.ndarray] = None) -> List[Tuple[str, float]]:
+        n = len(scores)
+        k = min(k, n)
+        if k < n:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(n)
+        top = top[np.argsort(-scores[top], kind="stable")]
+        if threshold is not None:
+            top = top[scores[top] >= threshold]
+        rows = top if columns is None else columns[top]
+        return [(self._ids[row], float(scores[i])) for row, i in zip(rows, top)]
+
+    def search(self, embedding: np.ndarray, k: int = 5) -> List[Tuple[str, float]]:
+        """Return the ``k`` most similar IDs by cosine similarity, best first."""
+        with self._lock:
+            n = len(self._ids)
+            query = self._normalize(embedding)
+            if n == 0 or k <= 0 or query is None:
+                return []
+            return self._top(self._scores(query), k)
+
+    def _normalize_many(self, embeddings: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Normalized rows of ``embeddings`` that are valid, and a mask of which rows those were."""
+        queries = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+        norms = np.linalg.norm(queries, axis=1)
+        valid = np.isfinite(norms) & (norms > 0)
+        return queries[valid] / norms[valid, None], valid
+
+    def search_many(self, embeddings: np.ndarray, k: int = 5, threshold: Optional[float] = None,
+                    rows: Optional[np.ndarray] = None) -> List[List[Tuple[str, float]]]:
+        """Top ``k`` per query row of ``embeddings``, scored in one matrix-matrix product.
+
+        Matches scoring below ``threshold`` are dropped; an invalid (zero) query gets an empty list.
+        With ``rows`` (sorted row numbers, e.g. from an attribute filter) only those rows can match.
+        """
+        with self._lock:
+            queries, valid = self._normalize_many(embeddings)
+            results = [[] for _ in range(len(valid))]
+            if rows is not None:
+                k = min(k, len(rows))
+            if not len(self._ids) or k <= 0 or not len(queries):
+                return results
+            scores, columns = self._candidate_scores(queries, rows)
+            for position, row_scores in zip(np.flatnonzero(valid), scores):
+                results[position] = self._top(row_scores, k, threshold, columns)
+            return results
+
+    def search_fused(self, embeddings: np.ndarray, k: int = 5, threshold: Optional[float] = None,
+                     mode: str = "max", rows: Optional[np.ndarray] = None) -> List[Tuple[str, float]]:
+        """Rank gallery entries by the ``max`` or ``mean`` of their scores over all query rows.
+
+        Used for several sketches or photos of one suspect: every entry is scored
+        against every query in one matrix-matrix product and ranked once.
+        """
+        if mode not in self.FUSE_MODES:
+            raise ValueError(f"Unknown fuse mode {mode!r}; expected one of {self.FUSE_MODES}")
+        with self._lock:
+            queries, _ = self._normalize_many(embeddings)
+            if rows is not None:
+                k = min(k, len(rows))
+            if not len(self._ids) or k <= 0 or not len(queries):
+                return []
+            scores, columns = self._candidate_scores(queries, rows)
+            fused = scores.max(axis=0) if mode == "max" else scores.mean(axis=0)
+            return self._top(fused, k, threshold, columns)
+
+    def to_dict(self) -> Dict[str, np.ndarray]:
+        """Export as the ``{image_id: embedding}`` dict used by ``embeddings.pkl``."""
+        with self._lock:
+            return {image_id: self._matrix[row].copy() for image_id, row in self._rows.items()}
+
+    @classmethod
+    def from_dict(cls, embeddings: Dict[str, np.ndarray]) -> "GalleryIndex":
+        """Build a gallery from an ``{image_id: embedding}`` dict."""
+        dim = len(next(iter(embeddings.values()))) if embeddings else 512
+        gallery = cls(dim=dim, capacity=len(embeddings))
+        gallery.add_many(embeddings.items())
+        return gallery
+
+    def copy(self) -> "GalleryIndex":
+        """A gallery with the same entries that copies the matrix on its first mutation.
+
+        Edit the copy and swap it in, so searches on this gallery never see rows move under them.
+        Both galleries share the matrix until then, so this one also copies it before its next mutation.
+        """
+        with self._lock:
+            self._writable = False
+            return GalleryIndex.from_matrix(self._ids, self.matrix)
+
+    @classmethod
+    def from_matrix(cls, ids: List[str], matrix: np.ndarray) -> "GalleryIndex":
+        """Wrap an already normalized ``(len(ids), dim)`` matrix, e.g. a store memory map, without copying."""
+        gallery = cls(dim=matrix.shape[1], capacity=1)
+        gallery._matrix = matrix
+        gallery._ids = list(ids)
+        gallery._rows = {image_id: row for row, image_id in enumerate(gallery._ids)}
+        gallery._writable = False
+        return gallery
@@ -0,0 +1,106 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Dict, Iterable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def file_sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    """SHA-256 of a file's contents, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class EnrollmentManifest:
+    """Record of which gallery files have been embedded, and with which model.
+
+    Each entry stores the file path, size, mtime, content hash, model version
+    and whether a face was found. A re-index only embeds files whose entry is
+    missing or no longer matches, and drops entries for files that are gone.
+    Size and mtime are checked first so unchanged files are never re-read.
+    """
+
+    def __init__(self, model_version: str, entries: Dict[str, dict] = None):
+        self.model_version = model_version
+        self.entries: Dict[str, dict] = entries or {}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @classmethod
+    def load(cls, path: str, model_version: str) -> "EnrollmentManifest":
+        """Load the manifest at ``path``, or start an empty one if it is missing or unreadable."""
+        if not os.path.exists(path):
+            return cls(model_version)
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            return cls(model_version, data.get("entries", {}))
+        except Exception as e:
+            logger.error(f"Error loading manifest {path}, starting empty: {e}")
+            return cls(model_version)
+
+    def save(self, path: str):
+        """Write the manifest atomically."""
+        # Per process, so workers saving at the same time never write into one temporary file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({"model_version": self.model_version, "entries": self.entries}, f)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def clear(self):
+        self.entries = {}
+
+    def record(self, image_id: str, path: str, embedded: bool, sha256: str = None):
+        """Mark ``image_id`` as processed from ``path`` with the current model."""
+        stat = os.stat(path)
+        self.entries[image_id] = {
+            "path": path,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": sha256 or file_sha256(path),
+            "model_version": self.model_version,
+            "embedded": embedded,
+        }
+
+    def discard(self, image_id: str):
+        self.entries.pop(image_id, None)
+
+    def _is_current(self, image_id: str, path: str, enrolled: bool) -> bool:
+        entry = self.entries.get(image_id)
+        if (entry is None or entry["model_version"] != self.model_version
+                or entry["path"] != path or entry["embedded"] != enrolled):
+            return False
+        stat = os.stat(path)
+        if entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            return True
+        # Touched but possibly not modified: fall back to the content hash
+        if entry["size"] == stat.st_size and file_sha256(path) == entry["sha256"]:
+            entry["mtime_ns"] = stat.st_mtime_ns
+            return True
+        return False
+
+    def diff(self, image_paths: Dict[str, str], enrolled_ids: Iterable[str]) -> Tuple[Dict[str, str], List[str]]:
+        """Compare the dataset listing with the manifest and the enrolled gallery IDs.
+
+        Returns ``(to_embed, to_remove)``: files that are new, changed or were
+        embedded with another model version, and gallery IDs whose file is gone.
+        """
+        enrolled = set(enrolled_ids)
+        to_embed = {
+            image_id: path for image_id, path in image_paths.items()
+            if not self._is_current(image_id, path, image_id in enrolled)
+        }
+        to_remove = sorted(enrolled.difference(image_paths))
+        for image_id in set(self.entries).difference(image_paths):
+            self.discard(image_id)
+        return to_embed, to_remove
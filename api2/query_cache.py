@@ -0,0 +1,120 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+def content_key(image_bytes: bytes, model_version: str = "") -> str:
+    """Cache key for an uploaded image: the SHA-256 of the model version and the image bytes."""
+    digest = hashlib.sha256(model_version.encode())
+    digest.update(b"\0")
+    digest.update(image_bytes)
+    return digest.hexdigest()
+
+
+class _Entry:
+    __slots__ = ("embedding", "results", "gallery_version", "expires_at")
+
+    def __init__(self, embedding: Optional[np.ndarray], expires_at: float):
+        self.embedding = embedding
+        self.results = {}
+        self.gallery_version = None
+        self.expires_at = expires_at
+
+
+class QueryCache:
+    """LRU cache of query embeddings and top-k results, keyed by image content hash.
+
+    An entry holds the face embedding of an upload (or ``None`` when no face
+    was found) and its search results per ``k``. Results are tagged with the
+    gallery version they were computed against and are ignored once the gallery
+    changes, while the embedding stays valid; the model version is part of
+    the key (see ``content_key``), so embeddings never cross model versions.
+    Entries expire ``ttl_seconds`` after they were stored, and the least
+    recently used entry is evicted beyond ``max_entries``.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 600.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.embedding_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _lookup(self, key: str) -> Optional[_Entry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at < time.monotonic():
+            del self._entries[key]
+            self.evictions += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def get_results(self, key: str, k: int, gallery_version: int) -> Optional[List[Tuple[str, float]]]:
+        """Cached top-``k`` results for ``key`` if they were computed against ``gallery_version``."""
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is not None and entry.gallery_version == gallery_version and k in entry.results:
+                self.hits += 1
+                return entry.results[k]
+            return None
+
+    def get_embedding(self, key: str) -> Tuple[bool, Optional[np.ndarray]]:
+        """``(found, embedding)`` for ``key``; ``embedding`` is None for a cached no-face result."""
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self.embedding_hits += 1
+            return True, entry.embedding
+
+    def put_embedding(self, key: str, embedding: Optional[np.ndarray]):
+        """Store the embedding for ``key`` (``None`` when no face was detected)."""
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = _Entry(embedding, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def put_results(self, key: str, k: int, gallery_version: int, results: List[Tuple[str, float]]):
+        """Attach top-``k`` results computed against ``gallery_version`` to an existing entry."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            if entry.gallery_version != gallery_version:
+                entry.results = {}
+                entry.gallery_version = gallery_version
+            entry.results[k] = results
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.embedding_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "result_hits": self.hits,
+            "embedding_hits": self.embedding_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": (self.hits + self.embedding_hits) / lookups if lookups else 0.0,
+        }
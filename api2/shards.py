@@ -0,0 +1,371 @@
+"""Sharded gallery: embedding stores partitioned by ID hash, served by shard processes.
+
+Each shard is an exact :class:`GalleryIndex` over its own embedding store
+file, served by :func:`serve_shard` over ``multiprocessing.connection``
+(authenticated with a shared key; messages are pickled, so only expose
+shards on a trusted network). A shard only listens on a non-loopback
+address when ``API2_SHARD_AUTHKEY`` is set; local shard processes get a
+random key. A shard reloads its store by itself when the file changes, or
+when the coordinator asks it to after rewriting that shard, so shards never
+have to restart together. Shards on other hosts (``API2_SHARD_ADDRESSES``)
+cannot see the coordinator's files; the coordinator sends them their rows
+instead (:meth:`ShardedGallery.push`), which they write to their own store.
+
+:class:`ShardedGallery` is the coordinator side. It sends every query to
+all shards in parallel and merges their local top-k into the global top-k.
+Since each gallery entry lives in exactly one shard and is scored the same
+way there, the merged result equals an unsharded exact search (up to the
+order of equal scores). Filtered searches send each shard the allowed IDs
+that hash to it, so the filter is applied inside every shard's top-k.
+
+Shard processes can run locally (see :func:`start_local_shards`) or on
+other hosts::
+
+    python shards.py partition --store embeddings.emb --count 4
+    API2_SHARD_AUTHKEY=... python shards.py serve --shard 0 --count 4 --listen 0.0.0.0:7100
+"""
+import argparse
+import heapq
+import ipaddress
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Client, Listener
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import config
+from embedding_store import open_store, write_store
+from gallery import GalleryIndex
+
+logger = logging.getLogger(__name__)
+
+Address = Tuple[str, int]
+
+
+class ShardError(RuntimeError):
+    """A shard could not be reached or failed to answer a request."""
+
+
+def shard_of(image_id: str, count: int) -> int:
+    """Stable shard number of an ID (CRC32, unlike ``hash()`` the same in every process)."""
+    return zlib.crc32(image_id.encode("utf-8")) % count
+
+
+def shard_store_path(shard: int, count: int, template: str = config.SHARD_STORE_TEMPLATE) -> str:
+    return template.format(shard=shard, count=count)
+
+
+def parse_address(address: str) -> Address:
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def is_loopback(host: str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def write_shard_stores(ids: Sequence[str], matrix: np.ndarray, count: int, template: str = config.SHARD_STORE_TEMPLATE,
+                       shards: Optional[Sequence[int]] = None, dtype=config.EMBEDDINGS_DTYPE,
+                       model_version: Optional[str] = None) -> List[int]:
+    """Partition a gallery by ID hash and write one store per shard.
+
+    Only the ``shards`` listed are rewritten (all by default), so shards whose
+    entries did not change keep their file and do not reload. Returns the
+    shard numbers written.
+    """
+    written = []
+    for shard, shard_ids, rows in partition(ids, count, shards):
+        write_store(shard_store_path(shard, count, template), shard_ids, matrix[rows], dtype=dtype,
+                    model_version=model_version)
+        written.append(shard)
+    return written
+
+
+def partition(ids: Sequence[str], count: int, shards: Optional[Sequence[int]] = None):
+    """Yield ``(shard, ids, rows)`` for every shard (or the ``shards`` listed): its IDs and their gallery rows."""
+    assignment = np.fromiter((shard_of(image_id, count) for image_id in ids), dtype=np.int64, count=len(ids))
+    for shard in (range(count) if shards is None else sorted(set(shards))):
+        rows = np.flatnonzero(assignment == shard)
+        yield shard, [ids[row] for row in rows], rows
+
+
+class ShardServer:
+    """One shard: an exact gallery over a store file that follows changes to that file."""
+
+    def __init__(self, shard: int, count: int, store_path: str,
+                 reload_interval: float = config.STORE_RELOAD_INTERVAL):
+        self.shard = shard
+        self.count = count
+        self.store_path = store_path
+        self.reload_interval = reload_interval
+        self.gallery = GalleryIndex()
+        self.store_mtime_ns = None
+        self.checked_at = 0.0
+        self.reloads = 0
+        self._reload_lock = threading.Lock()
+
+    def reload(self, force: bool = False) -> bool:
+        """Re-map the store if it changed on disk (or unconditionally with ``force``)."""
+        with self._reload_lock:
+            self.checked_at = time.monotonic()
+            try:
+                mtime_ns = os.stat(self.store_path).st_mtime_ns
+            except FileNotFoundError:
+                return False
+            if not force and mtime_ns == self.store_mtime_ns:
+                return False
+            ids, matrix, _ = open_store(self.store_path)
+            self.gallery = GalleryIndex.from_matrix(ids, matrix)
+            self.store_mtime_ns = mtime_ns
+            self.reloads += 1
+            logger.info(f"Shard {self.shard}/{self.count} loaded {len(ids)} embeddings from {self.store_path}")
+            return True
+
+    def maybe_reload(self):
+        if time.monotonic() - self.checked_at >= self.reload_interval:
+            self.reload()
+
+    def replace(self, ids: List[str], matrix: np.ndarray, model_version: Optional[str] = None) -> int:
+        """Write rows sent by the coordinator to this shard's store and serve them."""
+        write_store(self.store_path, ids, matrix, dtype=matrix.dtype, model_version=model_version)
+        self.reload(force=True)
+        return len(ids)
+
+    def handle(self, method: str, kwargs: dict):
+        if method == "reload":
+            return self.reload(force=True)
+        if method == "replace":
+            return self.replace(**kwargs)
+        self.maybe_reload()
+        gallery = self.gallery
+        if "ids" in kwargs:
+            # A filtered search: the coordinator sends the allowed IDs of this shard
+            kwargs["rows"] = gallery.rows_of(kwargs.pop("ids"))
+        if method == "search_many":
+            return gallery.search_many(**kwargs)
+        if method == "search_fused":
+            return gallery.search_fused(**kwargs)
+        if method == "info":
+            return {"shard": self.shard, "count": self.count, "size": len(gallery),
+                    "store_path": self.store_path, "reloads": self.reloads}
+        raise ValueError(f"Unknown shard method {method!r}")
+
+    def _serve_connection(self, connection):
+        with connection:
+            while True:
+                try:
+                    method, kwargs = connection.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    reply = ("ok", self.handle(method, kwargs))
+                except Exception as e:
+                    logger.error(f"Shard {self.shard} failed {method}: {e}")
+                    reply = ("error", str(e))
+                connection.send(reply)
+
+    def serve_forever(self, address: Address, authkey: bytes):
+        if not is_loopback(address[0]) and not config.SHARD_AUTHKEY:
+            raise ShardError(f"Refusing to listen on {address[0]} without API2_SHARD_AUTHKEY set")
+        self.reload(force=True)
+        with Listener(address, authkey=authkey) as listener:
+            logger.info(f"Shard {self.shard}/{self.count} listening on {address[0]}:{address[1]}")
+            while True:
+                try:
+                    connection = listener.accept()
+                except (OSError, EOFError) as e:
+                    # Failed handshake, e.g. a client with the wrong key
+                    logger.warning(f"Shard {self.shard} rejected a connection: {e}")
+                    continue
+                threading.Thread(target=self._serve_connection, args=(connection,), daemon=True).start()
+
+
+def serve_shard(shard: int, count: int, store_path: str, address: Address, authkey: bytes):
+    """Process entry point for one shard."""
+    logging.basicConfig(level=logging.INFO)
+    ShardServer(shard, count, store_path).serve_forever(address, authkey)
+
+
+def start_local_shards(count: int, authkey: bytes, base_port: int = config.SHARD_BASE_PORT,
+                       template: str = config.SHARD_STORE_TEMPLATE) -> Tuple[List[Address], list]:
+    """Spawn one shard process per shard on localhost; returns their addresses and processes."""
+    context = multiprocessing.get_context("spawn")
+    addresses, processes = [], []
+    for shard in range(count):
+        address = ("127.0.0.1", base_port + shard)
+        process = context.Process(target=serve_shard, name=f"gallery-shard-{shard}", daemon=True,
+                                  args=(shard, count, shard_store_path(shard, count, template), address, authkey))
+        process.start()
+        addresses.append(address)
+        processes.append(process)
+    return addresses, processes
+
+
+class ShardedGallery:
+    """Coordinator that scatters searches over shard processes and merges their top-k.
+
+    Offers the search methods of :class:`GalleryIndex` (``search``,
+    ``search_many``, ``search_fused``), so it can stand in as the search index.
+    Each shard has a small pool of connections, so concurrent requests do not
+    queue behind one socket.
+    """
+
+    def __init__(self, addresses: Sequence[Address], authkey: bytes, connect_timeout: float = 60.0):
+        self.addresses = list(addresses)
+        self.authkey = authkey
+        self.connect_timeout = connect_timeout
+        self._pools = [queue.LifoQueue() for _ in self.addresses]
+        # Shards connected to at least once; only the first connection waits for a shard to come up
+        self._connected = [False] * len(self.addresses)
+        self._executor = ThreadPoolExecutor(max_workers=max(1, len(self.addresses)), thread_name_prefix="shard-rpc")
+
+    def _connect(self, shard: int):
+        deadline = time.monotonic() + (0 if self._connected[shard] else self.connect_timeout)
+        while True:
+            try:
+                connection = Client(self.addresses[shard], authkey=self.authkey)
+                self._connected[shard] = True
+                return connection
+            except (ConnectionRefusedError, FileNotFoundError) as e:
+                # Local shard processes may still be starting
+                if time.monotonic() > deadline:
+                    raise ShardError(f"Shard {shard} at {self.addresses[shard]} is unreachable: {e}")
+                time.sleep(0.2)
+            except (OSError, EOFError, multiprocessing.AuthenticationError) as e:
+                raise ShardError(f"Shard {shard} at {self.addresses[shard]} is unreachable: {e}")
+
+    def call(self, shard: int, method: str, **kwargs):
+        """Send one request to one shard and return its reply."""
+        try:
+            connection = self._pools[shard].get_nowait()
+        except queue.Empty:
+            connection = self._connect(shard)
+        try:
+            connection.send((method, kwargs))
+            status, reply = connection.recv()
+        except (EOFError, OSError) as e:
+            connection.close()
+            raise ShardError(f"Shard {shard} connection failed: {e or 'connection closed'}")
+        self._pools[shard].put(connection)
+        if status != "ok":
+            raise ShardError(f"Shard {shard} {method} failed: {reply}")
+        return reply
+
+    def broadcast(self, method: str, **kwargs) -> list:
+        """Call every shard in parallel; replies are in shard order."""
+        futures = [self._executor.submit(self.call, shard, method, **kwargs) for shard in range(len(self.addresses))]
+        return [future.result() for future in futures]
+
+    def scatter(self, method: str, ids: Optional[Sequence[str]] = None, **kwargs) -> list:
+        """Call every shard, or with ``ids`` only the shards holding some of them, each with its own IDs."""
+        if ids is None:
+            return self.broadcast(method, **kwargs)
+        by_shard = {}
+        for image_id in ids:
+            by_shard.setdefault(shard_of(image_id, len(self.addresses)), []).append(image_id)
+        futures = [self._executor.submit(self.call, shard, method, ids=shard_ids, **kwargs)
+                   for shard, shard_ids in sorted(by_shard.items())]
+        return [future.result() for future in futures]
+
+    @staticmethod
+    def _merge(lists: Sequence[List[Tuple[str, float]]], k: int) -> List[Tuple[str, float]]:
+        return heapq.nlargest(k, (match for matches in lists for match in matches), key=lambda match: match[1])
+
+    def search_many(self, embeddings: np.ndarray, k: int = 5, threshold: Optional[float] = None,
+                    ids: Optional[Sequence[str]] = None) -> List[List[Tuple[str, float]]]:
+        """Top ``k`` per query over all shards; with ``ids`` only those entries can match."""
+        queries = np.asarray(embeddings, dtype=np.float32)
+        replies = self.scatter("search_many", ids, embeddings=queries, k=k, threshold=threshold)
+        if not replies:
+            return [[] for _ in range(len(queries))]
+        return [self._merge(per_shard, k) for per_shard in zip(*replies)]
+
+    def search(self, embedding: np.ndarray, k: int = 5) -> List[Tuple[str, float]]:
+        return self.search_many(np.asarray(embedding, dtype=np.float32).reshape(1, -1), k)[0]
+
+    def search_fused(self, embeddings: np.ndarray, k: int = 5, threshold: Optional[float] = None,
+                     mode: str = "max", ids: Optional[Sequence[str]] = None) -> List[Tuple[str, float]]:
+        # Fusion is per gallery entry, so each shard can fuse its own entries before the merge
+        replies = self.scatter("search_fused", ids, embeddings=np.asarray(embeddings, dtype=np.float32),
+                               k=k, threshold=threshold, mode=mode)
+        return self._merge(replies, k)
+
+    def reload(self, shards: Optional[Sequence[int]] = None):
+        """Ask the given shards (all by default) to re-map their stores now."""
+        shards = range(len(self.addresses)) if shards is None else shards
+        futures = [self._executor.submit(self.call, shard, "reload") for shard in shards]
+        for future in futures:
+            future.result()
+
+    def push(self, ids: Sequence[str], matrix: np.ndarray, shards: Optional[Sequence[int]] = None,
+             model_version: Optional[str] = None) -> List[int]:
+        """Send the given shards (all by default) their rows of a gallery to store and serve.
+
+        For shards that keep their own store file, e.g. on other hosts.
+        Returns the shard numbers sent.
+        """
+        futures = {shard: self._executor.submit(self.call, shard, "replace", ids=shard_ids,
+                                                matrix=np.ascontiguousarray(matrix[rows]),
+                                                model_version=model_version)
+                   for shard, shard_ids, rows in partition(ids, len(self.addresses), shards)}
+        for future in futures.values():
+            future.result()
+        return list(futures)
+
+    def info(self) -> list:
+        return self.broadcast("info")
+
+    def __len__(self) -> int:
+        return sum(reply["size"] for reply in self.info())
+
+    def close(self):
+        for pool in self._pools:
+            while not pool.empty():
+                pool.get_nowait().close()
+        self._executor.shutdown(wait=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Partition the embedding store into shards, or serve one shard.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    partition = commands.add_parser("partition", help="Split an embedding store into per-shard stores")
+    partition.add_argument("--store", default=config.EMBEDDINGS_PATH)
+    partition.add_argument("--count", type=int, default=config.SHARD_COUNT or 2)
+    partition.add_argument("--template", default=config.SHARD_STORE_TEMPLATE)
+
+    serve = commands.add_parser("serve", help="Serve one shard")
+    serve.add_argument("--shard", type=int, required=True)
+    serve.add_argument("--count", type=int, required=True)
+    serve.add_argument("--store", help="Shard store path; defaults to the shard store template")
+    serve.add_argument("--template", default=config.SHARD_STORE_TEMPLATE)
+    serve.add_argument("--listen", default=f"127.0.0.1:{config.SHARD_BASE_PORT}")
+    args = parser.parse_args()
+
+    if args.command == "partition":
+        ids, matrix, meta = open_store(args.store)
+        written = write_shard_stores(ids, matrix, args.count, args.template, dtype=matrix.dtype,
+                                     model_version=meta.get("model_version"))
+        for shard in written:
+            print(shard_store_path(shard, args.count, args.template))
+    else:
+        if not config.SHARD_AUTHKEY:
+            parser.error("serve needs API2_SHARD_AUTHKEY, the key the coordinator connects with")
+        store = args.store or shard_store_path(args.shard, args.count, args.template)
+        serve_shard(args.shard, args.count, store, parse_address(args.listen), config.SHARD_AUTHKEY.encode())
+
+
+if __name__ == "__main__":
+    main()
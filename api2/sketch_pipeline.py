@@ -0,0 +1,65 @@
+import io
+import logging
+import os
+import sys
+
+import torch
+from PIL import Image
+
+# The sketch-to-photo generator and its inference engines live in the api app next to this one
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(REPO_ROOT)
+sys.path.append(os.path.join(REPO_ROOT, "api"))
+from common.ingest import decode_image, to_tensor  # noqa: E402
+from generator import Generator  # noqa: E402
+from inference import GeneratorEngine, build_checked_engine  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+SKETCH_SIZE = 256
+IMAGE_FORMATS = {"png": ("PNG", "image/png"), "jpeg": ("JPEG", "image/jpeg")}
+
+
+def load_generator(weights_path: str, runtime: str = "eager", device=torch.device('cpu'),
+                   cache_dir: str = None) -> GeneratorEngine:
+    """Load the sketch-to-photo generator and wrap it in an inference engine (see api/inference.py).
+
+    Like the api app, a compiled engine (exported to ``cache_dir``) is only
+    used if it passes the parity check against the eager model.
+    """
+    model = Generator(in_channels=1, out_channels=3)
+    model.load_state_dict(torch.load(weights_path, map_location='cpu'))
+    model.eval()
+    if device.type != 'cpu':
+        return GeneratorEngine("eager", module=model.to(device))
+    try:
+        engine, parity = build_checked_engine(model, runtime, cache_dir=cache_dir)
+        logger.info(f"Sketch generator {runtime} engine parity {parity}")
+        return engine
+    except Exception as e:
+        logger.error(f"Could not build {runtime} sketch generator engine, using eager model: {e}")
+        return GeneratorEngine("eager", module=model)
+
+
+def preprocess_sketch(contents: bytes, out: torch.Tensor = None) -> torch.Tensor:
+    """Decode a sketch to the generator's normalized (1, 256, 256) grayscale input, like api/main.py."""
+    return to_tensor(decode_image(contents, 'L', size=(SKETCH_SIZE, SKETCH_SIZE)), out)
+
+
+def generate_photos(engine: GeneratorEngine, sketches: torch.Tensor) -> torch.Tensor:
+    """Generate photos for an (N, 1, 256, 256) batch as an (N, 256, 256, 3) uint8 tensor.
+
+    Rounded to 8 bits exactly as when encoding the photo, so face detection sees
+    the pixels it would have seen after a PNG round trip, without the encoding.
+    """
+    with torch.no_grad():
+        generated = engine(sketches).cpu()
+    generated = (generated * 0.5 + 0.5).clamp(0, 1)
+    return (generated.permute(0, 2, 3, 1) * 255).to(torch.uint8)
+
+
+def encode_photo(photo: torch.Tensor, image_format: str = "png") -> bytes:
+    """Encode one (256, 256, 3) uint8 photo; only needed when the client asks for the image."""
+    buffer = io.BytesIO()
+    Image.fromarray(photo.numpy()).save(buffer, format=IMAGE_FORMATS[image_format][0])
+    return buffer.getvalue()
@@ -0,0 +1,54 @@
+"""Compare two benchmark reports, e.g. from the parent commit and the current one.
+
+Results are matched on benchmark, variant and params. Exits with status 1 if
+any matched result's chosen percentile got slower by more than ``--threshold``.
+
+Example::
+
+    python benchmarks/compare.py baseline.json current.json --metric p95_ms --threshold 0.10
+"""
+import argparse
+import json
+import sys
+
+
+def result_key(record: dict) -> str:
+    return json.dumps([record["benchmark"], record["variant"], record["params"]], sort_keys=True)
+
+
+def compare(baseline: dict, current: dict, metric: str, threshold: float) -> list:
+    """Rows of (key, baseline value, current value, relative change, regressed) for matched results."""
+    previous = {result_key(r): r for r in baseline["results"]}
+    rows = []
+    for record in current["results"]:
+        before = previous.get(result_key(record))
+        if before is None or not before[metric]:
+            continue
+        change = record[metric] / before[metric] - 1
+        rows.append((result_key(record), before[metric], record[metric], change, change > threshold))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark JSON reports.")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--metric", default="p50_ms", choices=("mean_ms", "p50_ms", "p95_ms", "p99_ms"))
+    parser.add_argument("--threshold", type=float, default=0.10, help="Allowed relative slowdown")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    print(f"baseline {baseline['environment'].get('commit')} -> current {current['environment'].get('commit')}")
+    rows = compare(baseline, current, args.metric, args.threshold)
+    for key, before, after, change, regressed in rows:
+        print(f"{'REGRESSION' if regressed else 'ok':<10} {change:+8.1%} {before:10.3f} -> {after:10.3f} {key}")
+    regressions = sum(1 for row in rows if row[4])
+    print(f"{len(rows)} results compared on {args.metric}, {regressions} regressed by more than {args.threshold:.0%}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
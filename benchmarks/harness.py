@@ -0,0 +1,127 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from typing import Callable, List, Optional
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+API_DIR = os.path.join(REPO_ROOT, "api")
+API2_DIR = os.path.join(REPO_ROOT, "api2")
+# Face images shipped with the repo, used as queries and sketches
+DEFAULT_IMAGES_DIR = os.path.join(API2_DIR, "criminal_faces")
+
+# The apps use flat imports from their own directories; their module names do not overlap
+for path in (API_DIR, API2_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+def percentile_summary(latencies: List[float], elapsed: Optional[float] = None, items_per_call: int = 1) -> dict:
+    """p50/p95/p99/mean latency in ms and throughput in items per second.
+
+    ``latencies`` are per-call seconds. ``elapsed`` is the wall time of the
+    whole run; for sequential runs it defaults to the sum of the latencies.
+    """
+    values = np.asarray(latencies, dtype=np.float64) * 1000
+    elapsed = elapsed if elapsed is not None else float(np.sum(latencies))
+    p50, p95, p99 = np.percentile(values, [50, 95, 99]) if len(values) else (0.0, 0.0, 0.0)
+    return {
+        "count": len(values),
+        "mean_ms": float(values.mean()) if len(values) else 0.0,
+        "p50_ms": float(p50),
+        "p95_ms": float(p95),
+        "p99_ms": float(p99),
+        "throughput_per_s": len(values) * items_per_call / elapsed if elapsed else 0.0,
+    }
+
+
+def time_calls(fn: Callable[[int], object], repeat: int, warmup: int = 2) -> List[float]:
+    """Call ``fn(i)`` ``warmup`` times untimed, then ``repeat`` times; returns per-call seconds."""
+    for i in range(warmup):
+        fn(i)
+    latencies = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn(i)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def result(benchmark: str, variant: str, params: dict, summary: dict, **extra) -> dict:
+    """One result record; ``benchmark``, ``variant`` and ``params`` identify it across runs."""
+    record = {"benchmark": benchmark, "variant": variant, "params": params}
+    record.update(summary)
+    record.update(extra)
+    print(f"{benchmark:>10} {variant:<24} {json.dumps(params, sort_keys=True):<48} "
+          f"p50={summary['p50_ms']:9.3f}ms p95={summary['p95_ms']:9.3f}ms p99={summary['p99_ms']:9.3f}ms "
+          f"{summary['throughput_per_s']:10.1f}/s", file=sys.stderr)
+    return record
+
+
+def synthetic_gallery(size: int, dim: int = 512, seed: int = 0, block: int = 65536) -> np.ndarray:
+    """``(size, dim)`` float32 matrix of random unit vectors, generated blockwise to bound peak memory."""
+    rng = np.random.default_rng(seed)
+    matrix = np.empty((size, dim), dtype=np.float32)
+    for start in range(0, size, block):
+        rows = rng.standard_normal((min(block, size - start), dim), dtype=np.float32)
+        rows /= np.linalg.norm(rows, axis=1, keepdims=True)
+        matrix[start:start + len(rows)] = rows
+    return matrix
+
+
+def load_images(images_dir: str = DEFAULT_IMAGES_DIR, limit: int = 32) -> List[bytes]:
+    """Read up to ``limit`` image files from ``images_dir`` in name order."""
+    names = sorted(name for name in os.listdir(images_dir)
+                   if os.path.splitext(name)[1].lower() in (".jpg", ".jpeg", ".png"))[:limit]
+    if not names:
+        raise FileNotFoundError(f"No images found in {images_dir}")
+    images = []
+    for name in names:
+        with open(os.path.join(images_dir, name), "rb") as f:
+            images.append(f.read())
+    return images
+
+
+def environment() -> dict:
+    """Commit and machine details recorded with every report."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    info = {
+        "commit": commit,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+    }
+    try:
+        import torch
+        info.update(torch=torch.__version__, torch_threads=torch.get_num_threads())
+    except ImportError:
+        pass
+    try:
+        import faiss
+        info["faiss"] = faiss.__version__
+    except ImportError:
+        pass
+    return info
+
+
+def write_report(results: List[dict], output: Optional[str], **settings):
+    """Write ``{"environment", "settings", "results"}`` as JSON to ``output``, or stdout when it is None."""
+    report = {"environment": environment(), "settings": settings, "results": results}
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {len(results)} results to {output}", file=sys.stderr)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,150 @@
+"""In-process load test of the api (sketch-to-photo) and api2 (face search) apps.
+
+Each app runs inside this process through its own lifespan and an
+``httpx.ASGITransport``, so no server or network is involved. After the
+app reports ready, every concurrency level sends ``--requests`` requests from
+that many concurrent clients and records per-request latency. api2 searches
+a synthetic gallery of ``--gallery-size`` random unit vectors; its query
+cache is disabled unless ``--cache`` is given, so repeated images are not
+served from it. State api2 would write (store, manifest, index) goes to a
+temporary directory.
+
+Example::
+
+    python benchmarks/load.py --app api2 --concurrency 1 4 16 --random-weights --output load.json
+"""
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+import httpx
+
+from harness import DEFAULT_IMAGES_DIR, load_images, percentile_summary, result, synthetic_gallery, write_report
+
+APPS = ("api", "api2")
+
+
+async def wait_ready(client: httpx.AsyncClient, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        response = await client.get("/health/ready")
+        if response.status_code == 200:
+            return
+        body = response.json()
+        if body.get("error"):
+            raise RuntimeError(f"App failed to boot: {body['error']}")
+        await asyncio.sleep(0.2)
+    raise TimeoutError(f"App not ready after {timeout}s")
+
+
+async def run_level(client: httpx.AsyncClient, send, concurrency: int, requests: int):
+    """Send ``requests`` requests from ``concurrency`` workers; returns (latencies, errors, elapsed)."""
+    latencies, errors = [], 0
+    next_request = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in next_request:
+            start = time.perf_counter()
+            response = await send(client, i)
+            if response.status_code == 200:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return latencies, errors, time.perf_counter() - start
+
+
+async def load_app(name: str, app, send, params: dict, args) -> list:
+    results = []
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+            await wait_ready(client, args.ready_timeout)
+            if args.prepare is not None:
+                args.prepare()
+            for concurrency in args.concurrency:
+                # Untimed round so each level starts from a warm state
+                await run_level(client, send, concurrency, concurrency)
+                latencies, errors, elapsed = await run_level(client, send, concurrency, args.requests)
+                results.append(result("load", name, dict(params, concurrency=concurrency),
+                                      percentile_summary(latencies, elapsed), errors=errors))
+    return results
+
+
+def setup_api(args, images):
+    import torch
+    import main
+    from generator import Generator
+
+    if args.random_weights:
+        main.model_path = os.path.join(args.workdir, "G_random.pth")
+        torch.save(Generator(in_channels=1, out_channels=3).state_dict(), main.model_path)
+
+    async def send(client, i):
+        files = {"digitalImage": ("sketch.jpg", images[i % len(images)], "image/jpeg")}
+        return await client.post("/image/upload", files=files)
+
+    args.prepare = None
+    return main.app, send, {"endpoint": "/image/upload", "runtime": main.GENERATOR_RUNTIME}
+
+
+def setup_api2(args, images):
+    os.environ.setdefault("API2_EMBEDDINGS_PATH", os.path.join(args.workdir, "embeddings.emb"))
+    os.environ.setdefault("API2_LEGACY_EMBEDDINGS_PATH", os.path.join(args.workdir, "embeddings.pkl"))
+    os.environ.setdefault("API2_DATASET_PATH", os.path.join(args.workdir, "dataset"))
+    if not args.cache:
+        os.environ["API2_QUERY_CACHE_SIZE"] = "0"
+    if args.random_weights:
+        os.environ["API2_RESNET_PRETRAINED"] = ""
+    import api
+    from config import INDEX_TYPE
+    from gallery import GalleryIndex
+
+    def prepare():
+        matrix = synthetic_gallery(args.gallery_size)
+        api.publish(GalleryIndex.from_matrix([f"id{i}" for i in range(args.gallery_size)], matrix))
+
+    async def send(client, i):
+        files = {"file": ("query.jpg", images[i % len(images)], "image/jpeg")}
+        return await client.post("/find_similar/", files=files)
+
+    args.prepare = prepare
+    params = {"endpoint": "/find_similar/", "gallery_size": args.gallery_size, "cache": args.cache,
+              "index_type": INDEX_TYPE}
+    return api.app, send, params
+
+
+def main():
+    parser = argparse.ArgumentParser(description="In-process load test of the FastAPI apps.")
+    parser.add_argument("--app", choices=APPS, nargs="+", default=list(APPS))
+    parser.add_argument("--output", help="JSON report path; printed to stdout when omitted")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=64, help="Timed requests per concurrency level")
+    parser.add_argument("--gallery-size", type=int, default=10000)
+    parser.add_argument("--cache", action="store_true", help="Keep the api2 query cache enabled")
+    parser.add_argument("--random-weights", action="store_true",
+                        help="Use randomly initialized models; latency does not depend on the weights")
+    parser.add_argument("--images", default=DEFAULT_IMAGES_DIR)
+    parser.add_argument("--ready-timeout", type=float, default=600)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    images = load_images(args.images)
+    results = []
+    with tempfile.TemporaryDirectory(prefix="facetrace-bench-") as workdir:
+        args.workdir = workdir
+        for name in args.app:
+            app, send, params = {"api": setup_api, "api2": setup_api2}[name](args, images)
+            results.extend(asyncio.run(load_app(name, app, send, params, args)))
+    write_report(results, args.output, concurrency=args.concurrency, requests=args.requests,
+                 random_weights=args.random_weights)
+
+
+if __name__ == "__main__":
+    main()
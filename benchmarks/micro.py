@@ -0,0 +1,150 @@
+"""Micro-benchmarks of the CPU hot paths.
+
+* ``embedding``: api2 ``get_image_embedding`` (MTCNN + InceptionResnetV1 on one
+  upload) and ``embed_image_batch`` as used by the /find_similar/ batcher.
+* ``search``: ``compute_similarity`` over synthetic galleries of random unit
+  vectors, with the exact NumPy index and the FAISS indexes (``flat`` is the
+  inner-product search ``bnd/recognize_face.py`` runs). Compressed indexes are
+  timed with re-ranking at ``API2_RERANK_FACTOR``; ``api2/ann_index.py``
+  reports their recall and memory.
+* ``generator``: ``Generator.forward`` and the compiled inference engines of api.
+
+Example::
+
+    python benchmarks/micro.py --suite search --gallery-sizes 1000 100000 --output search.json
+"""
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+
+from harness import (API_DIR, DEFAULT_IMAGES_DIR, load_images, percentile_summary, result, synthetic_gallery,
+                     time_calls, write_report)
+
+SUITES = ("embedding", "search", "generator")
+
+
+def bench_embedding(args) -> list:
+    import api
+    api.load_models()
+    images = load_images(args.images, args.batch_size)
+    params = {"device": str(api.device), "random_weights": args.random_weights}
+
+    latencies = time_calls(lambda i: api.get_image_embedding(image_bytes=images[i % len(images)]), args.repeat)
+    results = [result("embedding", "get_image_embedding", params, percentile_summary(latencies))]
+
+    batch = [images[i % len(images)] for i in range(args.batch_size)]
+    latencies = time_calls(lambda i: api.embed_image_batch(batch), max(1, args.repeat // args.batch_size))
+    results.append(result("embedding", "embed_image_batch", dict(params, batch_size=args.batch_size),
+                          percentile_summary(latencies, items_per_call=args.batch_size)))
+    return results
+
+
+def bench_search(args) -> list:
+    from ann_index import COMPRESSED_TYPES, FaissIndex
+    from gallery import GalleryIndex
+
+    results = []
+    rng = np.random.default_rng(1)
+    for size in args.gallery_sizes:
+        matrix = synthetic_gallery(size, args.dim)
+        gallery = GalleryIndex.from_matrix([f"id{i}" for i in range(size)], matrix)
+        # Queries near gallery rows, like a probe of an enrolled identity
+        rows = rng.integers(0, size, args.repeat)
+        queries = matrix[rows] + rng.standard_normal((args.repeat, args.dim), dtype=np.float32) * 0.05
+        for index_type in args.index_types:
+            params = {"gallery_size": size, "dim": args.dim, "k": args.k}
+            if index_type == "exact":
+                index, build_seconds = gallery, 0.0
+            else:
+                index, build_seconds = _build_faiss(FaissIndex, gallery, index_type)
+                if index_type in COMPRESSED_TYPES:
+                    index.set_rerank(gallery.matrix)
+                params.update(index.params)
+            latencies = time_calls(lambda i: index.search(queries[i], args.k), args.repeat)
+            results.append(result("search", index_type, params, percentile_summary(latencies),
+                                  build_seconds=build_seconds))
+            del index
+    return results
+
+
+def _build_faiss(factory, gallery, index_type: str):
+    start = time.perf_counter()
+    index = factory.build(gallery, index_type)
+    return index, time.perf_counter() - start
+
+
+def bench_generator(args) -> list:
+    import torch
+    from generator import Generator
+    from inference import build_engine
+
+    model = Generator(in_channels=1, out_channels=3)
+    if not args.random_weights:
+        model.load_state_dict(torch.load(args.weights, map_location="cpu"))
+    model.eval()
+
+    results = []
+    for batch_size in args.generator_batch_sizes:
+        sketches = torch.rand(batch_size, 1, 256, 256) * 2 - 1
+        params = {"batch_size": batch_size, "threads": torch.get_num_threads(), "random_weights": args.random_weights}
+
+        def forward(_):
+            with torch.no_grad():
+                model(sketches)
+
+        latencies = time_calls(forward, args.generator_repeat)
+        results.append(result("generator", "forward", params,
+                              percentile_summary(latencies, items_per_call=batch_size)))
+        for runtime in args.runtimes:
+            engine = build_engine(model, runtime, int8=args.int8)
+            latencies = time_calls(lambda _: engine(sketches), args.generator_repeat)
+            variant = f"{runtime}-int8" if args.int8 and runtime == "onnxruntime" else runtime
+            results.append(result("generator", variant, params,
+                                  percentile_summary(latencies, items_per_call=batch_size)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of embedding, search and generation.")
+    parser.add_argument("--suite", choices=SUITES, nargs="+", default=list(SUITES))
+    parser.add_argument("--output", help="JSON report path; printed to stdout when omitted")
+    parser.add_argument("--repeat", type=int, default=200, help="Timed calls per embedding/search benchmark")
+    parser.add_argument("--threads", type=int, default=0, help="torch intra-op threads; 0 keeps the default")
+    parser.add_argument("--random-weights", action="store_true",
+                        help="Use randomly initialized models; latency does not depend on the weights")
+    parser.add_argument("--images", default=DEFAULT_IMAGES_DIR)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--gallery-sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("--index-types", nargs="+", choices=("exact", "flat", "ivf", "hnsw", "fp16", "sq8", "pq"),
+                        default=["exact", "flat"])
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--weights", default=os.path.join(API_DIR, "models", "G_sketch_to_photo_best.pth"))
+    parser.add_argument("--generator-batch-sizes", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--generator-repeat", type=int, default=20)
+    parser.add_argument("--runtimes", nargs="*", choices=("eager", "torchscript", "onnxruntime"), default=["eager"],
+                        help="Inference engines to time besides the plain forward pass")
+    parser.add_argument("--int8", action="store_true")
+    args = parser.parse_args()
+    if args.random_weights:
+        # api2's config reads this once, when the first suite imports any api2 module
+        os.environ["API2_RESNET_PRETRAINED"] = ""
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.threads > 0:
+        import torch
+        torch.set_num_threads(args.threads)
+
+    results = []
+    for suite in args.suite:
+        results.extend({"embedding": bench_embedding, "search": bench_search,
+                        "generator": bench_generator}[suite](args))
+    write_report(results, args.output, suite=args.suite, repeat=args.repeat, threads=args.threads,
+                 random_weights=args.random_weights)
+
+
+if __name__ == "__main__":
+    main()
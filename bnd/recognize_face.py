@@ -1,40 +1,68 @@
 import sys
 import json
 import os
+import argparse
+import threading
+import socket
+import socketserver
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import numpy as np
-import faiss
-import pickle
-from deepface import DeepFace
 import logging
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Load FAISS index and IDs
-try:
+# Where the long-lived worker listens; the CLI tries it before loading models itself
+SERVER_HOST = os.getenv('RECOGNIZE_FACE_HOST', '127.0.0.1')
+SERVER_PORT = int(os.getenv('RECOGNIZE_FACE_PORT', '5005'))
+SERVER_SOCKET = os.getenv('RECOGNIZE_FACE_SOCKET')
+CLIENT_TIMEOUT = float(os.getenv('RECOGNIZE_FACE_TIMEOUT', '60'))
+
+valid_extensions = ['.jpg', '.jpeg', '.png']
+
+# FAISS index, IDs and the DeepFace module, loaded once by load_resources()
+index = None
+ids = None
+DeepFace = None
+# DeepFace/TensorFlow calls are serialized across server threads
+model_lock = threading.Lock()
+
+
+def load_resources():
+    """Load the FAISS index, IDs and ArcFace weights once per process."""
+    global index, ids, DeepFace
+    if index is not None:
+        return
+    import faiss
+    import pickle
+    from deepface import DeepFace
+
     logger.info("Loading FAISS index and embeddings...")
-    index = faiss.read_index('faiss_index.bin')
+    loaded_index = faiss.read_index('faiss_index.bin')
     with open('embeddings.pickle', 'rb') as f:
         data = pickle.load(f)
-        ids = data['ids']
-    if index.ntotal != len(ids):
-        raise ValueError(f"FAISS index size ({index.ntotal}) does not match ids length ({len(ids)})")
+        loaded_ids = data['ids']
+    if loaded_index.ntotal != len(loaded_ids):
+        raise ValueError(f"FAISS index size ({loaded_index.ntotal}) does not match ids length ({len(loaded_ids)})")
+    # Build the ArcFace model now so the first query does not pay for it
+    DeepFace.build_model('ArcFace')
+    index, ids = loaded_index, loaded_ids
     logger.info("FAISS index and embeddings loaded successfully")
-except Exception as e:
-    logger.error(f"Error loading FAISS index or embeddings: {str(e)}")
-    sys.exit(1)
 
-def get_query_embedding(image_path):
+
+def get_query_embedding(image):
+    """Embed an image path or a decoded BGR array with ArcFace, L2-normalized, shape (1, d)."""
     try:
-        valid_extensions = ['.jpg', '.jpeg', '.png']
-        if not any(image_path.lower().endswith(ext) for ext in valid_extensions):
-            raise ValueError(f"Unsupported file format for {image_path}. Use JPG or PNG.")
-        embedding_list = DeepFace.represent(
-            img_path=image_path,
-            model_name='ArcFace',
-            enforce_detection=False
-        )
+        if isinstance(image, str) and not any(image.lower().endswith(ext) for ext in valid_extensions):
+            raise ValueError(f"Unsupported file format for {image}. Use JPG or PNG.")
+        with model_lock:
+            embedding_list = DeepFace.represent(
+                img_path=image,
+                model_name='ArcFace',
+                enforce_detection=False
+            )
         if not embedding_list or not isinstance(embedding_list, list) or not embedding_list[0].get('embedding'):
             raise ValueError("No valid embedding generated")
         embedding = np.array(embedding_list[0]['embedding'], dtype='float32')
@@ -42,39 +70,207 @@ def get_query_embedding(image_path):
         embedding = embedding / np.linalg.norm(embedding)
         return embedding.reshape(1, -1)
     except Exception as e:
-        logger.error(f"Error generating embedding for {image_path}: {str(e)}")
+        name = image if isinstance(image, str) else 'uploaded image'
+        logger.error(f"Error generating embedding for {name}: {str(e)}")
         return None
 
+
 def recognize_face(query_embedding):
+    """Search the FAISS index; raises ValueError on a malformed embedding."""
+    if query_embedding is None or query_embedding.shape != (1, index.d):
+        raise ValueError("Invalid query embedding shape")
+    distances, indices = index.search(query_embedding, 5)
+    matches = [
+        [ids[i], 1 / (1 + float(dist))]  # Maintain compatibility with router.js
+        for i, dist in zip(indices[0], distances[0])
+        if i < len(ids)
+    ]
+    matches = sorted(matches, key=lambda x: x[1], reverse=True)
+    return matches
+
+
+def recognize_image(image):
+    """Full query for one image path or BGR array: ``[[id, score], ...]``, or [] if no embedding."""
+    query_embedding = get_query_embedding(image)
+    if query_embedding is None:
+        return []
+    return recognize_face(query_embedding)
+
+
+class RecognizeHandler(BaseHTTPRequestHandler):
+    """HTTP API of the long-lived worker.
+
+    ``POST /recognize`` accepts raw image bytes (``Content-Type: image/*``),
+    ``{"path": ...}`` for one image, or ``{"paths": [...]}`` for a stream of
+    images, and answers with the same ``[[id, score], ...]`` JSON as the CLI
+    (a list of those for ``paths``). ``GET /health`` reports readiness.
+    """
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send_json(200, {'status': 'ok', 'gallery_size': len(ids)})
+        else:
+            self._send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        if self.path != '/recognize':
+            self._send_json(404, {'error': 'Not found'})
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.headers.get('Content-Type', '').startswith('image/'):
+                import cv2
+                image = cv2.imdecode(np.frombuffer(body, np.uint8), cv2.IMREAD_COLOR)
+                if image is None:
+                    raise ValueError("Could not decode image")
+                self._send_json(200, recognize_image(image))
+                return
+            request = json.loads(body or b'{}')
+            if 'paths' in request:
+                missing = [path for path in request['paths'] if not os.path.isfile(path)]
+                if missing:
+                    raise ValueError(f"Image files {', '.join(missing)} do not exist")
+                self._send_json(200, [recognize_image(path) for path in request['paths']])
+            elif 'path' in request:
+                if not os.path.isfile(request['path']):
+                    raise ValueError(f"Image file {request['path']} does not exist")
+                self._send_json(200, recognize_image(request['path']))
+            else:
+                raise ValueError("Expected image bytes, 'path' or 'paths'")
+        except ValueError as e:
+            self._send_json(400, {'error': str(e)})
+        except Exception as e:
+            logger.error(f"Error handling request: {str(e)}")
+            self._send_json(500, {'error': str(e)})
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ('local', 0)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def serve(host=SERVER_HOST, port=SERVER_PORT, socket_path=SERVER_SOCKET):
+    """Load models once and answer queries until interrupted."""
+    load_resources()
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, RecognizeHandler)
+        logger.info(f"Serving on unix socket {socket_path}")
+    else:
+        server = ThreadingHTTPServer((host, port), RecognizeHandler)
+        logger.info(f"Serving on http://{host}:{port}")
     try:
-        if query_embedding is None or query_embedding.shape != (1, index.d):
-            raise ValueError("Invalid query embedding shape")
-        distances, indices = index.search(query_embedding, 5)
-        matches = [
-            [ids[i], 1 / (1 + float(dist))]  # Maintain compatibility with router.js
-            for i, dist in zip(indices[0], distances[0])
-            if i < len(ids)
-        ]
-        matches = sorted(matches, key=lambda x: x[1], reverse=True)
-        return matches
-    except Exception as e:
-        logger.error(f"Error searching FAISS index: {str(e)}")
-        sys.exit(1)
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def query_server(image_path, host=SERVER_HOST, port=SERVER_PORT, socket_path=SERVER_SOCKET,
+                 timeout=CLIENT_TIMEOUT):
+    """Ask a running worker to recognize ``image_path``; returns None if no worker is listening.
+
+    A worker that is listening but fails or does not answer within ``timeout``
+    raises RuntimeError instead, so the caller does not load the models itself.
+    """
+    if socket_path:
+        connection = UnixHTTPConnection(socket_path, timeout)
+    else:
+        connection = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        body = json.dumps({'path': os.path.abspath(image_path)})
+        connection.request('POST', '/recognize', body=body, headers={'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        payload = json.loads(response.read())
+    except (ConnectionRefusedError, FileNotFoundError):
+        return None
+    except socket.timeout:
+        raise RuntimeError(f"No reply within {timeout:g}s")
+    except (json.JSONDecodeError, http.client.HTTPException) as e:
+        raise RuntimeError(f"Malformed reply: {str(e)}")
+    except OSError as e:
+        raise RuntimeError(f"Connection failed: {str(e)}")
+    finally:
+        connection.close()
+    if response.status != 200:
+        error = payload.get('error') if isinstance(payload, dict) else None
+        raise RuntimeError(error or f"HTTP {response.status}")
+    return payload
+
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
+    parser = argparse.ArgumentParser(description="Recognize a face against the FAISS gallery.")
+    parser.add_argument('image_path', nargs='?', help="Image to recognize (client mode)")
+    parser.add_argument('--serve', action='store_true', help="Run as a long-lived worker")
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--socket', default=SERVER_SOCKET, help="Unix socket to serve on or connect to, instead of TCP")
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.host, args.port, args.socket)
+        sys.exit(0)
+
+    if not args.image_path:
         logger.error("Expected one image path as argument")
         sys.exit(1)
 
-    image_path = sys.argv[1]
+    image_path = args.image_path
     if not os.path.isfile(image_path):
         logger.error(f"Image file {image_path} does not exist")
         sys.exit(1)
 
-    query_embedding = get_query_embedding(image_path)
-    if query_embedding is None:
-        print(json.dumps([]))
-        sys.exit(0)
+    try:
+        matches = query_server(image_path, args.host, args.port, args.socket)
+    except RuntimeError as e:
+        logger.error(f"Recognition worker error: {str(e)}")
+        sys.exit(1)
+
+    if matches is None:
+        # No worker running: load everything in this process, as before
+        try:
+            load_resources()
+        except Exception as e:
+            logger.error(f"Error loading FAISS index or embeddings: {str(e)}")
+            sys.exit(1)
+        query_embedding = get_query_embedding(image_path)
+        if query_embedding is None:
+            print(json.dumps([]))
+            sys.exit(0)
+        try:
+            matches = recognize_face(query_embedding)
+        except Exception as e:
+            logger.error(f"Error searching FAISS index: {str(e)}")
+            sys.exit(1)
 
-    matches = recognize_face(query_embedding)
-    print(json.dumps(matches))
\ No newline at end of file
+    print(json.dumps(matches))
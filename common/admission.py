@@ -0,0 +1,199 @@
+"""Admission control for model work, shared by api and api2.
+
+An :class:`AdmissionController` lets at most ``max_concurrency`` requests
+run model work at once and queues up to ``max_queue`` more, in arrival order.
+When a request cannot be served in time, it is turned away early instead of
+piling up and timing out:
+
+* the queue is full: 429 straight away;
+* the request's deadline passes while it is queued: 503;
+* the client disconnected while it was queued: the work is dropped (499).
+
+Both rejections carry a ``Retry-After`` estimated from the recent service
+time. A request's deadline is the controller's ``timeout``. Clients can
+shorten it, but not extend it past ``timeout``, by sending
+``X-Request-Timeout: <seconds>``.
+
+Time spent queued and time spent holding a slot are reported as separate
+histograms, ``facetrace_admission_queue_seconds`` and
+``facetrace_admission_service_seconds``, per pool. Size the executor that
+runs the model work to ``max_concurrency``, so admitted work never waits
+again behind the executor's own unbounded queue.
+"""
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from starlette.exceptions import HTTPException
+
+from common.metrics import LATENCY_BUCKETS, Counter, Gauge, Histogram
+
+TIMEOUT_HEADER = "x-request-timeout"
+# Weight of the newest observation in the service-time average used for Retry-After
+SERVICE_EWMA_ALPHA = 0.2
+MAX_RETRY_AFTER = 60
+
+QUEUE_SECONDS = Histogram("facetrace_admission_queue_seconds", "Time a request waited for a model slot.", ["pool"],
+                          buckets=LATENCY_BUCKETS + (30.0, 60.0))
+SERVICE_SECONDS = Histogram("facetrace_admission_service_seconds", "Time a request held a model slot.", ["pool"],
+                            buckets=LATENCY_BUCKETS + (30.0, 60.0))
+REJECTED = Counter("facetrace_admission_rejected_total", "Requests turned away by admission control.",
+                   ["pool", "reason"])
+ACTIVE = Gauge("facetrace_admission_active", "Requests holding a model slot.", ["pool"])
+QUEUED = Gauge("facetrace_admission_queued", "Requests waiting for a model slot.", ["pool"])
+
+
+class Overloaded(HTTPException):
+    """The request was rejected by admission control; the response carries ``Retry-After``."""
+
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(status_code, detail, headers={"Retry-After": str(retry_after)})
+
+
+class ClientGone(HTTPException):
+    """The client disconnected while its request was queued (nginx's 499)."""
+
+    def __init__(self):
+        super().__init__(499, "Client closed request")
+
+
+class Ticket:
+    """A held model slot; release it exactly once, or use :meth:`AdmissionController.slot`."""
+
+    __slots__ = ("_controller", "deadline", "queued_seconds", "_started", "_released")
+
+    def __init__(self, controller: "AdmissionController", deadline: float, queued_seconds: float):
+        self._controller = controller
+        self.deadline = deadline
+        self.queued_seconds = queued_seconds
+        self._started = time.monotonic()
+        self._released = False
+
+    def remaining(self) -> float:
+        """Seconds left until the request's deadline."""
+        return self.deadline - time.monotonic()
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def release(self):
+        """Give the slot to the next queued request; calling it again does nothing."""
+        if not self._released:
+            self._released = True
+            self._controller._release(time.monotonic() - self._started)
+
+
+class AdmissionController:
+    """Bounded concurrency with a bounded FIFO queue and per-request deadlines for one pool of model work."""
+
+    def __init__(self, pool: str, max_concurrency: int, max_queue: int, timeout: float):
+        self.pool = pool
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max(0, max_queue)
+        self.timeout = timeout
+        self._active = 0
+        self._waiters: deque = deque()
+        self._service_ewma: Optional[float] = None
+        self._queue_seconds = QUEUE_SECONDS.labels(pool)
+        self._service_seconds = SERVICE_SECONDS.labels(pool)
+        ACTIVE.labels(pool).set_function(lambda: self._active)
+        QUEUED.labels(pool).set_function(lambda: len(self._waiters))
+
+    def retry_after(self) -> int:
+        """Seconds until a slot is likely free: the queue ahead, drained at the recent service rate."""
+        if self._service_ewma is None:
+            return 1
+        estimate = self._service_ewma * (len(self._waiters) + 1) / self.max_concurrency
+        return min(MAX_RETRY_AFTER, max(1, math.ceil(estimate)))
+
+    def _reject(self, reason: str, status_code: int, detail: str):
+        REJECTED.labels(self.pool, reason).inc()
+        raise Overloaded(status_code, detail, self.retry_after())
+
+    def deadline_passed(self, detail: str = "Request deadline passed") -> Overloaded:
+        """The 503 to raise for admitted work that outlives its deadline, counted like a queued one."""
+        REJECTED.labels(self.pool, "deadline").inc()
+        return Overloaded(503, detail, self.retry_after())
+
+    def deadline_for(self, request=None) -> float:
+        """Monotonic deadline of a request: ``timeout`` from now, or sooner if the client asked for it."""
+        timeout = self.timeout
+        header = request.headers.get(TIMEOUT_HEADER) if request is not None else None
+        if header:
+            try:
+                timeout = min(timeout, max(0.0, float(header)))
+            except ValueError:
+                pass
+        return time.monotonic() + timeout
+
+    async def acquire(self, request=None) -> Ticket:
+        """Wait for a slot, or raise :class:`Overloaded` / :class:`ClientGone` when the request cannot be served.
+
+        ``request`` (a Starlette ``Request``) supplies the timeout header and
+        is checked for a disconnect after queueing.
+        """
+        deadline = self.deadline_for(request)
+        start = time.monotonic()
+        if self._active < self.max_concurrency and not self._waiters:
+            self._active += 1
+            self._queue_seconds.observe(0.0)
+            return Ticket(self, deadline, 0.0)
+        if len(self._waiters) >= self.max_queue:
+            self._reject("queue_full", 429, f"Server busy: {self._active} running and {len(self._waiters)} queued")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, max(0.0, deadline - start))
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as the wait ended; pass it on
+                self._release(None)
+            else:
+                waiter.cancel()
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+            if isinstance(e, asyncio.TimeoutError):
+                self._queue_seconds.observe(time.monotonic() - start)
+                self._reject("deadline", 503, "Request deadline passed while queued")
+            raise
+        queued = time.monotonic() - start
+        self._queue_seconds.observe(queued)
+        if request is not None and await request.is_disconnected():
+            self._release(None)
+            REJECTED.labels(self.pool, "client_gone").inc()
+            raise ClientGone()
+        return Ticket(self, deadline, queued)
+
+    def _release(self, service_seconds: Optional[float]):
+        if service_seconds is not None:
+            self._service_seconds.observe(service_seconds)
+            self._service_ewma = service_seconds if self._service_ewma is None else \
+                SERVICE_EWMA_ALPHA * service_seconds + (1 - SERVICE_EWMA_ALPHA) * self._service_ewma
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # Hand the slot straight to the next request, so newcomers cannot overtake the queue
+                waiter.set_result(None)
+                return
+        self._active -= 1
+
+    @asynccontextmanager
+    async def slot(self, request=None):
+        """``async with controller.slot(request) as ticket:`` holds a slot for the block."""
+        ticket = await self.acquire(request)
+        try:
+            yield ticket
+        finally:
+            ticket.release()
+
+    def stats(self) -> dict:
+        return {"pool": self.pool, "active": self._active, "queued": len(self._waiters),
+                "max_concurrency": self.max_concurrency, "max_queue": self.max_queue, "timeout": self.timeout,
+                "mean_service_seconds": self._service_ewma}
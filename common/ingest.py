@@ -0,0 +1,123 @@
+"""Bounded image ingest shared by api and api2.
+
+Uploads are read with a byte limit (``INGEST_MAX_BYTES``). Their dimensions
+are checked against ``INGEST_MAX_PIXELS`` from the header alone, before any
+pixel is decoded. JPEGs much larger than the model input are decoded at
+1/2, 1/4 or 1/8 scale through libjpeg's DCT scaling (``Image.draft``), so a
+12 MP phone photo of a sketch never exists at full resolution in memory.
+:func:`to_tensor` writes normalized pixels straight into a caller's
+(typically reused, see :func:`batch_buffer`) float tensor in CHW layout,
+without an intermediate float image.
+"""
+import io
+import os
+import threading
+from typing import Optional, Tuple
+
+import numpy as np
+import torch
+from PIL import Image, UnidentifiedImageError
+
+INGEST_MAX_BYTES = int(os.getenv("INGEST_MAX_BYTES", str(25 * 2 ** 20)))
+INGEST_MAX_PIXELS = int(os.getenv("INGEST_MAX_PIXELS", "50000000"))
+READ_CHUNK_BYTES = 1 << 20
+
+_local = threading.local()
+
+
+class IngestError(ValueError):
+    """An upload could not be decoded as an image."""
+
+
+class ImageTooLarge(IngestError):
+    """An upload exceeds the byte or pixel limit."""
+
+
+async def read_upload(upload, max_bytes: int = INGEST_MAX_BYTES) -> bytes:
+    """Read a FastAPI ``UploadFile``, failing as soon as it exceeds ``max_bytes``."""
+    if upload.size is not None and upload.size > max_bytes:
+        raise ImageTooLarge(f"Upload is {upload.size} bytes, the limit is {max_bytes}")
+    contents = bytearray()
+    while True:
+        chunk = await upload.read(READ_CHUNK_BYTES)
+        if not chunk:
+            return bytes(contents)
+        contents += chunk
+        if len(contents) > max_bytes:
+            raise ImageTooLarge(f"Upload exceeds the {max_bytes} byte limit")
+
+
+def open_image(contents: bytes, max_pixels: int = INGEST_MAX_PIXELS) -> Image.Image:
+    """Open an image lazily and check its dimensions; no pixels are decoded yet."""
+    try:
+        img = Image.open(io.BytesIO(contents))
+    except Image.DecompressionBombError as e:
+        # Raised by Image.open itself beyond twice PIL's MAX_IMAGE_PIXELS, before our own check
+        raise ImageTooLarge(f"Image is too large: {e}")
+    except UnidentifiedImageError:
+        raise IngestError("Could not decode image: unrecognized image format")
+    except OSError as e:
+        raise IngestError(f"Could not decode image: {e}")
+    width, height = img.size
+    if width * height > max_pixels:
+        raise ImageTooLarge(f"Image is {width}x{height} pixels, the limit is {max_pixels}")
+    return img
+
+
+def decode_image(contents: bytes, mode: str = "RGB", size: Optional[Tuple[int, int]] = None,
+                 max_side: Optional[int] = None, max_pixels: int = INGEST_MAX_PIXELS) -> Image.Image:
+    """Decode an upload to ``mode``, resized to exactly ``size`` or to at most ``max_side`` on its longest side.
+
+    JPEGs are decoded at the smallest DCT scale that still covers the
+    requested size, then resized with bilinear filtering.
+    """
+    img = open_image(contents, max_pixels)
+    if size is not None:
+        target = size
+    elif max_side is not None and max(img.size) > max_side:
+        scale = max_side / max(img.size)
+        target = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+    else:
+        target = None
+    try:
+        if target is not None and img.format == "JPEG":
+            # Also lets libjpeg convert to grayscale itself for mode "L"
+            img.draft(mode, target)
+        img = img.convert(mode)
+        if target is not None and img.size != target:
+            img = img.resize(target, Image.BILINEAR)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise IngestError(f"Could not decode image: {e}")
+    return img
+
+
+def to_tensor(img: Image.Image, out: Optional[torch.Tensor] = None, mean: float = 0.5,
+              std: float = 0.5) -> torch.Tensor:
+    """Write ``(pixels / 255 - mean) / std`` of an 8-bit L or RGB image into a ``(C, H, W)`` float tensor.
+
+    ``out`` (for example a row of :func:`batch_buffer`) is filled in place;
+    otherwise a new tensor is allocated.
+    """
+    pixels = np.asarray(img)
+    pixels = pixels[None] if pixels.ndim == 2 else pixels.transpose(2, 0, 1)
+    if out is None:
+        out = torch.empty(pixels.shape, dtype=torch.float32)
+    target = out.numpy()
+    np.multiply(pixels, 1.0 / (255.0 * std), out=target, casting="unsafe")
+    target -= mean / std
+    return out
+
+
+def batch_buffer(count: int, item_shape: Tuple[int, ...]) -> torch.Tensor:
+    """A ``(count, *item_shape)`` float tensor reused by the calling thread.
+
+    The same memory is handed out again on this thread's next call for that
+    item shape, so use the batch before preparing the next one.
+    """
+    buffers = getattr(_local, "buffers", None)
+    if buffers is None:
+        buffers = _local.buffers = {}
+    buffer = buffers.get(item_shape)
+    if buffer is None or buffer.shape[0] < count:
+        buffer = buffers[item_shape] = torch.empty((count,) + tuple(item_shape), dtype=torch.float32)
+    return buffer[:count]
@@ -0,0 +1,271 @@
+"""Low-overhead in-process metrics shared by api and api2, served in Prometheus text format.
+
+Both apps add :class:`MetricsMiddleware` for request counts, latency and
+in-flight requests, time their internal stages with ``stage("decode")`` and
+friends, and expose :func:`render` on ``/metrics``. Each observation is a
+bucket lookup and a few increments under a lock, so it is cheap enough to
+leave on in production.
+"""
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+from common.profiler import SlowRequestProfiler
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds in seconds, from sub-millisecond search to multi-second generation
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def labels(self, *values: str):
+        """The child metric for one combination of label values, created on first use."""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _default(self):
+        return self.labels()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def collect(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self._children.items()):
+            lines.extend(self._sample_lines(values, child))
+        return lines
+
+    def _sample_lines(self, values, child) -> list:
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.get())}"]
+
+
+class _Value:
+    __slots__ = ("_value", "_lock", "_function")
+
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+        self._function: Optional[Callable[[], float]] = None
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1.0):
+        with self._lock:
+            self._value -= amount
+
+    def set(self, value: float):
+        self._value = float(value)
+
+    def set_function(self, function: Callable[[], float]):
+        """Report ``function()`` at scrape time instead of a stored value."""
+        self._function = function
+
+    def get(self) -> float:
+        return float(self._function()) if self._function is not None else self._value
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1.0):
+        self._default().inc(amount)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1.0):
+        self._default().inc(amount)
+
+    def dec(self, amount: float = 1.0):
+        self._default().dec(amount)
+
+    def set(self, value: float):
+        self._default().set(value)
+
+    def set_function(self, function: Callable[[], float]):
+        self._default().set_function(function)
+
+
+class _HistogramValue:
+    __slots__ = ("_bounds", "_counts", "_sum", "_lock")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self._bounds = bounds
+        self._counts = [0] * (len(bounds) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def snapshot(self) -> Tuple[list, float]:
+        with self._lock:
+            return list(self._counts), self._sum
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+    def _sample_lines(self, values, child) -> list:
+        counts, total = child.snapshot()
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, values, f'le="{_format_value(bound)}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics):
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = Histogram("facetrace_stage_seconds", "Time spent in one processing stage.", ["stage"])
+BATCH_SIZE = Histogram("facetrace_batch_size", "Items per model batch.", ["model"], buckets=BATCH_SIZE_BUCKETS)
+REQUEST_SECONDS = Histogram("facetrace_request_seconds", "HTTP request latency until the response is sent.",
+                            ["method", "endpoint"])
+REQUESTS = Counter("facetrace_requests_total", "HTTP requests by response status.", ["method", "endpoint", "status"])
+IN_FLIGHT = Gauge("facetrace_in_flight_requests", "HTTP requests currently being served.")
+IN_FLIGHT.set(0)
+
+
+class stage:
+    """Context manager that records the duration of a block under ``facetrace_stage_seconds{stage=name}``."""
+
+    __slots__ = ("_histogram", "_start")
+
+    def __init__(self, name: str):
+        self._histogram = STAGE_SECONDS.labels(name)
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.perf_counter() - self._start)
+        return False
+
+
+def observe_batch(model: str, size: int):
+    BATCH_SIZE.labels(model).observe(size)
+
+
+def render() -> str:
+    """All registered metrics in the Prometheus text exposition format."""
+    return REGISTRY.render()
+
+
+class MetricsMiddleware:
+    """ASGI middleware counting requests, timing them and tracking the number in flight.
+
+    Requests are labelled with the route template (``/enroll/{image_id}``) so
+    path parameters do not create new series; the time includes streaming the
+    response body. When the slow-request profiler is enabled (see
+    ``common.profiler``), requests slower than its threshold get their sampled
+    stacks written to disk.
+    """
+
+    def __init__(self, app, profiler: Optional[SlowRequestProfiler] = None):
+        self.app = app
+        self.profiler = profiler if profiler is not None else SlowRequestProfiler.from_env()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        IN_FLIGHT.inc()
+        token = self.profiler.begin() if self.profiler is not None else None
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            IN_FLIGHT.dec()
+            endpoint = getattr(scope.get("route"), "path", "unmatched")
+            REQUEST_SECONDS.labels(scope["method"], endpoint).observe(elapsed)
+            REQUESTS.labels(scope["method"], endpoint, str(status)).inc()
+            if token is not None:
+                self.profiler.end(token, f"{scope['method']} {endpoint}", elapsed)
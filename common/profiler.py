@@ -0,0 +1,105 @@
+"""Opt-in sampling profiler that keeps stacks only for slow requests.
+
+Enabled by setting ``PROFILE_SLOW_REQUEST_MS``. While at least one request
+is in flight a background thread samples the stacks of all threads every
+``PROFILE_INTERVAL_MS`` and adds them to each in-flight request. A request
+that takes longer than the threshold has its samples written to
+``PROFILE_DIR`` in the collapsed-stack format (``thread;frame;frame count``)
+read by flamegraph.pl, speedscope and inferno. Samples of concurrent
+requests overlap, since work is shared between the event loop and worker
+threads; profiles are clearest at low concurrency.
+"""
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+PROFILE_SLOW_REQUEST_MS = float(os.getenv("PROFILE_SLOW_REQUEST_MS", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# Stop writing after this many profiles so a slow period cannot fill the disk
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "100"))
+
+
+def collapse_stack(frame, thread_name: str) -> str:
+    """``thread;outermost;...;innermost`` with frames as ``function (file:line)``."""
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    frames.append(thread_name)
+    return ";".join(reversed(frames))
+
+
+class SlowRequestProfiler:
+    def __init__(self, threshold_ms: float, interval_ms: float = PROFILE_INTERVAL_MS,
+                 output_dir: str = PROFILE_DIR, max_files: int = PROFILE_MAX_FILES):
+        self.threshold = threshold_ms / 1000
+        self.interval = interval_ms / 1000
+        self.output_dir = output_dir
+        self.max_files = max_files
+        self.files_written = 0
+        self._active = {}
+        self._next_token = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_env(cls) -> Optional["SlowRequestProfiler"]:
+        """A profiler configured from the environment, or None when it is not enabled."""
+        return cls(PROFILE_SLOW_REQUEST_MS) if PROFILE_SLOW_REQUEST_MS > 0 else None
+
+    def begin(self) -> int:
+        """Start collecting samples for a request; returns the token to pass to ``end``."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="slow-request-profiler", daemon=True)
+                self._thread.start()
+            self._next_token += 1
+            token = self._next_token
+            self._active[token] = Counter()
+        self._wake.set()
+        return token
+
+    def end(self, token: int, name: str, seconds: float):
+        """Stop collecting for a request and write its stacks if it was slow."""
+        with self._lock:
+            samples = self._active.pop(token, None)
+            if not self._active:
+                self._wake.clear()
+        if not samples or seconds < self.threshold or self.files_written >= self.max_files:
+            return
+        self.files_written += 1
+        try:
+            self._write(name, seconds, samples)
+        except OSError as e:
+            logger.error(f"Could not write profile for {name}: {e}")
+
+    def _write(self, name: str, seconds: float, samples: Counter):
+        os.makedirs(self.output_dir, exist_ok=True)
+        slug = re.sub(r"[^A-Za-z0-9]+", "_", name).strip("_")
+        path = os.path.join(self.output_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{slug}-{seconds * 1000:.0f}ms.folded")
+        with open(path, "w") as f:
+            for stack, count in samples.most_common():
+                f.write(f"{stack} {count}\n")
+        logger.warning(f"{name} took {seconds * 1000:.0f}ms, wrote {sum(samples.values())} stack samples to {path}")
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while True:
+            self._wake.wait()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = [collapse_stack(frame, names.get(ident, str(ident)))
+                      for ident, frame in sys._current_frames().items() if ident != own_ident]
+            with self._lock:
+                for samples in self._active.values():
+                    samples.update(stacks)
+            time.sleep(self.interval)
@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# api2's modules import each other by name, as when the service runs from api2/
+sys.path[:0] = [os.path.join(ROOT, "api2"), ROOT]
+
+# Keep every file api2 writes out of the source tree, and never download model weights
+os.environ.setdefault("API2_EMBEDDINGS_PATH", os.path.join(tempfile.mkdtemp(prefix="api2-tests-"), "embeddings.emb"))
+os.environ.setdefault("API2_RESNET_PRETRAINED", "")
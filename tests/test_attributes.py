@@ -0,0 +1,83 @@
+import json
+
+import numpy as np
+import pytest
+
+from attributes import AttributeIndex, Filter, FilterError, load_records
+
+COUNTIES = ("COOK", "LAKE", "WILL", "KANE")
+
+
+@pytest.fixture(scope="module")
+def records():
+    rng = np.random.default_rng(0)
+    records = {}
+    for i in range(400):
+        record = {"id": f"A{i:05d}", "county": COUNTIES[rng.integers(4)] if i % 3 else "Cook",
+                  "class": str(rng.choice(["X", "1", "2", "3"])), "count": int(rng.integers(1, 6)),
+                  "custody_date": f"{rng.integers(1, 13):02d}/{rng.integers(1, 29):02d}/{rng.integers(2005, 2020)}"}
+        if i % 17 == 0:
+            del record["custody_date"]
+        if i % 50 == 0:
+            record["mark"] = "Tattoo"
+        records[record["id"]] = record
+    return records
+
+
+@pytest.fixture(scope="module")
+def index(records):
+    # Some gallery rows have no record at all
+    return AttributeIndex(list(records) + ["B00001", "B00002"], records)
+
+
+@pytest.mark.parametrize("conditions", [
+    {"county": "cook"},
+    {"county": ["LAKE", "will"], "class": "X"},
+    {"class": ["1", "2"], "count": {"gte": 2, "lt": 4}},
+    {"count": 3},
+    {"custody_date": {"gte": "01/01/2010", "lte": "12/31/2012"}, "county": "KANE"},
+    {"custody_date": {"gt": "06/15/2015"}},
+    {"county": "NOWHERE"},
+    {"mark": "TATTOO", "county": "cook"},
+    {"count": {"gt": 3, "gte": 3, "lt": 5, "lte": 4}},
+])
+def test_select_matches_record_by_record_check(index, conditions):
+    query_filter = Filter.parse(json.dumps(conditions))
+    expected = [row for row, image_id in enumerate(index.ids) if query_filter.matches(index.records.get(image_id))]
+    assert index.select(query_filter).tolist() == expected
+
+
+def test_common_values_are_bitmaps_and_rare_ones_posting_lists(index):
+    assert index.values["county"]["cook"].dtype == bool
+    assert index.values["class"]["x"].dtype == bool
+    assert index.values["mark"]["tattoo"].tolist() == list(range(0, 400, 50))
+
+
+def test_parse_empty_and_ranges():
+    assert Filter.parse(None) is None and Filter.parse("") is None and Filter.parse("{}") is None
+    assert Filter.parse('{"count": {"gt": 2, "gte": 2, "lte": 5}}').ranges["count"] == (2.0, 5.0, False, True)
+    assert Filter.parse('{"count": 4}').ranges["count"] == (4.0, 4.0, True, True)
+    assert Filter.parse('{"county": ["Cook", " LAKE "]}').categories["county"] == {"cook", "lake"}
+
+
+@pytest.mark.parametrize("text", [
+    "not json",
+    "[1, 2]",
+    '{"height": 180}',
+    '{"count": {"between": [1, 2]}}',
+    '{"count": {"gte": "many"}}',
+    '{"custody_date": {"gte": "2014-03-18"}}',
+    '{"county": {"eq": "COOK"}}',
+    '{"county": null}',
+])
+def test_parse_rejects_bad_filters(text):
+    with pytest.raises(FilterError):
+        Filter.parse(text)
+
+
+def test_load_records_reads_json_lines_and_arrays(tmp_path):
+    lines = tmp_path / "details.jsonl"
+    lines.write_text('{"id": "A1", "county": "COOK"}\n\n{"id": 2, "county": "LAKE"}\n{"county": "no id"}\n')
+    array = tmp_path / "details.json"
+    array.write_text(json.dumps([{"id": "A1", "county": "COOK"}, {"id": 2, "county": "LAKE"}]))
+    assert set(load_records(str(lines))) == set(load_records(str(array))) == {"A1", "2"}
@@ -0,0 +1,64 @@
+import asyncio
+import io
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from batcher import MicroBatcher
+
+FACE_IMAGE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "api2", "criminal_faces",
+                          "A00147.jpg")
+
+
+def run_batch(process_batch, items, max_batch_size=8):
+    async def main():
+        batcher = MicroBatcher(process_batch, max_batch_size, max_wait_ms=50)
+        batcher.start()
+        try:
+            return await asyncio.gather(*(batcher.submit(item) for item in items), return_exceptions=True)
+        finally:
+            await batcher.stop()
+    return asyncio.run(main())
+
+
+def test_results_follow_submission_order():
+    sizes = []
+
+    def double(batch):
+        sizes.append(len(batch))
+        return [item * 2 for item in batch]
+
+    assert run_batch(double, list(range(5))) == [0, 2, 4, 6, 8]
+    assert sizes == [5]
+
+
+def test_failing_item_does_not_fail_its_batch():
+    def process(batch):
+        if "bad" in batch:
+            raise ValueError("bad item")
+        return [item.upper() for item in batch]
+
+    results = run_batch(process, ["a", "bad", "c"])
+    assert results[0] == "A" and results[2] == "C"
+    assert isinstance(results[1], ValueError)
+
+
+def encode(img: Image.Image, image_format: str = "PNG") -> bytes:
+    buffer = io.BytesIO()
+    img.save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+def test_tiny_upload_only_loses_its_own_embedding():
+    pytest.importorskip("facenet_pytorch")
+    import api
+
+    api.load_models()
+    with open(FACE_IMAGE, "rb") as f:
+        face = f.read()
+    tiny = encode(Image.new("RGB", (4, 4)))
+    embeddings = api.embed_image_batch([tiny, face, tiny, face])
+    assert embeddings[0] is None and embeddings[2] is None
+    assert embeddings[1] is not None and np.allclose(embeddings[1], embeddings[3], atol=1e-5)
@@ -0,0 +1,81 @@
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from embedding_store import EmbeddingStoreError, StoreBusy, convert_pickle, open_store, store_lock, write_store
+
+
+@pytest.fixture
+def matrix():
+    rng = np.random.default_rng(0)
+    matrix = rng.standard_normal((300, 32)).astype(np.float32)
+    return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float16])
+def test_round_trip(tmp_path, matrix, dtype):
+    path = str(tmp_path / "embeddings.emb")
+    ids = [f"id{i}" for i in range(len(matrix))]
+    write_store(path, ids, matrix, dtype=dtype, model_version="v1")
+    stored_ids, stored, meta = open_store(path)
+    assert stored_ids == ids
+    assert stored.dtype == np.dtype(dtype) and stored.shape == matrix.shape
+    assert isinstance(stored, np.memmap) and not stored.flags.writeable
+    np.testing.assert_allclose(stored, matrix, atol=1e-3 if dtype == np.float16 else 0)
+    assert meta["model_version"] == "v1"
+    assert os.listdir(tmp_path) == ["embeddings.emb"]
+
+
+def test_empty_store(tmp_path):
+    path = str(tmp_path / "embeddings.emb")
+    write_store(path, [], np.zeros((0, 32), dtype=np.float32))
+    ids, stored, _ = open_store(path)
+    assert ids == [] and stored.shape == (0, 32)
+
+
+def test_rejects_mismatched_ids(tmp_path, matrix):
+    with pytest.raises(ValueError):
+        write_store(str(tmp_path / "embeddings.emb"), ["only-one"], matrix)
+
+
+def test_truncated_or_foreign_file_is_an_error(tmp_path, matrix):
+    path = str(tmp_path / "embeddings.emb")
+    write_store(path, [f"id{i}" for i in range(len(matrix))], matrix)
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 100)
+    with pytest.raises(EmbeddingStoreError, match="truncated"):
+        open_store(path)
+    with open(path, "wb") as f:
+        f.write(b"\x80\x04not a store" * 100)
+    with pytest.raises(EmbeddingStoreError, match="not an embedding store"):
+        open_store(path)
+
+
+def test_convert_pickle_normalizes_both_layouts(tmp_path, matrix):
+    embeddings = {f"id{i}": row * 3 for i, row in enumerate(matrix[:10])}
+    layouts = {"api2.pkl": embeddings,
+               "notebook.pickle": {"ids": list(embeddings), "embeddings": list(embeddings.values())}}
+    for name, data in layouts.items():
+        with open(tmp_path / name, "wb") as f:
+            pickle.dump(data, f)
+        dst = str(tmp_path / f"{name}.emb")
+        assert convert_pickle(str(tmp_path / name), dst) == 10
+        ids, stored, _ = open_store(dst)
+        assert ids == list(embeddings)
+        np.testing.assert_allclose(stored, matrix[:10], atol=1e-6)
+
+
+def test_exclusive_lock_excludes_other_holders(tmp_path):
+    path = str(tmp_path / "embeddings.emb")
+    with store_lock(path, shared=True, timeout=0):
+        with store_lock(path, shared=True, timeout=0):
+            pass
+        with pytest.raises(StoreBusy):
+            with store_lock(path, timeout=0.1):
+                pass
+    with store_lock(path, timeout=0):
+        with pytest.raises(StoreBusy):
+            with store_lock(path, shared=True, timeout=0):
+                pass
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+from gallery import GalleryIndex
+
+DIM = 16
+
+
+def make_gallery(n=200, seed=0):
+    rng = np.random.default_rng(seed)
+    ids = [f"id{i}" for i in range(n)]
+    embeddings = rng.standard_normal((n, DIM)).astype(np.float32)
+    gallery = GalleryIndex(dim=DIM, capacity=4)
+    assert gallery.add_many(zip(ids, embeddings)) == n
+    return gallery, ids, embeddings
+
+
+def brute_force(ids, embeddings, query, k, allowed=None):
+    matrix = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    scores = matrix @ (query / np.linalg.norm(query))
+    order = [row for row in np.argsort(-scores, kind="stable") if allowed is None or row in allowed]
+    return [(ids[row], float(scores[row])) for row in order[:k]]
+
+
+def assert_same(results, expected):
+    assert [image_id for image_id, _ in results] == [image_id for image_id, _ in expected]
+    np.testing.assert_allclose([score for _, score in results], [score for _, score in expected], atol=1e-5)
+
+
+def test_search_matches_brute_force():
+    gallery, ids, embeddings = make_gallery()
+    rng = np.random.default_rng(1)
+    for query in rng.standard_normal((5, DIM)):
+        assert_same(gallery.search(query, k=7), brute_force(ids, embeddings, query, 7))
+
+
+def test_search_many_matches_search_and_skips_zero_queries():
+    gallery, ids, embeddings = make_gallery()
+    queries = np.random.default_rng(2).standard_normal((4, DIM)).astype(np.float32)
+    queries[2] = 0
+    results = gallery.search_many(queries, k=5)
+    assert results[2] == []
+    for query, result in zip(queries[[0, 1, 3]], [results[0], results[1], results[3]]):
+        assert_same(result, brute_force(ids, embeddings, query, 5))
+
+
+def test_search_many_threshold_and_rows():
+    gallery, ids, embeddings = make_gallery()
+    query = embeddings[10]
+    # Prefiltered (few rows) and post-filtered (most rows) paths must agree with brute force
+    for allowed in (np.array([3, 10, 57, 120]), np.arange(0, 200, 2)):
+        (result,) = gallery.search_many(query[None], k=5, rows=allowed)
+        assert_same(result, brute_force(ids, embeddings, query, 5, set(allowed.tolist())))
+    (result,) = gallery.search_many(query[None], k=50, threshold=0.5)
+    assert result[0][0] == "id10"
+    assert all(score >= 0.5 for _, score in result)
+    assert len(result) < 50
+
+
+def test_search_fused_ranks_by_max_and_mean():
+    gallery, ids, embeddings = make_gallery()
+    queries = embeddings[[4, 9]]
+    matrix = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    scores = matrix @ (queries / np.linalg.norm(queries, axis=1, keepdims=True)).T
+    for mode, fused in (("max", scores.max(axis=1)), ("mean", scores.mean(axis=1))):
+        expected = [(ids[row], float(fused[row])) for row in np.argsort(-fused, kind="stable")[:6]]
+        assert_same(gallery.search_fused(queries, k=6, mode=mode), expected)
+    with pytest.raises(ValueError):
+        gallery.search_fused(queries, mode="sum")
+
+
+def test_remove_keeps_rows_packed_and_copy_is_independent():
+    gallery, ids, embeddings = make_gallery(n=20)
+    snapshot = gallery.copy()
+    assert gallery.remove("id3") and not gallery.remove("id3")
+    assert len(gallery) == 19 and "id3" not in gallery
+    assert gallery.add("id3b", embeddings[3])
+    np.testing.assert_allclose(gallery.get("id19"), embeddings[19] / np.linalg.norm(embeddings[19]), atol=1e-6)
+    assert gallery.search(embeddings[3], k=1)[0][0] == "id3b"
+    # The copy still searches the original rows
+    assert snapshot.search(embeddings[3], k=1)[0][0] == "id3"
+    assert len(snapshot) == 20 and "id3b" not in snapshot
+    assert not gallery.add("zero", np.zeros(DIM))
+
+
+def test_float16_matrix_searches_in_blocks():
+    gallery, ids, embeddings = make_gallery()
+    half = GalleryIndex.from_matrix(ids, gallery.matrix.astype(np.float16))
+    half.SEARCH_BLOCK_ROWS = 64
+    query = embeddings[42]
+    assert [image_id for image_id, _ in half.search(query, k=3)] == \
+        [image_id for image_id, _ in gallery.search(query, k=3)]
@@ -0,0 +1,69 @@
+import os
+
+import pytest
+
+from manifest import EnrollmentManifest
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    paths = {}
+    for image_id in ("a", "b", "c", "noface"):
+        path = tmp_path / f"{image_id}.jpg"
+        path.write_bytes(f"image {image_id}".encode())
+        paths[image_id] = str(path)
+    manifest = EnrollmentManifest("v1")
+    for image_id, path in paths.items():
+        manifest.record(image_id, path, embedded=image_id != "noface")
+    return paths, manifest
+
+
+def test_unchanged_dataset_needs_nothing(dataset):
+    paths, manifest = dataset
+    assert manifest.diff(paths, ["a", "b", "c"]) == ({}, [])
+
+
+def test_new_changed_and_removed_files(dataset, tmp_path):
+    paths, manifest = dataset
+    with open(paths["b"], "wb") as f:
+        f.write(b"a different image")
+    new = tmp_path / "d.jpg"
+    new.write_bytes(b"image d")
+    listing = {image_id: path for image_id, path in paths.items() if image_id != "c"}
+    listing["d"] = str(new)
+    to_embed, to_remove = manifest.diff(listing, ["a", "b", "c"])
+    assert to_embed == {"b": paths["b"], "d": str(new)}
+    assert to_remove == ["c"]
+    assert "c" not in manifest.entries
+
+
+def test_touched_file_with_same_content_is_current(dataset):
+    paths, manifest = dataset
+    stat = os.stat(paths["a"])
+    os.utime(paths["a"], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert manifest.diff(paths, ["a", "b", "c"]) == ({}, [])
+    assert manifest.entries["a"]["mtime_ns"] == stat.st_mtime_ns + 10 ** 9
+
+
+def test_gallery_out_of_sync_with_manifest(dataset):
+    paths, manifest = dataset
+    # "a" was recorded as embedded but is missing from the gallery
+    to_embed, to_remove = manifest.diff(paths, ["b", "c"])
+    assert to_embed == {"a": paths["a"]} and to_remove == []
+
+
+def test_model_version_change_re_embeds_everything(dataset, tmp_path):
+    paths, manifest = dataset
+    path = str(tmp_path / "manifest.json")
+    manifest.save(path)
+    reloaded = EnrollmentManifest.load(path, "v2")
+    to_embed, to_remove = reloaded.diff(paths, ["a", "b", "c"])
+    assert to_embed == paths and to_remove == []
+    assert EnrollmentManifest.load(path, "v1").diff(paths, ["a", "b", "c"]) == ({}, [])
+
+
+def test_unreadable_manifest_starts_empty(tmp_path):
+    path = tmp_path / "manifest.json"
+    path.write_text("{not json")
+    assert len(EnrollmentManifest.load(str(path), "v1")) == 0
+    assert len(EnrollmentManifest.load(str(tmp_path / "missing.json"), "v1")) == 0
@@ -0,0 +1,108 @@
+import socket
+import threading
+
+import numpy as np
+import pytest
+
+from gallery import GalleryIndex
+from shards import ShardError, ShardServer, ShardedGallery, partition, shard_of, shard_store_path, write_shard_stores
+
+COUNT = 3
+DIM = 16
+AUTHKEY = b"test"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture(scope="module")
+def gallery():
+    rng = np.random.default_rng(0)
+    embeddings = rng.standard_normal((500, DIM)).astype(np.float32)
+    gallery = GalleryIndex(dim=DIM)
+    gallery.add_many((f"id{i}", embedding) for i, embedding in enumerate(embeddings))
+    return gallery
+
+
+@pytest.fixture(scope="module")
+def sharded(gallery, tmp_path_factory):
+    template = str(tmp_path_factory.mktemp("shards") / "embeddings.shard{shard}-of-{count}.emb")
+    assert write_shard_stores(gallery.ids, gallery.matrix, COUNT, template) == list(range(COUNT))
+    addresses = []
+    for shard in range(COUNT):
+        address = ("127.0.0.1", free_port())
+        server = ShardServer(shard, COUNT, shard_store_path(shard, COUNT, template))
+        threading.Thread(target=server.serve_forever, args=(address, AUTHKEY), daemon=True).start()
+        addresses.append(address)
+    sharded = ShardedGallery(addresses, AUTHKEY, connect_timeout=10)
+    yield sharded
+    sharded.close()
+
+
+def ids_and_scores(results):
+    return [image_id for image_id, _ in results], np.array([score for _, score in results])
+
+
+def assert_same(results, expected):
+    ids, scores = ids_and_scores(results)
+    expected_ids, expected_scores = ids_and_scores(expected)
+    assert ids == expected_ids
+    np.testing.assert_allclose(scores, expected_scores, atol=1e-5)
+
+
+def test_partition_assigns_every_id_to_its_shard_once(gallery):
+    seen = []
+    for shard, shard_ids, rows in partition(gallery.ids, COUNT):
+        assert all(shard_of(image_id, COUNT) == shard for image_id in shard_ids)
+        assert shard_ids == [gallery.ids[row] for row in rows]
+        seen += shard_ids
+    assert sorted(seen) == sorted(gallery.ids)
+    assert [shard for shard, _, _ in partition(gallery.ids, COUNT, shards=[2, 0, 2])] == [0, 2]
+
+
+def test_merge_keeps_the_global_top_k():
+    lists = [[("a", 0.9), ("b", 0.5)], [], [("c", 0.7), ("d", 0.6)]]
+    assert ShardedGallery._merge(lists, 3) == [("a", 0.9), ("c", 0.7), ("d", 0.6)]
+
+
+def test_sharded_search_equals_exact_search(gallery, sharded):
+    queries = np.random.default_rng(1).standard_normal((4, DIM)).astype(np.float32)
+    assert sum(reply["size"] for reply in sharded.info()) == len(gallery)
+    for result, expected in zip(sharded.search_many(queries, k=10), gallery.search_many(queries, k=10)):
+        assert_same(result, expected)
+    assert_same(sharded.search(queries[0], k=3), gallery.search(queries[0], k=3))
+    for mode in ("max", "mean"):
+        assert_same(sharded.search_fused(queries, k=8, mode=mode), gallery.search_fused(queries, k=8, mode=mode))
+
+
+def test_filtered_sharded_search_equals_exact_search(gallery, sharded):
+    allowed = [f"id{i}" for i in range(0, 500, 7)]
+    query = np.random.default_rng(2).standard_normal((1, DIM)).astype(np.float32)
+    (result,) = sharded.search_many(query, k=5, ids=allowed)
+    (expected,) = gallery.search_many(query, k=5, rows=gallery.rows_of(allowed))
+    assert_same(result, expected)
+    assert sharded.search_many(query, k=5, ids=[]) == [[]]
+
+
+def test_push_replaces_shard_rows(gallery, sharded):
+    updated = gallery.copy()
+    updated.remove("id0")
+    updated.add("new", np.ones(DIM))
+    changed = {shard_of("id0", COUNT), shard_of("new", COUNT)}
+    assert sorted(sharded.push(updated.ids, updated.matrix, shards=changed)) == sorted(changed)
+    assert sharded.search(np.ones(DIM), k=1)[0][0] == "new"
+    assert "id0" not in [image_id for image_id, _ in sharded.search(gallery.get("id0"), k=3)]
+    # Restore the module's shards for the other tests
+    sharded.push(gallery.ids, gallery.matrix, shards=changed)
+
+
+def test_unreachable_shard_is_a_shard_error():
+    dead = ShardedGallery([("127.0.0.1", free_port())], AUTHKEY, connect_timeout=0)
+    try:
+        with pytest.raises(ShardError):
+            dead.search(np.ones(DIM))
+    finally:
+        dead.close()